@@ -1,6 +1,10 @@
+from collections import OrderedDict
+
+import torch
+
 from .model_resnet import ResNet_50, ResNet_101
 from .model_vit import ViT_EvoLVe
-from ..config import EMBEDDING_SIZE
+from ..config import EMBEDDING_SIZE, RESNET_WEIGHT_PATH, VIT_WEIGHT_PATH
 
 def get_backbone(name: str, **kwargs):
     """
@@ -27,4 +31,27 @@ def get_backbone(name: str, **kwargs):
         )
         
     else:
-        raise ValueError(f"Backbone '{name}' không được hỗ trợ.")
\ No newline at end of file
+        raise ValueError(f"Backbone '{name}' không được hỗ trợ.")
+
+
+def backbone_weight_path(name: str) -> str:
+    """File checkpoint ArcFace tương ứng với backbone (ResNet_50 / ResNet_101 dùng chung RESNET_WEIGHT_PATH)."""
+    return VIT_WEIGHT_PATH if name == 'ViT' else RESNET_WEIGHT_PATH
+
+
+def load_backbone_checkpoint(backbone, weight_path: str, device) -> None:
+    """
+    Nạp trọng số ArcFace vào backbone: lấy 'backbone_state_dict' (hoặc cả checkpoint),
+    bỏ tiền tố 'module.' do train bằng DataParallel.
+    """
+    ckpt = torch.load(weight_path, map_location=device, weights_only=False)
+    sd = ckpt.get('backbone_state_dict', ckpt)
+    if not isinstance(sd, dict):
+        raise KeyError(f"Không tìm thấy 'backbone_state_dict' hợp lệ trong checkpoint {weight_path}.")
+
+    new_sd = OrderedDict()
+    for k, v in sd.items():
+        if k.startswith("module."): k = k[7:]
+        new_sd[k] = v
+
+    backbone.load_state_dict(new_sd, strict=False)
@@ -0,0 +1,119 @@
+# model_api/app/backbones/onnx_backend.py
+import os
+import time
+
+import numpy as np
+import torch
+
+from app.utils.logger import logger
+
+INPUT_NAME = "input"
+OUTPUT_NAME = "embedding"
+
+
+def export_onnx(backbone, path: str, input_size, opset: int = 17) -> str:
+    """
+    Export backbone PyTorch (đã load checkpoint, eval) sang ONNX, trục batch động.
+    Graph trả về feature CHƯA chuẩn hóa, giống backbone(batch); L2 normalize làm ở Img2ImgService.
+    """
+    backbone = backbone.cpu().eval()
+    dummy = torch.randn(2, 3, *input_size)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            backbone, dummy, tmp_path,
+            input_names=[INPUT_NAME], output_names=[OUTPUT_NAME],
+            dynamic_axes={INPUT_NAME: {0: "batch"}, OUTPUT_NAME: {0: "batch"}},
+            opset_version=opset, do_constant_folding=True,
+        )
+    # Đổi tên sau khi export xong: server đang chạy không bao giờ đọc phải file dở
+    os.replace(tmp_path, path)
+    return path
+
+
+class OnnxBackbone:
+    """
+    Backbone chạy bằng ONNX Runtime: nhận batch (N, 3, H, W) float32 -> feature (N, D) float32.
+    onnxruntime là dependency tùy chọn, chỉ import khi IMG2IMG_INFERENCE_BACKEND='onnx'.
+    """
+    def __init__(self, path: str, device: str = "cpu", num_threads: int = 0):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise RuntimeError("onnxruntime is not installed (pip install onnxruntime)") from e
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"ONNX model not found at {path} (run: python -m app.export_onnx)")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        if str(device).startswith("cuda") and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options=options, providers=providers)
+        self.providers = self.session.get_providers()
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        return self.session.run([OUTPUT_NAME], {INPUT_NAME: batch})[0]
+
+
+def _l2_normalize(x: np.ndarray) -> np.ndarray:
+    return x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-12)
+
+
+def parity_check(torch_backbone, onnx_backbone: OnnxBackbone, batch: np.ndarray) -> dict:
+    """
+    So embedding (đã L2 normalize) của ONNX với PyTorch trên cùng một batch, chạy cả batch 1
+    (kiểm tra trục batch động). Trả về cosine nhỏ nhất, sai lệch tuyệt đối lớn nhất và thời gian mỗi ảnh.
+    """
+    batch = np.ascontiguousarray(batch, dtype=np.float32)
+    with torch.no_grad():
+        start = time.perf_counter()
+        ref = torch_backbone(torch.from_numpy(batch).to(next(torch_backbone.parameters()).device))
+        torch_ms = (time.perf_counter() - start) * 1000
+    ref = _l2_normalize(ref.cpu().numpy().astype(np.float32))
+
+    start = time.perf_counter()
+    out = onnx_backbone(batch)
+    onnx_ms = (time.perf_counter() - start) * 1000
+    out = _l2_normalize(out)
+    single = _l2_normalize(onnx_backbone(batch[:1]))
+
+    cosines = np.sum(ref * out, axis=1)
+    return {
+        "batch": len(batch),
+        "min_cosine": float(cosines.min()),
+        "max_abs_diff": float(np.abs(ref - out).max()),
+        "single_vs_batch_max_abs_diff": float(np.abs(single[0] - out[0]).max()),
+        "torch_ms_per_image": round(torch_ms / len(batch), 3),
+        "onnx_ms_per_image": round(onnx_ms / len(batch), 3),
+    }
+
+
+def load_verified_onnx(torch_backbone, path: str, device: str, num_threads: int,
+                       input_size, verify: bool = True, min_cosine: float = 0.9999):
+    """
+    Load OnnxBackbone cho Img2ImgService. Lỗi (thiếu onnxruntime / file, lệch so với checkpoint
+    PyTorch hiện tại) -> log và trả None để service tiếp tục chạy bằng PyTorch.
+    """
+    try:
+        onnx_backbone = OnnxBackbone(path, device=device, num_threads=num_threads)
+        if verify and torch_backbone is not None:
+            rng = np.random.default_rng(0)
+            sample = rng.uniform(-1, 1, size=(4, 3, *input_size)).astype(np.float32)
+            report = parity_check(torch_backbone, onnx_backbone, sample)
+            if report["min_cosine"] < min_cosine:
+                logger.error(f"ONNX model {path} does not match the PyTorch checkpoint "
+                             f"(min cosine {report['min_cosine']:.6f} < {min_cosine}); re-export it. Using PyTorch.")
+                return None
+            logger.info(f"ONNX parity OK: {report}")
+        logger.info(f"Img2Img backbone running on ONNX Runtime ({path}, providers={onnx_backbone.providers})")
+        return onnx_backbone
+    except Exception as e:
+        logger.error(f"Failed to load ONNX backbone: {e}. Using PyTorch.")
+        return None
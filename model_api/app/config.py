@@ -12,6 +12,8 @@ HOST = os.getenv("HOST", "0.0.0.0")
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 UPLOAD_ROOT_DIR = BASE_DIR.parent / "server" 
+# Thư mục ảnh do Node server lưu (manifest của /img2img/index-bulk chỉ được trỏ vào đây)
+UPLOAD_IMAGES_DIR = UPLOAD_ROOT_DIR / "uploads"
 
 # Model Paths
 YOLO_WEIGHT_PATH = os.getenv("YOLO_WEIGHT_PATH", str(BASE_DIR / "weights/best.pt"))
@@ -95,6 +97,152 @@ YOLO_CLASS_GROUPS = {
     ]
 }
 
+# --- IMG2IMG FAISS INDEX CONFIG ---
+# Loại index: 'flat' (brute-force, chính xác tuyệt đối), 'ivf_flat', 'ivf_pq', 'hnsw_flat'
+# Lưu mã nén trong RAM: 'sq8' (8-bit, 4x nhỏ hơn), 'fp16' (2x), 'pq' (IMG2IMG_PQ_M byte/vector)
+IMG2IMG_INDEX_TYPE = os.getenv("IMG2IMG_INDEX_TYPE", "flat").lower()
+# Số cluster của IVF (sẽ tự giảm nếu catalog chưa đủ lớn để train)
+IMG2IMG_IVF_NLIST = int(os.getenv("IMG2IMG_IVF_NLIST", 1024))
+# Số sub-quantizer của PQ (phải chia hết cho EMBEDDING_SIZE)
+IMG2IMG_PQ_M = int(os.getenv("IMG2IMG_PQ_M", 64))
+IMG2IMG_PQ_NBITS = 8
+IMG2IMG_HNSW_M = int(os.getenv("IMG2IMG_HNSW_M", 32))
+IMG2IMG_HNSW_EF_CONSTRUCTION = int(os.getenv("IMG2IMG_HNSW_EF_CONSTRUCTION", 80))
+# Giá trị mặc định khi request không truyền nprobe / ef_search
+IMG2IMG_DEFAULT_NPROBE = int(os.getenv("IMG2IMG_NPROBE", 16))
+IMG2IMG_DEFAULT_EF_SEARCH = int(os.getenv("IMG2IMG_EF_SEARCH", 64))
+# Tự động chuyển đổi file index cũ (VD: flat) sang IMG2IMG_INDEX_TYPE khi khởi động
+IMG2IMG_INDEX_AUTO_MIGRATE = os.getenv("IMG2IMG_INDEX_AUTO_MIGRATE", "False").lower() in ('true', '1')
+
+# --- FULL-PRECISION VECTORS + RE-RANK ---
+# Giữ bản float32 đầy đủ trên đĩa (memmap) để re-rank kết quả của index nén và rebuild chính xác
+IMG2IMG_FULL_VECTORS_ON_DISK = os.getenv("IMG2IMG_FULL_VECTORS_ON_DISK", "True").lower() in ('true', '1')
+# Index nén lấy fetch_k * RERANK_FACTOR ứng viên rồi re-rank bằng vector gốc (0 = tắt re-rank)
+IMG2IMG_RERANK_FACTOR = int(os.getenv("IMG2IMG_RERANK_FACTOR", 4))
+
+# --- SHARDING ---
+# > 1: chia index img2img thành N shard theo hash(product_id), mỗi shard có file riêng
+# (VD: img2img_fashion.shard00.faiss) và được search song song
+IMG2IMG_NUM_SHARDS = int(os.getenv("IMG2IMG_NUM_SHARDS", 1))
+# Số thread search song song (0 = bằng số shard)
+IMG2IMG_SHARD_SEARCH_THREADS = int(os.getenv("IMG2IMG_SHARD_SEARCH_THREADS", 0))
+
+# --- PRODUCT-COLLAPSED SEARCH ---
+# Lượt đầu lấy k * FETCH_FACTOR hàng xóm; query nào chưa đủ k sản phẩm khác nhau
+# sẽ được search lại với số hàng xóm nhân GROWTH, tối đa MAX_ROUNDS lượt
+IMG2IMG_COLLAPSE_FETCH_FACTOR = int(os.getenv("IMG2IMG_COLLAPSE_FETCH_FACTOR", 4))
+IMG2IMG_COLLAPSE_GROWTH = int(os.getenv("IMG2IMG_COLLAPSE_GROWTH", 4))
+IMG2IMG_COLLAPSE_MAX_ROUNDS = int(os.getenv("IMG2IMG_COLLAPSE_MAX_ROUNDS", 5))
+
+# --- IMG2IMG JOURNAL (WAL) ---
+# Mỗi add/remove được ghi vào journal append-only (fsync) thay vì ghi lại toàn bộ index
+IMG2IMG_JOURNAL_ENABLED = os.getenv("IMG2IMG_JOURNAL_ENABLED", "True").lower() in ('true', '1')
+
+# --- BULK INDEXING (/img2img/index-bulk) ---
+# Số ảnh mỗi lần chạy YOLO + backbone
+IMG2IMG_BULK_BATCH_SIZE = int(os.getenv("IMG2IMG_BULK_BATCH_SIZE", 16))
+# Số ảnh tối đa trong một request
+IMG2IMG_BULK_MAX_ITEMS = int(os.getenv("IMG2IMG_BULK_MAX_ITEMS", 5000))
+
+# --- TEXT2IMG PRODUCT-COLLAPSED SEARCH ---
+# Giống img2img: over-fetch thích ứng tới khi đủ `limit` sản phẩm khác nhau.
+# Mặc định 8 lượt (k * 4 * 4^7 hàng xóm) đủ quét hết catalog thực tế.
+TEXT2IMG_COLLAPSE_FETCH_FACTOR = int(os.getenv("TEXT2IMG_COLLAPSE_FETCH_FACTOR", 4))
+TEXT2IMG_COLLAPSE_GROWTH = int(os.getenv("TEXT2IMG_COLLAPSE_GROWTH", 4))
+TEXT2IMG_COLLAPSE_MAX_ROUNDS = int(os.getenv("TEXT2IMG_COLLAPSE_MAX_ROUNDS", 8))
+# Chỉ trả về kết quả có score (cosine) > ngưỡng này
+TEXT2IMG_SEARCH_SCORE_FLOOR = float(os.getenv("TEXT2IMG_SEARCH_SCORE_FLOOR", 0.0))
+# True: dùng range_search (1 lần quét lấy mọi hit trên ngưỡng) thay cho over-fetch nhiều lượt.
+# Hợp khi ngưỡng đủ cao để số hit trên ngưỡng nhỏ.
+TEXT2IMG_SEARCH_USE_RANGE = os.getenv("TEXT2IMG_SEARCH_USE_RANGE", "False").lower() in ('true', '1')
+
+# --- TEXT2IMG JOURNAL (WAL + GROUP COMMIT) ---
+TEXT2IMG_JOURNAL_ENABLED = os.getenv("TEXT2IMG_JOURNAL_ENABLED", "True").lower() in ('true', '1')
+# Cửa sổ group commit (ms): record được ghi ngay vào journal, một thread nền fsync chung
+# cho mọi record tới trong cửa sổ. 0 = fsync từng record.
+TEXT2IMG_GROUP_COMMIT_WINDOW_MS = float(os.getenv("TEXT2IMG_GROUP_COMMIT_WINDOW_MS", 5))
+# True: add/remove chỉ trả về sau khi record đã được fsync (bền vững)
+# False: trả về ngay sau khi ghi vào journal (có thể mất cửa sổ cuối nếu máy sập)
+TEXT2IMG_GROUP_COMMIT_WAIT = os.getenv("TEXT2IMG_GROUP_COMMIT_WAIT", "True").lower() in ('true', '1')
+# Thời gian tối đa (giây) chờ fsync của một record; quá hạn -> add/remove báo lỗi thay vì treo
+TEXT2IMG_GROUP_COMMIT_TIMEOUT_S = float(os.getenv("TEXT2IMG_GROUP_COMMIT_TIMEOUT_S", 10))
+
+# --- SNAPSHOT (ghi index xuống đĩa bằng thread nền, atomic rename + checksum) ---
+# Ghi snapshot ngay khi số thay đổi chưa lưu đạt ngưỡng...
+IMG2IMG_SNAPSHOT_DIRTY_THRESHOLD = int(os.getenv("IMG2IMG_SNAPSHOT_DIRTY_THRESHOLD", 500))
+# ...hoặc sau khoảng thời gian này (giây) kể từ thay đổi đầu tiên chưa lưu
+IMG2IMG_SNAPSHOT_INTERVAL_S = float(os.getenv("IMG2IMG_SNAPSHOT_INTERVAL_S", 300))
+TEXT2IMG_SNAPSHOT_DIRTY_THRESHOLD = int(os.getenv("TEXT2IMG_SNAPSHOT_DIRTY_THRESHOLD", 100))
+TEXT2IMG_SNAPSHOT_INTERVAL_S = float(os.getenv("TEXT2IMG_SNAPSHOT_INTERVAL_S", 30))
+
+# --- SEARCH RESULT CACHE (LRU + TTL, tự hết hạn khi index thay đổi) ---
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "True").lower() in ('true', '1')
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 2048))
+SEARCH_CACHE_TTL_S = float(os.getenv("SEARCH_CACHE_TTL_S", 300))
+# Bước lượng tử hóa vector query khi tạo key (vector đã chuẩn hóa L2)
+SEARCH_CACHE_QUANT_STEP = float(os.getenv("SEARCH_CACHE_QUANT_STEP", 1e-3))
+
+# --- MEMORY-MAPPED INDEX ---
+# Load index read-only bằng mmap: các uvicorn worker dùng chung một bản trong page cache,
+# thay đổi mới nằm ở delta segment trong RAM và được gộp vào khi ghi snapshot.
+# Lưu ý: trên Windows không thể rename đè file đang được mmap -> để False.
+IMG2IMG_INDEX_MMAP = os.getenv("IMG2IMG_INDEX_MMAP", "False").lower() in ('true', '1')
+TEXT2IMG_INDEX_MMAP = os.getenv("TEXT2IMG_INDEX_MMAP", "False").lower() in ('true', '1')
+
+# --- TOMBSTONE DELETE + COMPACTION (img2img) ---
+# Xóa chỉ đánh dấu ID (lọc khi search), không gọi remove_ids O(n) trên index.
+# Thread nền compact (xóa vật lý) khi tỉ lệ vector đã xóa vượt ngưỡng...
+IMG2IMG_COMPACT_DELETED_RATIO = float(os.getenv("IMG2IMG_COMPACT_DELETED_RATIO", 0.2))
+# ...và có ít nhất ngần này vector đã xóa (tránh compact liên tục khi index nhỏ)
+IMG2IMG_COMPACT_MIN_DELETED = int(os.getenv("IMG2IMG_COMPACT_MIN_DELETED", 1000))
+
+# --- MICRO-BATCHING (backbone img2img) ---
+# Gom các request embed đơn lẻ (search / index từng ảnh) chạy đồng thời thành MỘT lần forward:
+# chờ tối đa MAX_WAIT_MS kể từ request đầu tiên hoặc tới khi đủ MAX_SIZE ảnh.
+IMG2IMG_MICRO_BATCH_ENABLED = os.getenv("IMG2IMG_MICRO_BATCH_ENABLED", "True").lower() in ('true', '1')
+IMG2IMG_MICRO_BATCH_MAX_SIZE = int(os.getenv("IMG2IMG_MICRO_BATCH_MAX_SIZE", 16))
+IMG2IMG_MICRO_BATCH_MAX_WAIT_MS = float(os.getenv("IMG2IMG_MICRO_BATCH_MAX_WAIT_MS", 2))
+
+# --- EMBEDDING CACHE (theo SHA-256 nội dung ảnh) ---
+# Ảnh trùng byte (upload lại khi sửa sản phẩm, người mua search lại cùng ảnh) dùng lại
+# crop + vector đã tính thay vì chạy lại YOLO + backbone.
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "True").lower() in ('true', '1')
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 4096))
+# Thư mục cache trên đĩa (giữ qua các lần restart). Để trống = chỉ cache trong RAM.
+EMBEDDING_CACHE_DISK_DIR = os.getenv("EMBEDDING_CACHE_DISK_DIR", "")
+
+# --- HYBRID SEARCH (text + ảnh, gộp điểm bằng Reciprocal Rank Fusion) ---
+# score(sản phẩm) = Σ weight / (HYBRID_RRF_K + rank) trên các nhánh có sản phẩm đó
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", 60))
+# Mỗi nhánh lấy k * factor sản phẩm trước khi fuse (sản phẩm hạng thấp ở một nhánh vẫn được cộng điểm)
+HYBRID_CANDIDATE_FACTOR = int(os.getenv("HYBRID_CANDIDATE_FACTOR", 3))
+
+# --- INFERENCE POOLS (chạy YOLO / backbone / PhoBERT / FAISS ngoài event loop) ---
+# Mỗi công đoạn một thread pool riêng: detect (YOLO), embed (backbone, PhoBERT, PhoCLIP), index (FAISS).
+# Pool embed nên >= IMG2IMG_MICRO_BATCH_MAX_SIZE: các thread chủ yếu chờ micro-batcher, đủ thread mới gom được batch.
+INFERENCE_DETECT_WORKERS = int(os.getenv("INFERENCE_DETECT_WORKERS", 2))
+INFERENCE_EMBED_WORKERS = int(os.getenv("INFERENCE_EMBED_WORKERS", 16))
+INFERENCE_INDEX_WORKERS = int(os.getenv("INFERENCE_INDEX_WORKERS", 4))
+# Số job được xếp hàng thêm (ngoài số đang chạy) mỗi pool; vượt quá -> trả 503 thay vì để hàng đợi phình vô hạn
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", 64))
+
+# --- INFERENCE BACKEND (backbone img2img) ---
+# 'torch' (eager PyTorch) hoặc 'onnx' (ONNX Runtime, cần export trước: python -m app.export_onnx)
+IMG2IMG_INFERENCE_BACKEND = os.getenv("IMG2IMG_INFERENCE_BACKEND", "torch").lower()
+IMG2IMG_ONNX_PATH = os.getenv("IMG2IMG_ONNX_PATH", str(BASE_DIR / f"weights/{IMG2IMG_BACKBONE.lower()}_arcface.onnx"))
+# Số thread intra-op của ONNX Runtime (0 = mặc định của ORT, bằng số core vật lý)
+IMG2IMG_ONNX_THREADS = int(os.getenv("IMG2IMG_ONNX_THREADS", 0))
+# So embedding ONNX với PyTorch khi load; lệch quá ngưỡng (file .onnx cũ so với checkpoint) -> quay về torch
+IMG2IMG_ONNX_VERIFY_ON_LOAD = os.getenv("IMG2IMG_ONNX_VERIFY_ON_LOAD", "True").lower() in ('true', '1')
+IMG2IMG_ONNX_MIN_COSINE = float(os.getenv("IMG2IMG_ONNX_MIN_COSINE", 0.9999))
+
+# --- MODEL WORKER PROCESSES (tùy chọn, cho máy CPU nhiều core) ---
+# > 0: YOLO / backbone / PhoCLIP chạy trong N process con (mỗi process giữ một bộ model),
+# process FastAPI chỉ điều phối; ảnh và vector trao đổi qua shared memory. 0 = chạy trong process FastAPI.
+MODEL_WORKER_PROCESSES = int(os.getenv("MODEL_WORKER_PROCESSES", 0))
+# Số thread torch mỗi worker. 0 = chia đều số core cho các worker
+MODEL_WORKER_TORCH_THREADS = int(os.getenv("MODEL_WORKER_TORCH_THREADS", 0))
+
 ENABLE_PERFORMANCE_LOGGING = True
 # --- CONFIG CHO DEBUGGING ---
 SAVE_CROPPED_IMAGES = True
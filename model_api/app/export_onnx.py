@@ -0,0 +1,105 @@
+# model_api/app/export_onnx.py
+"""
+Export backbone ArcFace (ResNet_50 / ResNet_101 / ViT) đang cấu hình sang ONNX rồi kiểm tra
+embedding so với PyTorch.
+
+    python -m app.export_onnx
+    python -m app.export_onnx --backbone ViT --out weights/vit_arcface.onnx --sample-images ../server/uploads/products/p1
+
+- Checkpoint lấy theo config (RESNET_WEIGHT_PATH / VIT_WEIGHT_PATH), giống Img2ImgService.
+- Graph có trục batch động: dùng được cho cả micro-batch và bulk indexing.
+- Parity: cosine giữa embedding ONNX và PyTorch (đã L2 normalize) trên batch ngẫu nhiên
+  (và ảnh thật nếu có --sample-images). Dưới --min-cosine -> exit code 1.
+- Dùng graph mới: IMG2IMG_INFERENCE_BACKEND=onnx (IMG2IMG_ONNX_PATH trỏ tới file output).
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torchvision.transforms as transforms
+from PIL import Image
+
+from app.backbones import get_backbone, load_backbone_checkpoint, backbone_weight_path
+from app.backbones.onnx_backend import export_onnx, OnnxBackbone, parity_check
+from app.config import (
+    IMG2IMG_BACKBONE, IMG2IMG_ONNX_PATH, IMG2IMG_ONNX_MIN_COSINE, IMG2IMG_ONNX_THREADS,
+    INPUT_SIZE, EMBEDDING_SIZE, RGB_MEAN, RGB_STD
+)
+from app.services.preprocess import resize_with_padding
+from app.utils.logger import logger
+from app.utils.timer import Timer
+
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def load_sample_images(images_dir: str, limit: int) -> np.ndarray:
+    """Ảnh thật qua cùng pipeline với search (resize + padding, RGB, normalize) -> (N, 3, H, W)."""
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=RGB_MEAN, std=RGB_STD)])
+    tensors = []
+    for path in sorted(Path(images_dir).rglob("*")):
+        if path.suffix.lower() not in IMAGE_EXTS:
+            continue
+        img_np = cv2.imread(str(path), cv2.IMREAD_COLOR)
+        if img_np is None:
+            continue
+        img_padded = resize_with_padding(img_np, target_size=INPUT_SIZE)
+        tensors.append(transform(Image.fromarray(cv2.cvtColor(img_padded, cv2.COLOR_BGR2RGB))).numpy())
+        if len(tensors) >= limit:
+            break
+    return np.stack(tensors) if tensors else None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export the img2img ArcFace backbone to ONNX and check parity")
+    parser.add_argument("--backbone", default=IMG2IMG_BACKBONE, help="ResNet_50 / ResNet_101 / ViT")
+    parser.add_argument("--weights", default=None, help="Mặc định: checkpoint trong config của backbone")
+    parser.add_argument("--out", default=None, help=f"Mặc định: IMG2IMG_ONNX_PATH ({IMG2IMG_ONNX_PATH})")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--batch-size", type=int, default=16, help="Kích thước batch ngẫu nhiên khi kiểm tra parity")
+    parser.add_argument("--sample-images", default=None, help="Thư mục ảnh thật để kiểm tra parity thêm")
+    parser.add_argument("--min-cosine", type=float, default=IMG2IMG_ONNX_MIN_COSINE)
+    args = parser.parse_args(argv)
+
+    weight_path = args.weights or backbone_weight_path(args.backbone)
+    out_path = args.out or IMG2IMG_ONNX_PATH
+    if args.out is None and args.backbone != IMG2IMG_BACKBONE:
+        out_path = str(Path(IMG2IMG_ONNX_PATH).with_name(f"{args.backbone.lower()}_arcface.onnx"))
+    if not os.path.exists(weight_path):
+        logger.error(f"Checkpoint not found at {weight_path}")
+        return 1
+
+    backbone = get_backbone(args.backbone, input_size=INPUT_SIZE, embedding_size=EMBEDDING_SIZE)
+    load_backbone_checkpoint(backbone, weight_path, "cpu")
+    backbone.eval()
+
+    with Timer("ONNX_Export", metadata={"backbone": args.backbone, "opset": args.opset}):
+        export_onnx(backbone, out_path, INPUT_SIZE, opset=args.opset)
+    logger.info(f"Exported {args.backbone} ({weight_path}) -> {out_path}")
+
+    onnx_backbone = OnnxBackbone(out_path, device="cpu", num_threads=IMG2IMG_ONNX_THREADS)
+    rng = np.random.default_rng(0)
+    samples = {"random": rng.uniform(-1, 1, size=(args.batch_size, 3, *INPUT_SIZE)).astype(np.float32)}
+    if args.sample_images:
+        images = load_sample_images(args.sample_images, args.batch_size)
+        if images is None:
+            logger.warning(f"No readable images in {args.sample_images}")
+        else:
+            samples["images"] = images
+
+    ok = True
+    for name, batch in samples.items():
+        report = parity_check(backbone, onnx_backbone, batch)
+        passed = report["min_cosine"] >= args.min_cosine
+        ok = ok and passed
+        print(f"[{name}] {'OK' if passed else 'FAIL'} {report}")
+    if not ok:
+        logger.error(f"ONNX embeddings deviate from PyTorch (min cosine < {args.min_cosine})")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,8 @@
 # E:\LuanVanTotNghiep\fashion-search-app\model_api\app\main.py
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from app.config import HOST, PORT
@@ -11,10 +12,14 @@ from app.utils.logger import logger
 from app.services.img2img_service import Img2ImgService
 # Giả sử bạn đã tạo file factory như hướng dẫn trước
 from app.services import get_index_service_instance 
+from app.services.txt_index_service import text_index_service
+from app.services.inference_pools import PoolSaturatedError, shutdown_inference_pools
+from app.services.model_workers import use_model_workers, model_worker_pool, RemoteImg2ImgService
 
 # Import các routes
 from app.routes import img2img_route 
 from app.routes import txt2img_route
+from app.routes import hybrid_route
 from app.routes import health
 
 # --- 2. Định nghĩa Lifespan Manager ---
@@ -26,7 +31,12 @@ async def lifespan(app: FastAPI):
     logger.info("Initializing services and loading models...")
     
     # Khởi tạo Img2ImgService (sẽ tự load YOLO và backbone được cấu hình)
-    img2img_service = Img2ImgService()
+    if use_model_workers():
+        # Model nằm trong các process worker; process này chỉ điều phối
+        model_worker_pool.start()
+        img2img_service = RemoteImg2ImgService(model_worker_pool)
+    else:
+        img2img_service = Img2ImgService()
     
     # Dùng factory để khởi tạo IndexService (sẽ tự load đúng file index)
     index_service = get_index_service_instance()
@@ -41,7 +51,13 @@ async def lifespan(app: FastAPI):
     
     # --- Logic thực thi khi shutdown ---
     logger.info("--- Application Shutdown ---")
-    # (Ví dụ: dọn dẹp, đóng kết nối,...)
+    # Chờ các job inference đang chạy xong trước khi đóng index / model
+    shutdown_inference_pools()
+    # Dừng các thread snapshot nền và ghi snapshot cuối cùng
+    index_service.close()
+    img2img_service.close()
+    if text_index_service:
+        text_index_service.close()
 
 
 # --- 3. Khởi tạo FastAPI app với lifespan manager ---
@@ -58,8 +74,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Pool inference đầy -> 503 + Retry-After để client / load balancer thử lại thay vì xếp hàng vô hạn
+@app.exception_handler(PoolSaturatedError)
+async def pool_saturated_handler(request: Request, exc: PoolSaturatedError):
+    logger.warning(f"Rejected {request.url.path}: {exc}")
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
 app.include_router(txt2img_route.router, prefix="/txt2img", tags=["Text-to-Image Search"])
 app.include_router(img2img_route.router)
+app.include_router(hybrid_route.router)
 app.include_router(health.router)
 
 @app.get("/")
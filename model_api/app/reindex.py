@@ -0,0 +1,341 @@
+# model_api/app/reindex.py
+"""
+Reindex offline toàn bộ catalog (không cần server / upload HTTP).
+
+    python -m app.reindex img2img --images-dir ../server/uploads/products --group upper_body
+    python -m app.reindex txt2img --manifest catalog.jsonl --workers 8 --batch-size 128
+    python -m app.reindex img2img --manifest catalog.jsonl --resume
+
+- Nguồn ảnh: --images-dir (cấu trúc <dir>/<product_id>/<ảnh>) hoặc --manifest (JSON list hoặc
+  JSON lines, mỗi phần tử {"path", "product_id", "image_id"?, "group"?, "shop_id"?, "image_path"?}).
+- Đọc + decode (+ transform cho txt2img) chạy trong process pool; crop YOLO + embed chạy theo
+  batch lớn ở process chính bằng Img2ImgService / Text2ImgService.
+- Ghi ra index + mapping MỚI (mặc định <index>.reindex.faiss, không đụng vào index đang chạy).
+  Dừng server rồi đổi tên file để dùng index mới.
+- Checkpoint (<out-index>.checkpoint.json) sau mỗi --checkpoint-every ảnh: snapshot index được
+  ghi trước, rồi mới ghi vị trí đã xử lý. --resume chạy tiếp từ checkpoint.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.utils.io_utils import atomic_write_bytes
+from app.utils.logger import logger
+
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+# Transform của PhoCLIP trong process con (tạo một lần mỗi process)
+_clip_transform = None
+
+
+# --- Nguồn ảnh ---
+def scan_images_dir(images_dir: str, group: str, shop_id: str = None) -> list:
+    """<dir>/<product_id>/<ảnh> -> danh sách item (sắp xếp để thứ tự ổn định khi resume)."""
+    items = []
+    for product_dir in sorted(Path(images_dir).iterdir()):
+        if not product_dir.is_dir():
+            continue
+        for image_file in sorted(product_dir.iterdir()):
+            if image_file.suffix.lower() in IMAGE_EXTS:
+                items.append({
+                    "path": str(image_file), "product_id": product_dir.name,
+                    "image_id": image_file.name, "group": group, "shop_id": shop_id,
+                })
+    return items
+
+
+def load_manifest(manifest_path: str, group: str, shop_id: str = None) -> list:
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        text = f.read()
+    stripped = text.lstrip()
+    entries = json.loads(text) if stripped.startswith("[") else [
+        json.loads(line) for line in text.splitlines() if line.strip()
+    ]
+    items = []
+    for i, entry in enumerate(entries):
+        if not entry.get("path") or not entry.get("product_id"):
+            raise ValueError(f"Manifest entry {i}: 'path' and 'product_id' are required")
+        items.append({
+            "path": entry["path"], "product_id": str(entry["product_id"]),
+            "image_id": str(entry.get("image_id") or os.path.basename(entry["path"])),
+            "group": entry.get("group", group), "shop_id": entry.get("shop_id", shop_id),
+            "image_path": entry.get("image_path"),
+        })
+    return items
+
+
+# --- Worker (process con): chỉ đọc file + decode, không load model ---
+def _load_for_img2img(item: dict):
+    try:
+        img_np = cv2.imdecode(np.fromfile(item["path"], dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img_np is None:
+            return item, None, "Cannot decode image"
+        return item, img_np, None
+    except Exception as e:
+        return item, None, str(e)
+
+
+def _load_for_txt2img(item: dict):
+    global _clip_transform
+    try:
+        if _clip_transform is None:
+            from app.services.preprocess import build_clip_image_transform
+            _clip_transform = build_clip_image_transform()
+        image_pil = Image.open(item["path"]).convert("RGB")
+        return item, _clip_transform(image_pil).numpy(), None
+    except Exception as e:
+        return item, None, str(e)
+
+
+# --- Embed + ghi index (process chính) ---
+class Img2ImgTarget:
+    loader = staticmethod(_load_for_img2img)
+
+    def __init__(self, out_index: str, out_map: str):
+        from app.config import IMG2IMG_INDEX_TYPE
+        from app.services import get_index_service_instance
+        from app.services.img2img_service import Img2ImgService
+
+        self.target_index_type = IMG2IMG_INDEX_TYPE
+        self.model = Img2ImgService()
+        self.index = get_index_service_instance(out_index, out_map)
+
+    def is_indexed(self, item: dict) -> bool:
+        shard = self.index.shard_for(item["product_id"]) if hasattr(self.index, "shard_for") else self.index
+        return bool(shard.id_map.ids_for_images(item["product_id"], [item["image_id"]]))
+
+    def index_batch(self, loaded: list) -> list:
+        """loaded: list (item, ảnh BGR). Trả về list lỗi (None = thành công) cùng thứ tự."""
+        outputs = self.model.process_images_for_indexing(
+            [{**item, "image": img_np} for item, img_np in loaded]
+        )
+        rows = [i for i, out in enumerate(outputs) if "vector" in out]
+        if rows:
+            self.index.add_items(
+                [outputs[i]["vector"] for i in rows],
+                [loaded[i][0]["product_id"] for i in rows],
+                [loaded[i][0]["image_id"] for i in rows],
+                groups=[loaded[i][0]["group"] for i in rows],
+                shop_ids=[loaded[i][0]["shop_id"] for i in rows]
+            )
+        return [out.get("error") if "vector" not in out else None for out in outputs]
+
+    def save(self):
+        return self.index.save()
+
+    def finish(self):
+        if self.index.index_type != self.target_index_type and self.index.ntotal:
+            logger.info(f"[Reindex] Building {self.target_index_type} index from {self.index.ntotal} vectors")
+            self.index.migrate_index(self.target_index_type)
+        self.index.close()
+
+
+class Txt2ImgTarget:
+    loader = staticmethod(_load_for_txt2img)
+
+    def __init__(self, out_index: str, out_map: str):
+        from app.config import TEXT2IMG_EMBEDDING_DIM
+        from app.services.txt2img_service import txt2img_service
+        from app.services.txt_index_service import TextIndexService
+
+        if txt2img_service is None or txt2img_service.model is None:
+            raise RuntimeError("Text2ImgService is not available (PhoCLIP model failed to load)")
+        self.model = txt2img_service
+        self.index = TextIndexService(out_index, out_map, dim=TEXT2IMG_EMBEDDING_DIM)
+
+    def is_indexed(self, item: dict) -> bool:
+        # Text index upsert theo image_path -> thêm lại cũng không bị trùng
+        return False
+
+    def index_batch(self, loaded: list) -> list:
+        vectors = self.model.embed_image_tensors(np.stack([tensor for _, tensor in loaded]))
+        if vectors is None:
+            return ["Text2Img embedding failed"] * len(loaded)
+        added = self.index.add_products(
+            vectors,
+            [item["product_id"] for item, _ in loaded],
+            [item.get("image_path") or item["path"] for item, _ in loaded]
+        )
+        if added != len(loaded):
+            return ["Text2Img index write failed"] * len(loaded)
+        return [None] * len(loaded)
+
+    def save(self):
+        return self.index.save()
+
+    def finish(self):
+        self.index.close()
+
+
+TARGETS = {"img2img": Img2ImgTarget, "txt2img": Txt2ImgTarget}
+
+
+def default_output_paths(mode: str):
+    """Index mới nằm cạnh index đang chạy: <tên>.reindex.faiss + mapping tương ứng."""
+    if mode == "img2img":
+        from app.services import get_index_paths
+        index_path, map_path = get_index_paths()
+    else:
+        from app.config import TEXT2IMG_INDEX_PATH
+        index_path = TEXT2IMG_INDEX_PATH
+        map_path = TEXT2IMG_INDEX_PATH.replace(".faiss", "_map.json")
+    index_root, index_ext = os.path.splitext(index_path)
+    map_root, map_ext = os.path.splitext(map_path)
+    return f"{index_root}.reindex{index_ext}", f"{map_root}.reindex{map_ext}"
+
+
+# --- Checkpoint ---
+def _read_checkpoint(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_checkpoint(path: str, state: dict):
+    atomic_write_bytes(path, json.dumps(state, ensure_ascii=False, indent=2).encode("utf-8"), keep_previous=False)
+
+
+# --- Main loop ---
+def _windows(items: list, start: int, size: int):
+    for window_start in range(start, len(items), size):
+        yield window_start, items[window_start:window_start + size]
+
+
+def run(args) -> int:
+    group = args.group
+    if args.manifest:
+        items = load_manifest(args.manifest, group, args.shop_id)
+        source = os.path.abspath(args.manifest)
+    else:
+        items = scan_images_dir(args.images_dir, group, args.shop_id)
+        source = os.path.abspath(args.images_dir)
+
+    out_index, out_map = args.out_index, args.out_map
+    if out_index is None:
+        out_index, out_map = default_output_paths(args.mode)
+    elif out_map is None:
+        out_map = os.path.splitext(out_index)[0] + "_map.json"
+    checkpoint_path = out_index + ".checkpoint.json"
+
+    checkpoint = _read_checkpoint(checkpoint_path)
+    if checkpoint and not args.resume:
+        logger.error(f"[Reindex] Checkpoint {checkpoint_path} exists. Use --resume, or delete the output files to start over.")
+        return 2
+    if not checkpoint and os.path.exists(out_index) and not args.resume:
+        logger.error(f"[Reindex] Output index {out_index} already exists. Choose another --out-index or delete it.")
+        return 2
+    if checkpoint and (checkpoint.get("source") != source or checkpoint.get("mode") != args.mode):
+        logger.error(f"[Reindex] Checkpoint was created for {checkpoint.get('mode')} {checkpoint.get('source')}, not {args.mode} {source}")
+        return 2
+
+    state = checkpoint or {"mode": args.mode, "source": source, "total": len(items),
+                           "next_position": 0, "indexed": 0, "failed": 0, "skipped": 0, "elapsed_s": 0.0}
+    state["total"] = len(items)
+    start_position = state["next_position"]
+    logger.info(f"[Reindex] {args.mode}: {len(items)} images from {source} -> {out_index} "
+                f"(start at {start_position}, workers={args.workers}, batch={args.batch_size})")
+
+    target = TARGETS[args.mode](out_index, out_map)
+    run_start = time.perf_counter()
+    elapsed_before = state["elapsed_s"]
+    indexed_at_start = state["indexed"]
+    last_report = last_checkpoint_pos = start_position
+    last_report_time = run_start
+
+    def checkpoint_now(position):
+        # Snapshot index TRƯỚC, checkpoint sau: checkpoint không bao giờ vượt quá dữ liệu đã lưu
+        if not target.save():
+            raise RuntimeError("Failed to save index snapshot")
+        state["next_position"] = position
+        state["elapsed_s"] = round(elapsed_before + time.perf_counter() - run_start, 3)
+        _write_checkpoint(checkpoint_path, state)
+
+    window_size = args.batch_size * max(args.prefetch, 1)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        windows = _windows(items, start_position, window_size)
+        current = next(windows, None)
+        pending = pool.map(target.loader, current[1], chunksize=max(1, args.batch_size // args.workers)) if current else None
+        while current is not None:
+            window_start, window_items = current
+            # Gửi window kế tiếp cho process pool trong lúc process chính embed window hiện tại
+            upcoming = next(windows, None)
+            loaded_results = list(pending)
+            if upcoming is not None:
+                pending = pool.map(target.loader, upcoming[1], chunksize=max(1, args.batch_size // args.workers))
+
+            ready = []
+            for item, data, error in loaded_results:
+                if error is not None:
+                    state["failed"] += 1
+                    logger.warning(f"[Reindex] {item['path']}: {error}")
+                elif target.is_indexed(item):
+                    state["skipped"] += 1
+                else:
+                    ready.append((item, data))
+
+            for batch_start in range(0, len(ready), args.batch_size):
+                batch = ready[batch_start:batch_start + args.batch_size]
+                errors = target.index_batch(batch)
+                for (item, _), error in zip(batch, errors):
+                    if error is None:
+                        state["indexed"] += 1
+                    else:
+                        state["failed"] += 1
+                        logger.warning(f"[Reindex] {item['path']}: {error}")
+
+            position = window_start + len(window_items)
+            now = time.perf_counter()
+            if now - last_report_time >= args.report_every or upcoming is None:
+                recent_rate = (position - last_report) / max(now - last_report_time, 1e-9)
+                overall_rate = (state["indexed"] - indexed_at_start) / max(now - run_start, 1e-9)
+                eta = (len(items) - position) / recent_rate if recent_rate > 0 else 0
+                print(f"[Reindex] {position}/{len(items)} | indexed={state['indexed']} failed={state['failed']} "
+                      f"skipped={state['skipped']} | {recent_rate:.1f} images/s (avg {overall_rate:.1f}) | ETA {eta:.0f}s",
+                      flush=True)
+                last_report, last_report_time = position, now
+            if position - last_checkpoint_pos >= args.checkpoint_every:
+                checkpoint_now(position)
+                last_checkpoint_pos = position
+            current = upcoming
+
+    checkpoint_now(len(items))
+    target.finish()
+    total_time = time.perf_counter() - run_start
+    print(f"[Reindex] Done: indexed={state['indexed']} failed={state['failed']} skipped={state['skipped']} "
+          f"in {total_time:.1f}s ({(state['indexed'] - indexed_at_start) / max(total_time, 1e-9):.1f} images/s)")
+    print(f"[Reindex] New index: {out_index}\n[Reindex] New mapping: {out_map}\n"
+          f"[Reindex] Stop the server and replace the live index files with these to use them.")
+    os.remove(checkpoint_path)
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline reindex of the img2img / txt2img catalog")
+    parser.add_argument("mode", choices=sorted(TARGETS))
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images-dir", help="Thư mục <dir>/<product_id>/<ảnh>")
+    source.add_argument("--manifest", help="JSON list / JSON lines: {path, product_id, image_id?, group?, shop_id?}")
+    parser.add_argument("--group", default="none", help="Nhóm crop mặc định cho img2img (upper_body/lower_body/full_body/none)")
+    parser.add_argument("--shop-id", default=None)
+    parser.add_argument("--out-index", default=None, help="Mặc định: <index hiện tại>.reindex.faiss")
+    parser.add_argument("--out-map", default=None)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--batch-size", type=int, default=64, help="Số ảnh mỗi lần chạy YOLO / backbone")
+    parser.add_argument("--prefetch", type=int, default=4, help="Số batch được decode trước")
+    parser.add_argument("--checkpoint-every", type=int, default=2000, help="Số ảnh giữa 2 checkpoint")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Giây giữa 2 dòng báo tiến độ")
+    parser.add_argument("--resume", action="store_true", help="Chạy tiếp từ checkpoint")
+    return run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,9 @@
 # E:\LuanVanTotghiep\fashion-search-app\model_api\app\routes\health.py
 
 from fastapi import APIRouter, Request, HTTPException
+from app.services.txt_index_service import text_index_service
+from app.services.embedding_cache import embedding_cache
+from app.services.inference_pools import inference_pools
 
 # --- Đã xóa import từ app.dependencies, điều này đúng ---
 
@@ -20,7 +23,8 @@ def health_check(request: Request): # <-- Bước 1: Thêm 'request: Request' v
         # --- Bước 3: Thực hiện kiểm tra trên các service đã lấy được ---
         yolo_loaded = img2img_service.yolo_model is not None
         backbone_loaded = img2img_service.backbone is not None
-        index_loaded = index_service.index is not None
+        # is_loaded: IndexService có .index; ShardedIndexService yêu cầu mọi shard đều đã có index
+        index_loaded = index_service is not None and index_service.is_loaded
 
         services_status = {
             "img2img_service": {
@@ -29,7 +33,9 @@ def health_check(request: Request): # <-- Bước 1: Thêm 'request: Request' v
             },
             "index_service": {
                 "faiss_index": "loaded" if index_loaded else "NOT_LOADED",
-                "indexed_items": index_service.index.ntotal if index_loaded else 0
+                "index_type": index_service.index_type,
+                "num_shards": getattr(index_service, "num_shards", 1),
+                "indexed_items": index_service.ntotal if index_loaded else 0
             }
         }
 
@@ -65,6 +71,44 @@ def health_check(request: Request): # <-- Bước 1: Thêm 'request: Request' v
         )
 
 
+@router.get("/search-cache", summary="Thống kê cache kết quả search (hit/miss)")
+def search_cache_stats(request: Request):
+    caches = {}
+    index_service = getattr(request.app.state, "index_service", None)
+    for name, service in (("img2img", index_service), ("txt2img", text_index_service)):
+        cache = getattr(service, "result_cache", None)
+        caches[name] = {**cache.stats(), "generation": service.generation} if cache else {"enabled": False}
+    return {"status": "ok", "caches": caches}
+
+
+@router.get("/micro-batching", summary="Histogram kích thước batch và thời gian chờ của backbone img2img")
+def micro_batching_stats(request: Request):
+    img2img_service = getattr(request.app.state, "img2img_service", None)
+    batcher = getattr(img2img_service, "batcher", None)
+    if batcher is None:
+        return {"status": "ok", "img2img": {"enabled": False}}
+    return {"status": "ok", "img2img": batcher.stats()}
+
+
+@router.get("/inference-pools", summary="Hàng đợi / số job đang chạy của từng pool inference (detect, embed, index)")
+def inference_pool_stats(request: Request):
+    pools = {name: pool.stats() for name, pool in inference_pools.items()}
+    # Hàng đợi micro-batcher nằm phía sau pool embed (thread embed chờ batch ở đây)
+    batcher = getattr(getattr(request.app.state, "img2img_service", None), "batcher", None)
+    return {
+        "status": "ok",
+        "pools": pools,
+        "micro_batcher_queue_depth": batcher.queue_depth if batcher is not None else None,
+    }
+
+
+@router.get("/embedding-cache", summary="Thống kê embedding cache theo nội dung ảnh (hit/miss)")
+def embedding_cache_stats():
+    if embedding_cache is None:
+        return {"status": "ok", "cache": {"enabled": False}}
+    return {"status": "ok", "cache": embedding_cache.stats()}
+
+
 # from fastapi import APIRouter
 # # from app.dependencies import img2img_service #, txt2img_service
 
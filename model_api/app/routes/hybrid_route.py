@@ -0,0 +1,80 @@
+# model_api/app/routes/hybrid_route.py
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request
+from typing import Optional
+
+from app.schemas.img2img_request import TargetGroupEnum
+from app.schemas.hybrid_response import HybridSearchResponse
+from app.services.hybrid_search import hybrid_search
+from app.services.inference_pools import PoolSaturatedError
+from app.services.txt2img_service import txt2img_service
+from app.services.txt_index_service import text_index_service
+from app.utils.logger import logger
+
+router = APIRouter(prefix="/hybrid", tags=["Hybrid Search"])
+
+@router.post("/search", response_model=HybridSearchResponse, summary="Tìm kiếm kết hợp text + ảnh (RRF)")
+async def search_hybrid(
+    request: Request,
+    query: Optional[str] = Form(None, description="Câu mô tả sản phẩm (tìm trong text index)"),
+    file: Optional[UploadFile] = File(None, description="Ảnh đã crop (tìm trong img2img index)"),
+    k: int = Form(10),
+    group: Optional[TargetGroupEnum] = Form(None, description="Chỉ áp dụng cho nhánh ảnh"),
+    shop_id: Optional[str] = Form(None, description="Chỉ áp dụng cho nhánh ảnh"),
+    text_weight: float = Form(1.0, description="Trọng số RRF của nhánh text"),
+    image_weight: float = Form(1.0, description="Trọng số RRF của nhánh ảnh")
+):
+    """
+    Một request thay cho /txt2img/search + /img2img/search:
+    embed text và ảnh song song, search 2 index song song, gộp theo sản phẩm bằng Reciprocal Rank Fusion.
+    """
+    query = (query or "").strip() or None
+    content = await file.read() if file is not None else None
+    if not query and not content:
+        raise HTTPException(status_code=400, detail="Cần ít nhất một trong hai: query hoặc file ảnh.")
+
+    errors = {}
+    if query and (not txt2img_service or not txt2img_service.model or not text_index_service):
+        # Chỉ có text mà service text lỗi -> 503; có cả ảnh -> vẫn trả kết quả nhánh ảnh
+        if not content:
+            raise HTTPException(status_code=503, detail="Text-to-Image AI service is currently unavailable or failed to load.")
+        errors["text"] = "Text-to-Image service unavailable"
+        query = None
+
+    img2img_service = getattr(request.app.state, "img2img_service", None)
+    index_service = getattr(request.app.state, "index_service", None)
+    if content and (img2img_service is None or img2img_service.backbone is None
+                    or index_service is None or not index_service.is_loaded):
+        # Chỉ có ảnh (hoặc nhánh text đã bị loại) mà service ảnh lỗi -> 503; còn text -> trả kết quả nhánh text
+        if not query:
+            raise HTTPException(status_code=503, detail="Image-to-Image AI service is currently unavailable or failed to load.")
+        errors["image"] = "Image-to-Image service unavailable"
+        content = None
+
+    try:
+        outcome = await hybrid_search(
+            k, query=query, image_bytes=content,
+            txt2img_service=txt2img_service, text_index_service=text_index_service,
+            img2img_service=img2img_service, index_service=index_service,
+            group=group.value if group else None, shop_id=shop_id,
+            text_weight=text_weight, image_weight=image_weight
+        )
+    except PoolSaturatedError:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"[HybridSearch] Unhandled error: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="An internal server error occurred during hybrid search.")
+
+    errors.update(outcome["errors"])
+    if not outcome["branch_totals"]:
+        raise HTTPException(status_code=500, detail=f"All search branches failed: {errors}")
+
+    return HybridSearchResponse(
+        status="success",
+        total_results=len(outcome["results"]),
+        results=outcome["results"],
+        message="Tìm kiếm thành công" if not errors else "Tìm kiếm thành công một phần",
+        branch_totals=outcome["branch_totals"],
+        errors=errors
+    )
@@ -1,17 +1,33 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request
-from typing import List
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
 import json
 
 # Import Schemas
 from app.schemas.img2img_request import TargetGroupEnum
-from app.schemas.img2img_response import SearchResponse, SearchResultItem, DetectResponse
+from app.schemas.img2img_response import SearchResponse, SearchResultItem, DetectResponse, BatchSearchResponse
 
 # Import Services & Utils
 # from app.dependencies import img2img_service, img2img_index
+from app.config import IMG2IMG_BULK_BATCH_SIZE, IMG2IMG_BULK_MAX_ITEMS
+from app.services.bulk_indexer import bulk_index_events
+from app.services.inference_pools import embed_pool, detect_pool, index_pool, PoolSaturatedError
 from app.utils.logger import logger
 
 router = APIRouter(prefix="/img2img", tags=["Image Search"])
 
+
+def _add_and_commit(img2img_index, vector, product_id, image_id, group, shop_id):
+    img2img_index.add_item(vector, product_id, image_id, group=group, shop_id=shop_id)
+    img2img_index.commit() # Đã ghi journal (fsync) -> an toàn dữ liệu, snapshot chạy nền
+
+
+def _remove_and_commit(img2img_index, remove_fn, *args) -> int:
+    count = remove_fn(*args)
+    if count > 0:
+        img2img_index.commit()
+    return count
+
 # ==============================================================================
 # 1. API CHO NGƯỜI BÁN (SHOP) - TẠO SẢN PHẨM & QUẢN LÝ
 # ==============================================================================
@@ -22,7 +38,8 @@ async def index_product(
     file: UploadFile = File(...),
     product_id: str = Form(..., description="ID sản phẩm (DB)"),
     image_id: str = Form(..., description="Tên file ảnh unique (VD: img_01.jpg)"),
-    group: TargetGroupEnum = Form(..., description="Nhóm để crop (upper/lower/full)")
+    group: TargetGroupEnum = Form(..., description="Nhóm để crop (upper/lower/full)"),
+    shop_id: Optional[str] = Form(None, description="ID shop (tùy chọn, dùng để lọc khi search)")
 ):
     """
     Dùng cho Shop: Tự động tìm đối tượng trong ảnh theo Group, Crop, Resize và Lưu Vector.
@@ -34,23 +51,82 @@ async def index_product(
         content = await file.read()
         
         # 1. Gọi Service xử lý (Auto Crop High->Low->Center)
-        vector, method_used = img2img_service.process_image_for_indexing(content, group.value, product_id=product_id, image_id=image_id)
+        # Chạy ngoài event loop: các request đồng thời được micro-batch khi vào backbone
+        vector, method_used = await embed_pool.run(
+            img2img_service.process_image_for_indexing, content, group.value, product_id=product_id, image_id=image_id
+        )
         
-        # 2. Lưu vào Index
-        img2img_index.add_item(vector, product_id, image_id) 
-        img2img_index.save() # Lưu ngay để an toàn dữ liệu
+        # 2. Lưu vào Index (journal fsync cũng chạy trong pool index)
+        await index_pool.run(_add_and_commit, img2img_index, vector, product_id, image_id, group.value, shop_id)
 
         return {
             "status": "success", 
             "message": f"Added {image_id} for {product_id}",
             "crop_method": method_used
         }
+    except PoolSaturatedError:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Index error: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
+@router.post("/index-bulk", summary="Thêm nhiều ảnh sản phẩm (batch Crop & Index, stream tiến độ NDJSON)")
+async def index_products_bulk(
+    request: Request,
+    items: str = Form(..., description='JSON list: [{"product_id", "image_id", "group", "shop_id"?, "path"?}]'),
+    files: Optional[List[UploadFile]] = File(None, description="Ảnh upload; file thứ i ứng với items[i]"),
+    shop_id: Optional[str] = Form(None, description="shop_id mặc định cho các item không ghi shop_id"),
+    batch_size: int = Form(IMG2IMG_BULK_BATCH_SIZE, description="Số ảnh mỗi lần chạy YOLO + backbone")
+):
+    """
+    Onboard cả catalog trong một request. Ảnh lấy từ `files` (multipart) hoặc, nếu không gửi file,
+    từ `path` của từng item (file nằm trong server/uploads).
+    Ảnh được xử lý theo batch (YOLO + backbone một lần mỗi batch), index chỉ commit một lần ở cuối.
+    Response là NDJSON: một dòng "start", một dòng "item" cho mỗi ảnh, một dòng "done".
+    """
+    img2img_service = request.app.state.img2img_service
+    img2img_index = request.app.state.index_service
+
+    try:
+        parsed = json.loads(items)
+        if not isinstance(parsed, list) or not parsed:
+            raise ValueError("items must be a non-empty JSON list")
+        if len(parsed) > IMG2IMG_BULK_MAX_ITEMS:
+            raise ValueError(f"Too many items ({len(parsed)} > {IMG2IMG_BULK_MAX_ITEMS})")
+        if files and len(files) != len(parsed):
+            raise ValueError(f"Got {len(files)} files for {len(parsed)} items")
+        if batch_size < 1:
+            raise ValueError("batch_size must be >= 1")
+
+        bulk_items = []
+        for i, entry in enumerate(parsed):
+            if not entry.get("product_id") or not entry.get("image_id"):
+                raise ValueError(f"items[{i}]: product_id and image_id are required")
+            if not files and not entry.get("path"):
+                raise ValueError(f"items[{i}]: path is required when no files are uploaded")
+            bulk_items.append({
+                "product_id": str(entry["product_id"]),
+                "image_id": str(entry["image_id"]),
+                "group": TargetGroupEnum(entry.get("group", TargetGroupEnum.none.value)).value,
+                "shop_id": entry.get("shop_id", shop_id),
+                "path": entry.get("path"),
+            })
+    except (ValueError, AttributeError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid items: {e}")
+
+    # File upload phải được đọc trước khi bắt đầu stream (request đóng file khi handler trả về)
+    for item, file in zip(bulk_items, files or []):
+        item["content"] = await file.read()
+
+    # Async generator: mỗi batch chạy trong embed_pool / index_pool, pool đầy -> dòng "error" cuối stream
+    events = bulk_index_events(img2img_service, img2img_index, bulk_items, batch_size)
+    return StreamingResponse(
+        (json.dumps(event, ensure_ascii=False) + "\n" async for event in events),
+        media_type="application/x-ndjson"
+    )
+
 @router.post("/delete-batch", summary="Xóa nhiều ảnh cùng lúc")
 async def delete_batch_images(
     request: Request, 
@@ -61,11 +137,11 @@ async def delete_batch_images(
         img2img_index = request.app.state.index_service
 
         ids_list = json.loads(image_ids)
-        count = img2img_index.remove_list_images(product_id, ids_list)
-        if count > 0:
-            img2img_index.save()
+        count = await index_pool.run(_remove_and_commit, img2img_index, img2img_index.remove_list_images, product_id, ids_list)
         
         return {"status": "success", "message": f"Deleted {count} images"}
+    except PoolSaturatedError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -74,14 +150,55 @@ async def delete_product(request: Request,product_id: str = Form(...)):
     try:
         img2img_index = request.app.state.index_service
 
-        count = img2img_index.remove_product(product_id)
+        count = await index_pool.run(_remove_and_commit, img2img_index, img2img_index.remove_product, product_id)
         if count > 0:
-            img2img_index.save()
             return {"status": "success", "message": f"Deleted {count} vectors for {product_id}"}
         else:
 
             return {"status": "success", "message": "Product not found or already deleted"}
+    except PoolSaturatedError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/rebuild-index", summary="Train & build lại index (flat/ivf_flat/ivf_pq/hnsw_flat/sq8/fp16/pq)")
+async def rebuild_index(
+    request: Request,
+    index_type: Optional[str] = Form(None, description="Bỏ trống để dùng IMG2IMG_INDEX_TYPE trong config")
+):
+    """
+    Build lại index từ các vector đang lưu (kể cả file .faiss flat cũ) theo loại mới và lưu xuống đĩa.
+    """
+    try:
+        img2img_index = request.app.state.index_service
+
+        info = await index_pool.run(img2img_index.migrate_index, index_type)
+        return {"status": "success", **info}
+    except PoolSaturatedError:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Rebuild index error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/index-report", summary="Báo cáo bộ nhớ & recall của index")
+async def index_report(request: Request, sample_size: int = 200, k: int = 10,
+                       nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """
+    Kích thước index trong RAM so với float32, và recall@k (có / không re-rank)
+    so với brute-force trên vector gốc lưu trên đĩa.
+    """
+    try:
+        img2img_index = request.app.state.index_service
+        report = await index_pool.run(
+            img2img_index.storage_report, sample_size=sample_size, k=k, nprobe=nprobe, ef_search=ef_search
+        )
+        return {"status": "success", **report}
+    except PoolSaturatedError:
+        raise
     except Exception as e:
+        logger.error(f"Index report error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -99,8 +216,10 @@ async def detect_objects(request: Request, file: UploadFile = File(...)):
         img2img_service = request.app.state.img2img_service
 
         content = await file.read()
-        candidates = img2img_service.detect_search_candidates(content)
+        candidates = await detect_pool.run(img2img_service.detect_search_candidates, content)
         return DetectResponse(status="success", candidates=candidates)
+    except PoolSaturatedError:
+        raise
     except Exception as e:
         logger.error(f"Detect error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -109,10 +228,15 @@ async def detect_objects(request: Request, file: UploadFile = File(...)):
 async def search_product(
     request: Request,
     file: UploadFile = File(..., description="Ảnh đã được FE crop theo box người dùng chọn"),
-    k: int = Form(10)
+    k: int = Form(10),
+    nprobe: Optional[int] = Form(None, description="Số cluster quét (chỉ dùng cho index IVF)"),
+    ef_search: Optional[int] = Form(None, description="Độ rộng tìm kiếm (chỉ dùng cho index HNSW)"),
+    group: Optional[TargetGroupEnum] = Form(None, description="Chỉ tìm sản phẩm thuộc nhóm này (box đã chọn ở /detect)"),
+    shop_id: Optional[str] = Form(None, description="Chỉ tìm sản phẩm của shop này")
 ):
     """
     Nhận ảnh đã crop -> Resize -> Embed -> Search FAISS (Cosine Similarity).
+    group / shop_id được lọc ngay trong lúc FAISS quét (không lọc sau).
     """
     try:
         img2img_service = request.app.state.img2img_service
@@ -121,10 +245,15 @@ async def search_product(
         content = await file.read()
         
         # Trích xuất vector
-        vector = img2img_service.process_image_for_search(content)
+        vector = await embed_pool.run(img2img_service.process_image_for_search, content)
         
         # Tìm kiếm
-        raw_results = img2img_index.search(vector, k=k)
+        batch_results, rounds = await index_pool.run(
+            img2img_index.search_batch_collapsed,
+            [vector], k=k, nprobe=nprobe, ef_search=ef_search,
+            group=group.value if group else None, shop_id=shop_id
+        )
+        raw_results = batch_results[0]
         
         # Format kết quả & Lọc rác (Cosine Score)
         formatted_results = []
@@ -147,11 +276,78 @@ async def search_product(
             status="success",
             total_results=len(formatted_results),
             results=formatted_results,
-            message="Tìm kiếm thành công"
+            message="Tìm kiếm thành công",
+            search_rounds=rounds[0]
         )
 
+    except PoolSaturatedError:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Search error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/search-batch", response_model=BatchSearchResponse, summary="Tìm kiếm nhiều ảnh trong một request")
+async def search_product_batch(
+    request: Request,
+    files: List[UploadFile] = File(..., description="Danh sách ảnh đã crop"),
+    k: int = Form(10),
+    nprobe: Optional[int] = Form(None, description="Số cluster quét (chỉ dùng cho index IVF)"),
+    ef_search: Optional[int] = Form(None, description="Độ rộng tìm kiếm (chỉ dùng cho index HNSW)"),
+    group: Optional[TargetGroupEnum] = Form(None, description="Chỉ tìm sản phẩm thuộc nhóm này"),
+    shop_id: Optional[str] = Form(None, description="Chỉ tìm sản phẩm của shop này")
+):
+    """
+    Embed từng ảnh -> gộp thành ma trận -> MỘT lần search FAISS cho tất cả query.
+    Ảnh lỗi được trả về với status="error" mà không làm hỏng cả batch.
+    """
+    try:
+        img2img_service = request.app.state.img2img_service
+        img2img_index = request.app.state.index_service
+
+        # Embed cả list ảnh trong MỘT lần forward (ảnh lỗi chỉ báo lỗi ở vị trí của nó)
+        contents = [await file.read() for file in files]
+        matrix, item_errors = await embed_pool.run(img2img_service.process_images_for_search, contents)
+        errors = {i: error for i, error in enumerate(item_errors) if error is not None}
+        vectors = [matrix[i] for i in range(len(files)) if i not in errors]
+
+        batch_results, batch_rounds = [], []
+        if vectors:
+            batch_results, batch_rounds = await index_pool.run(
+                img2img_index.search_batch_collapsed,
+                vectors, k=k, nprobe=nprobe, ef_search=ef_search,
+                group=group.value if group else None, shop_id=shop_id
+            )
+
+        queries = []
+        result_iter = iter(zip(batch_results, batch_rounds))
+        for i in range(len(files)):
+            if i in errors:
+                queries.append(SearchResponse(status="error", total_results=0, results=[], message=errors[i]))
+                continue
+            raw_results, rounds = next(result_iter)
+            formatted_results = [
+                SearchResultItem(
+                    rank=item['rank'],
+                    product_id=item['product_id'],
+                    image_id=item['image_id'],
+                    similarity=float(item['score'])
+                )
+                for item in raw_results
+            ]
+            queries.append(SearchResponse(
+                status="success",
+                total_results=len(formatted_results),
+                results=formatted_results,
+                message="Tìm kiếm thành công",
+                search_rounds=rounds
+            ))
+
+        return BatchSearchResponse(status="success", total_queries=len(queries), queries=queries)
+
+    except PoolSaturatedError:
+        raise
+    except Exception as e:
+        logger.error(f"Batch search error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
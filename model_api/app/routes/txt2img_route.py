@@ -3,14 +3,16 @@
 from fastapi import APIRouter, HTTPException, Form, File, UploadFile
 from app.schemas.txt2img_request import (
     TextSearchRequest,
+    TextBatchSearchRequest,
     TextDeleteRequest, 
     TextBatchDeleteRequest
 )
-from app.schemas.txt2img_response import TextSearchResponse, BaseResponse
+from app.schemas.txt2img_response import TextSearchResponse, TextBatchSearchResponse, BaseResponse
 
 # Import các service
 from app.services.txt2img_service import txt2img_service
 from app.services.txt_index_service import text_index_service
+from app.services.inference_pools import embed_pool, index_pool, PoolSaturatedError
 
 # Import decorator mới của chúng ta
 from app.utils.dependencies import ensure_services_are_ready 
@@ -24,11 +26,11 @@ router = APIRouter()
 @ensure_services_are_ready(check_model=True, check_index=True)
 async def search_by_text(payload: TextSearchRequest):
     try:
-        vector = txt2img_service.embed_text(payload.query)
+        vector = await embed_pool.run(txt2img_service.embed_text, payload.query)
         if vector is None:
             raise HTTPException(status_code=500, detail="Failed to create text embedding.")
             
-        results = text_index_service.search(vector, k=payload.limit)
+        results = await index_pool.run(text_index_service.search, vector, k=payload.limit)
         
         return {
             "success": True, 
@@ -36,10 +38,44 @@ async def search_by_text(payload: TextSearchRequest):
             "total_found": len(results),
             "message": "Search completed"
         }
+    except PoolSaturatedError:
+        raise
     except Exception as e:
         logger.error(f"[TextSearch] Unhandled error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An internal server error occurred during search.")
 
+# 1b. API SEARCH BATCH
+# Nhiều câu query -> embed từng câu -> MỘT lần search FAISS cho tất cả
+@router.post("/search-batch", response_model=TextBatchSearchResponse)
+@ensure_services_are_ready(check_model=True, check_index=True)
+async def search_by_text_batch(payload: TextBatchSearchRequest):
+    try:
+        # Một lần forward PhoBERT cho cả list query
+        vectors, errors = await embed_pool.run(txt2img_service.embed_texts, payload.queries)
+        valid_rows = [i for i, error in enumerate(errors) if error is None]
+
+        batch_results = []
+        if valid_rows:
+            batch_results = await index_pool.run(text_index_service.search_batch, vectors[valid_rows], k=payload.limit)
+            if len(batch_results) != len(valid_rows):
+                raise RuntimeError(f"Text index returned {len(batch_results)} result rows for {len(valid_rows)} queries")
+        results_by_row = dict(zip(valid_rows, batch_results))
+
+        data = []
+        for i in range(len(payload.queries)):
+            results = results_by_row.get(i)
+            if results is None:
+                data.append({"success": False, "data": [], "total_found": 0, "message": f"Failed to create text embedding: {errors[i]}"})
+            else:
+                data.append({"success": True, "data": results, "total_found": len(results), "message": "Search completed"})
+
+        return {"success": True, "data": data, "message": f"Processed {len(payload.queries)} queries"}
+    except PoolSaturatedError:
+        raise
+    except Exception as e:
+        logger.error(f"[TextSearchBatch] Unhandled error: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="An internal server error occurred during batch search.")
+
 # 2. API INDEX (ADD/UPDATE)
 # Áp dụng decorator: Endpoint này cần cả model và index
 @router.post("/index", response_model=BaseResponse)
@@ -50,11 +86,11 @@ async def index_product(
     image: UploadFile = File(...)
 ):
     try:
-        vector = txt2img_service.embed_image(image.file)
+        vector = await embed_pool.run(txt2img_service.embed_image, image.file)
         if vector is None:
             raise HTTPException(status_code=400, detail=f"Could not process image '{image.filename}'.")
 
-        success = text_index_service.add_product(vector, product_id, image_path)
+        success = await index_pool.run(text_index_service.add_product, vector, product_id, image_path)
         if not success:
             raise HTTPException(status_code=500, detail="Failed to add vector to index.")
         
@@ -62,6 +98,8 @@ async def index_product(
             "success": True, 
             "message": f"Image '{image_path}' for product '{product_id}' indexed successfully."
         }
+    except PoolSaturatedError:
+        raise
     except HTTPException as he:
         # Ghi log và re-throw lỗi HTTP đã biết
         logger.warning(f"[TextIndex] Client error for image '{image.filename}': {he.detail}")
@@ -106,14 +144,18 @@ async def delete_entries(payload: TextBatchDeleteRequest): # Dùng lại schema
         count = 0
         if payload.image_paths and len(payload.image_paths) > 0:
             # Kịch bản 1: Xóa các ảnh cụ thể
-            count = text_index_service.remove_list_images(payload.product_id, payload.image_paths)
+            count = await index_pool.run(text_index_service.remove_list_images, payload.product_id, payload.image_paths)
             message = f"Removed {count} specific image entries for product '{payload.product_id}'."
         else:
             # Kịch bản 2: Xóa toàn bộ sản phẩm
-            count = text_index_service.remove_product(payload.product_id)
+            count = await index_pool.run(text_index_service.remove_product, payload.product_id)
             message = f"Removed all {count} entries for product '{payload.product_id}'."
-            
+        if count < 0:
+            raise HTTPException(status_code=500, detail="Failed to remove entries from index.")
+
         return {"success": True, "message": message}
+    except (PoolSaturatedError, HTTPException):
+        raise
     except Exception as e:
         logger.error(f"[TextDelete] Error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An internal error occurred during deletion.")
@@ -124,10 +166,12 @@ async def delete_entries(payload: TextBatchDeleteRequest): # Dùng lại schema
 @ensure_services_are_ready(check_model=False, check_index=True)
 async def clear_index():
     try:
-        success = text_index_service.reset_index()
+        success = await index_pool.run(text_index_service.reset_index)
         if not success:
             raise HTTPException(status_code=500, detail="Failed to clear index.")
         return {"success": True, "message": "Index cleared successfully."}
+    except PoolSaturatedError:
+        raise
     except Exception as e:
         logger.error(f"[TextClear] Unhandled error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
\ No newline at end of file
@@ -0,0 +1,25 @@
+# model_api/app/schemas/hybrid_response.py
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+
+# Kết quả của một nhánh cho sản phẩm (None nếu sản phẩm không có trong top của nhánh đó)
+class HybridBranchHit(BaseModel):
+    rank: int
+    score: float                    # Cosine similarity của nhánh
+    image_id: Optional[str] = None  # Nhánh ảnh: ảnh khớp nhất trong img2img index
+    image: Optional[str] = None     # Nhánh text: đường dẫn ảnh khớp nhất trong text index
+
+class HybridResultItem(BaseModel):
+    rank: int
+    product_id: str
+    score: float                    # Điểm RRF sau khi gộp
+    text: Optional[HybridBranchHit] = None
+    image: Optional[HybridBranchHit] = None
+
+class HybridSearchResponse(BaseModel):
+    status: str
+    total_results: int
+    results: List[HybridResultItem]
+    message: Optional[str] = None
+    branch_totals: Dict[str, int] = {}  # Số sản phẩm mỗi nhánh trả về trước khi gộp
+    errors: Dict[str, str] = {}         # Nhánh lỗi (nhánh còn lại vẫn được trả về)
@@ -13,6 +13,13 @@ class SearchResponse(BaseModel):
     total_results: int
     results: List[SearchResultItem]
     message: Optional[str] = None
+    search_rounds: Optional[int] = None # Số lượt search FAISS cần để đủ k sản phẩm
+
+# Schema cho API Search Batch: mỗi ảnh query một SearchResponse (status="error" nếu ảnh lỗi)
+class BatchSearchResponse(BaseModel):
+    status: str
+    total_queries: int
+    queries: List[SearchResponse]
 
 # Schema cho API Detect
 class DetectResponse(BaseModel):
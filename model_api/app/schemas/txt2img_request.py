@@ -6,6 +6,10 @@ class TextSearchRequest(BaseModel):
     query: str
     limit: int = 20
 
+class TextBatchSearchRequest(BaseModel):
+    queries: List[str]
+    limit: int = 20
+
 # class TextIndexRequest(BaseModel):
 #     product_id: str  # ID từ MongoDB (String)
 #     image_path: str  # Đường dẫn ảnh trên ổ cứng server
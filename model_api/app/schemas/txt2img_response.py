@@ -15,6 +15,12 @@ class TextSearchResponse(BaseModel):
     total_found: int             # Số lượng kết quả tìm thấy
     data: List[SearchResultItem] # Danh sách đã sort theo score giảm dần
 
+# 2b. Phản hồi cho API Search Batch (mỗi query một TextSearchResponse, cùng thứ tự với request)
+class TextBatchSearchResponse(BaseModel):
+    success: bool
+    message: Optional[str] = None
+    data: List[TextSearchResponse]
+
 # 3. Cấu trúc phản hồi chung (cho Index/Delete)
 class BaseResponse(BaseModel):
     success: bool
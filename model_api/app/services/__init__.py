@@ -1,19 +1,15 @@
 from .index_service import IndexService
+from .sharded_index_service import ShardedIndexService
 from app.config import (
-    IMG2IMG_BACKBONE, EMBEDDING_SIZE,
+    IMG2IMG_BACKBONE, EMBEDDING_SIZE, IMG2IMG_NUM_SHARDS,
     RESNET50_INDEX_PATH, RESNET50_MAP_PATH,
     RESNET101_INDEX_PATH, RESNET101_MAP_PATH,
     VIT_INDEX_PATH, VIT_MAP_PATH
 )
 from app.utils.logger import logger
 
-def get_index_service_instance() -> IndexService:
-    """
-    Hàm Factory: Đọc config và trả về một instance của IndexService
-    đã được cấu hình đúng với backbone đang hoạt động.
-    """
-    logger.info(f"Initializing IndexService for backbone: {IMG2IMG_BACKBONE}")
-    
+def get_index_paths():
+    """Trả về (index_path, map_path) của index img2img ứng với backbone đang hoạt động."""
     if IMG2IMG_BACKBONE == 'ResNet_50':
         index_path = RESNET50_INDEX_PATH
         map_path = RESNET50_MAP_PATH
@@ -25,7 +21,29 @@ def get_index_service_instance() -> IndexService:
         map_path = RESNET101_MAP_PATH
     else:
         raise ValueError(f"Không có cấu hình index cho backbone: {IMG2IMG_BACKBONE}")
-        
+    return index_path, map_path
+
+
+def get_index_service_instance(index_path: str = None, map_path: str = None) -> IndexService:
+    """
+    Hàm Factory: Đọc config và trả về một instance của IndexService
+    đã được cấu hình đúng với backbone đang hoạt động.
+    IMG2IMG_NUM_SHARDS > 1 -> ShardedIndexService (cùng API, chia shard theo product_id).
+    index_path / map_path: ghi đè đường dẫn (VD: reindex ra file mới).
+    """
+    logger.info(f"Initializing IndexService for backbone: {IMG2IMG_BACKBONE}")
+    
+    if index_path is None:
+        index_path, map_path = get_index_paths()
+
+    if IMG2IMG_NUM_SHARDS > 1:
+        return ShardedIndexService(
+            index_path=index_path,
+            mapping_path=map_path,
+            dim=EMBEDDING_SIZE,
+            num_shards=IMG2IMG_NUM_SHARDS
+        )
+
     return IndexService(
         index_path=index_path,
         mapping_path=map_path,
@@ -0,0 +1,130 @@
+# model_api/app/services/bulk_indexer.py
+import time
+from pathlib import Path
+
+from app.config import UPLOAD_ROOT_DIR, UPLOAD_IMAGES_DIR
+from app.services.inference_pools import embed_pool, index_pool, PoolSaturatedError
+from app.utils.logger import logger
+from app.utils.timer import Timer
+
+
+def resolve_upload_path(path: str) -> Path:
+    """
+    Đường dẫn ảnh trong manifest -> file thật nằm trong UPLOAD_IMAGES_DIR (server/uploads).
+    Chấp nhận đường dẫn tuyệt đối, hoặc tương đối theo server/ (VD: '/uploads/products/a.jpg').
+    Đường dẫn trỏ ra ngoài thư mục uploads (VD: '../') -> ValueError.
+    """
+    root = UPLOAD_IMAGES_DIR.resolve()
+    raw = str(path).replace("\\", "/")
+    candidates = [Path(raw).resolve()] if Path(raw).is_absolute() else []
+    candidates.append((UPLOAD_ROOT_DIR / raw.lstrip("/")).resolve())
+    for candidate in candidates:
+        if root in candidate.parents:
+            return candidate
+    raise ValueError(f"Path '{path}' is outside {UPLOAD_IMAGES_DIR}")
+
+
+async def bulk_index_events(img2img_service, index_service, items: list, batch_size: int):
+    """
+    Async generator cho /img2img/index-bulk: chạy từng batch qua Detect -> Crop -> Embed (batch),
+    thêm vector vào index bằng add_items, và yield một event (dict) cho mỗi ảnh.
+    items: list dict {"product_id", "image_id", "group", "shop_id", và "content" (bytes) hoặc "path"}.
+    Model chạy trong embed_pool, FAISS / journal trong index_pool (như /img2img/index), không chiếm
+    threadpool của Starlette. Pool đầy -> yield event "error" rồi dừng stream.
+    Chỉ commit index MỘT lần ở cuối.
+    """
+    total = len(items)
+    start = time.perf_counter()
+    indexed = failed = 0
+    yield {"event": "start", "total": total, "batch_size": batch_size}
+
+    with Timer("BulkIndexing_Total", metadata={"service": "img2img", "action": "indexing", "total": total}):
+        try:
+            for batch_start in range(0, total, batch_size):
+                batch = items[batch_start:batch_start + batch_size]
+                for offset, event in enumerate(await _index_batch(img2img_service, index_service, batch)):
+                    if event["status"] == "indexed":
+                        indexed += 1
+                    else:
+                        failed += 1
+                    yield {"event": "item", "index": batch_start + offset, **event}
+        except PoolSaturatedError as e:
+            logger.warning(f"Bulk indexing stopped after {indexed + failed}/{total} items: {e}")
+            if indexed:
+                await _commit(index_service)
+            yield {"event": "error", "error": str(e), "processed": indexed + failed, "indexed": indexed, "failed": failed}
+            return
+
+        if indexed:
+            await _commit(index_service)
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Bulk indexing done: {indexed} indexed, {failed} failed in {elapsed:.1f}s")
+    yield {
+        "event": "done", "total": total, "indexed": indexed, "failed": failed,
+        "elapsed_s": round(elapsed, 3), "images_per_sec": round(indexed / elapsed, 2) if elapsed > 0 else 0.0
+    }
+
+
+async def _commit(index_service):
+    try:
+        await index_pool.run(index_service.commit)
+    except PoolSaturatedError as e:
+        # Vector đã nằm trong index (và journal nếu bật); snapshot sau sẽ ghi xuống đĩa
+        logger.warning(f"Bulk indexing commit deferred: {e}")
+
+
+def _load_and_embed(img2img_service, events: list, batch: list):
+    """Đọc ảnh theo path (nếu chưa có bytes) rồi Detect -> Crop -> Embed cả batch; chạy trong embed_pool."""
+    ready = []
+    for event, item in zip(events, batch):
+        if item.get("content") is None:
+            try:
+                item["content"] = resolve_upload_path(item["path"]).read_bytes()
+            except (OSError, ValueError) as e:
+                event["error"] = str(e)
+                continue
+        ready.append((event, item))
+
+    try:
+        outputs = img2img_service.process_images_for_indexing([item for _, item in ready]) if ready else []
+    except Exception as e:
+        logger.error(f"Bulk indexing batch failed: {e}")
+        outputs = [{"error": str(e)}] * len(ready)
+    return ready, outputs
+
+
+async def _index_batch(img2img_service, index_service, batch: list) -> list:
+    """Xử lý một batch; lỗi của từng ảnh được ghi vào event của ảnh đó, không làm dừng cả request."""
+    events = [{"product_id": it["product_id"], "image_id": it["image_id"], "status": "error"} for it in batch]
+    ready, outputs = await embed_pool.run(_load_and_embed, img2img_service, events, batch)
+
+    to_add = []
+    for (event, item), output in zip(ready, outputs):
+        item.pop("content", None) # Giải phóng bytes ảnh ngay sau khi embed
+        if "crop_method" in output:
+            event["crop_method"] = output["crop_method"]
+        if "vector" in output:
+            to_add.append((event, item, output["vector"]))
+        else:
+            event["error"] = output.get("error", "Unknown error")
+
+    if to_add:
+        try:
+            await index_pool.run(
+                index_service.add_items,
+                [vector for _, _, vector in to_add],
+                [item["product_id"] for _, item, _ in to_add],
+                [item["image_id"] for _, item, _ in to_add],
+                groups=[item["group"] for _, item, _ in to_add],
+                shop_ids=[item.get("shop_id") for _, item, _ in to_add]
+            )
+            for event, _, _ in to_add:
+                event["status"] = "indexed"
+        except PoolSaturatedError:
+            raise
+        except Exception as e:
+            logger.error(f"Bulk indexing add_items failed: {e}")
+            for event, _, _ in to_add:
+                event["error"] = str(e)
+    return events
@@ -0,0 +1,135 @@
+# model_api/app/services/embedding_cache.py
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from app.config import EMBEDDING_CACHE_ENABLED, EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_DISK_DIR
+from app.utils.io_utils import atomic_write_bytes
+from app.utils.logger import logger
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def model_tag(name: str, weight_path: str = None) -> str:
+    """
+    Phần namespace định danh model: tên + file trọng số + mtime.
+    Train lại và ghi đè file trọng số -> tag đổi -> entry cũ trên đĩa không còn được dùng.
+    """
+    if not weight_path or not os.path.exists(weight_path):
+        return name
+    return f"{name}:{os.path.basename(weight_path)}:{int(os.path.getmtime(weight_path))}"
+
+
+class EmbeddingCache:
+    """
+    Cache theo nội dung ảnh: SHA-256(bytes) + namespace -> {"vector", "crop_method", "crop_box"}.
+    - namespace gồm model và công đoạn (VD: "img2img:ResNet_50:...:index:upper_body"),
+      vì cùng một ảnh cho ra vector khác nhau theo backbone / group crop.
+    - Tầng RAM: LRU giới hạn max_entries.
+    - Tầng đĩa (tùy chọn): mỗi entry một file .npz trong disk_dir/<namespace>/<2 ký tự đầu>/,
+      miss ở RAM thì đọc đĩa rồi đưa lên RAM. Không giới hạn dung lượng (xóa thư mục để dọn).
+    Entry không phụ thuộc index (chỉ là đầu ra của model) nên không cần hết hạn theo generation.
+    """
+    def __init__(self, max_entries: int = 4096, disk_dir: str = None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir or None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _disk_path(self, namespace: str, digest: str) -> str:
+        safe_ns = re.sub(r"[^A-Za-z0-9_.-]+", "_", namespace)
+        return os.path.join(self.disk_dir, safe_ns, digest[:2], f"{digest}.npz")
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, namespace: str, digest: str):
+        """Trả về bản copy của entry ({"vector", "crop_method", "crop_box"}) hoặc None."""
+        key = (namespace, digest)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return {**entry, "vector": entry["vector"].copy()}
+
+        entry = self._read_disk(namespace, digest) if self.disk_dir else None
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self._remember(key, entry)
+        return {**entry, "vector": entry["vector"].copy()}
+
+    def put(self, namespace: str, digest: str, vector, crop_method: str = None, crop_box=None):
+        entry = {
+            "vector": np.array(vector, dtype=np.float32),
+            "crop_method": crop_method,
+            "crop_box": [int(c) for c in crop_box] if crop_box is not None else None,
+        }
+        self._remember((namespace, digest), entry)
+        if self.disk_dir:
+            self._write_disk(namespace, digest, entry)
+
+    def _read_disk(self, namespace: str, digest: str):
+        path = self._disk_path(namespace, digest)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                meta = json.loads(str(data["meta"]))
+                return {"vector": data["vector"].astype(np.float32), **meta}
+        except Exception as e:
+            logger.warning(f"[EmbeddingCache] Ignoring unreadable cache file {path}: {e}")
+            return None
+
+    def _write_disk(self, namespace: str, digest: str, entry: dict):
+        buffer = io.BytesIO()
+        meta = {"crop_method": entry["crop_method"], "crop_box": entry["crop_box"]}
+        np.savez(buffer, vector=entry["vector"], meta=np.array(json.dumps(meta)))
+        try:
+            atomic_write_bytes(self._disk_path(namespace, digest), buffer.getbuffer(), keep_previous=False)
+        except OSError as e:
+            # Ghi cache lỗi (đầy đĩa, quyền...) không được làm hỏng request
+            logger.warning(f"[EmbeddingCache] Failed to write cache entry: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "disk_dir": self.disk_dir,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.disk_hits) / total, 4) if total else 0.0,
+            }
+
+
+# --- Singleton dùng chung cho img2img và txt2img ---
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_DISK_DIR) if EMBEDDING_CACHE_ENABLED else None
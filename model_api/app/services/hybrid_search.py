@@ -0,0 +1,105 @@
+# model_api/app/services/hybrid_search.py
+import asyncio
+import time
+
+from app.config import HYBRID_RRF_K, HYBRID_CANDIDATE_FACTOR
+from app.services.inference_pools import embed_pool, index_pool, PoolSaturatedError
+from app.utils.logger import logger
+from app.utils.timer import Timer
+
+
+def reciprocal_rank_fusion(ranked: dict, k: int, rrf_k: int = HYBRID_RRF_K, weights: dict = None) -> list:
+    """
+    Gộp nhiều danh sách kết quả (mỗi nhánh đã khử trùng sản phẩm, sort theo score giảm dần).
+    ranked: {"text": [{"product_id", "score", ...}], "image": [...]}
+    score(p) = Σ_nhánh weight / (rrf_k + rank của p trong nhánh), rank bắt đầu từ 1.
+    RRF chỉ dùng thứ hạng nên không cần chuẩn hóa score của 2 model khác nhau (PhoCLIP vs backbone ảnh).
+    Trả về top-k: {"product_id", "score", "rank", "<nhánh>": {"rank", "score", ...}}.
+    """
+    weights = weights or {}
+    fused = {}
+    for branch, results in ranked.items():
+        weight = weights.get(branch, 1.0)
+        for rank, item in enumerate(results, start=1):
+            entry = fused.setdefault(item["product_id"], {"product_id": item["product_id"], "score": 0.0})
+            entry["score"] += weight / (rrf_k + rank)
+            entry[branch] = {"rank": rank, **{key: value for key, value in item.items() if key != "product_id"}}
+
+    # Hòa điểm -> ưu tiên sản phẩm có mặt ở nhiều nhánh, rồi tới thứ hạng tốt nhất
+    ordered = sorted(
+        fused.values(),
+        key=lambda e: (-e["score"], -sum(b in e for b in ranked), min(e[b]["rank"] for b in ranked if b in e))
+    )[:k]
+    for rank, entry in enumerate(ordered, start=1):
+        entry["rank"] = rank
+    return ordered
+
+
+async def _text_branch(txt2img_service, text_index_service, query: str, fetch_k: int) -> list:
+    start = time.perf_counter()
+    vector = await embed_pool.run(txt2img_service.embed_text, query)
+    if vector is None:
+        raise RuntimeError("Failed to create text embedding.")
+    embed_ms = (time.perf_counter() - start) * 1000
+    results = await index_pool.run(text_index_service.search, vector, k=fetch_k)
+    logger.debug(f"[Hybrid] text branch: embed {embed_ms:.1f}ms, total {(time.perf_counter() - start) * 1000:.1f}ms")
+    return [{"product_id": r["id"], "score": r["score"], "image": r["image"]} for r in results]
+
+
+async def _image_branch(img2img_service, index_service, image_bytes: bytes, fetch_k: int,
+                        group: str = None, shop_id: str = None) -> list:
+    start = time.perf_counter()
+    vector = await embed_pool.run(img2img_service.process_image_for_search, image_bytes)
+    embed_ms = (time.perf_counter() - start) * 1000
+    results, _ = await index_pool.run(
+        index_service.search_batch_collapsed, [vector], k=fetch_k, group=group, shop_id=shop_id
+    )
+    logger.debug(f"[Hybrid] image branch: embed {embed_ms:.1f}ms, total {(time.perf_counter() - start) * 1000:.1f}ms")
+    return [{"product_id": r["product_id"], "score": r["score"], "image_id": r["image_id"]} for r in results[0]]
+
+
+async def hybrid_search(k: int, query: str = None, image_bytes: bytes = None,
+                        txt2img_service=None, text_index_service=None,
+                        img2img_service=None, index_service=None,
+                        group: str = None, shop_id: str = None,
+                        text_weight: float = 1.0, image_weight: float = 1.0) -> dict:
+    """
+    Chạy nhánh text (embed_text -> search text index) và nhánh ảnh
+    (process_image_for_search -> search img2img index) song song trên các pool embed / index
+    (PyTorch và FAISS nhả GIL), sau đó gộp bằng reciprocal_rank_fusion.
+    Một nhánh lỗi không làm hỏng nhánh còn lại: lỗi được trả về trong "errors".
+    ValueError của nhánh ảnh (ảnh không đọc được) được ném lại để route trả 400;
+    PoolSaturatedError được ném lại khi không nhánh nào chạy được (route trả 503).
+    """
+    fetch_k = k * max(HYBRID_CANDIDATE_FACTOR, 1)
+    branches = {}
+    if query:
+        branches["text"] = _text_branch(txt2img_service, text_index_service, query, fetch_k)
+    if image_bytes:
+        branches["image"] = _image_branch(img2img_service, index_service, image_bytes, fetch_k, group, shop_id)
+
+    metadata = {"service": "hybrid", "action": "search", "k": k, "branches": ",".join(branches)}
+    with Timer("Search_Hybrid_Total", metadata=metadata):
+        outcomes = await asyncio.gather(*branches.values(), return_exceptions=True)
+
+    ranked, errors = {}, {}
+    for branch, outcome in zip(branches, outcomes):
+        if isinstance(outcome, ValueError) and branch == "image":
+            raise outcome
+        if isinstance(outcome, BaseException):
+            logger.error(f"[Hybrid] {branch} branch failed: {outcome}")
+            errors[branch] = str(outcome)
+        else:
+            ranked[branch] = outcome
+    if not ranked:
+        saturated = [outcome for outcome in outcomes if isinstance(outcome, PoolSaturatedError)]
+        if saturated:
+            raise saturated[0]
+
+    with Timer("Search_Hybrid_Fusion", metadata=metadata):
+        fused = reciprocal_rank_fusion(ranked, k, weights={"text": text_weight, "image": image_weight})
+    return {
+        "results": fused,
+        "branch_totals": {branch: len(results) for branch, results in ranked.items()},
+        "errors": errors,
+    }
@@ -0,0 +1,255 @@
+# model_api/app/services/id_store.py
+import faiss
+import numpy as np
+
+# Code dùng cho slot trống (ID chưa dùng hoặc đã xóa)
+EMPTY_CODE = -1
+
+class IdMapStore:
+    """
+    Lưu map FAISS id -> (product_id, image_id, group, shop_id) dạng cột NumPy.
+    - Các chuỗi được intern thành mã int32, mảng được đánh chỉ số trực tiếp bằng FAISS id.
+    - Reverse index product -> {FAISS ids} để xóa theo sản phẩm chỉ tốn O(số ảnh của sản phẩm).
+    - group / shop_id dùng để lọc ngay trong lúc FAISS quét (IDSelectorBitmap, xem selector_for).
+    """
+    COLUMNS = ("product_codes", "image_codes", "group_codes", "shop_codes")
+
+    def __init__(self, capacity: int = 1024):
+        self.product_codes = np.full(capacity, EMPTY_CODE, dtype=np.int32)
+        self.image_codes = np.full(capacity, EMPTY_CODE, dtype=np.int32)
+        self.group_codes = np.full(capacity, EMPTY_CODE, dtype=np.int32)
+        self.shop_codes = np.full(capacity, EMPTY_CODE, dtype=np.int32)
+
+        # Bảng intern: code -> chuỗi và chuỗi -> code
+        self._products = []
+        self._product_lookup = {}
+        self._images = []
+        self._image_lookup = {}
+        self._groups = []
+        self._group_lookup = {}
+        self._shops = []
+        self._shop_lookup = {}
+
+        # Reverse index: product code -> set các FAISS id
+        self._product_ids = {}
+        self._count = 0
+        # Tăng mỗi lần thay đổi -> cache bitmap filter biết khi nào hết hạn
+        self.version = 0
+        self._selector_cache = {}
+
+    # --- Intern helpers ---
+    @staticmethod
+    def _intern(value: str, table: list, lookup: dict) -> int:
+        code = lookup.get(value)
+        if code is None:
+            code = len(table)
+            table.append(value)
+            lookup[value] = code
+        return code
+
+    def _ensure_capacity(self, int_id: int):
+        size = len(self.product_codes)
+        if int_id < size:
+            return
+        new_size = max(int_id + 1, size * 2)
+        for name in self.COLUMNS:
+            old = getattr(self, name)
+            grown = np.full(new_size, EMPTY_CODE, dtype=np.int32)
+            grown[:size] = old
+            setattr(self, name, grown)
+
+    # --- Thao tác cơ bản ---
+    def add(self, int_id: int, product_id: str, image_id: str, group: str = None, shop_id: str = None):
+        int_id = int(int_id)
+        if int_id in self:
+            self.remove(int_id)
+        self._ensure_capacity(int_id)
+        p_code = self._intern(product_id, self._products, self._product_lookup)
+        i_code = self._intern(image_id, self._images, self._image_lookup)
+        self.product_codes[int_id] = p_code
+        self.image_codes[int_id] = i_code
+        if group is not None:
+            self.group_codes[int_id] = self._intern(group, self._groups, self._group_lookup)
+        if shop_id is not None:
+            self.shop_codes[int_id] = self._intern(str(shop_id), self._shops, self._shop_lookup)
+        self._product_ids.setdefault(p_code, set()).add(int_id)
+        self._count += 1
+        self.version += 1
+
+    def remove(self, int_id: int) -> bool:
+        int_id = int(int_id)
+        if int_id not in self:
+            return False
+        p_code = int(self.product_codes[int_id])
+        ids = self._product_ids.get(p_code)
+        if ids is not None:
+            ids.discard(int_id)
+            if not ids:
+                del self._product_ids[p_code]
+        for name in self.COLUMNS:
+            getattr(self, name)[int_id] = EMPTY_CODE
+        self._count -= 1
+        self.version += 1
+        return True
+
+    def pop(self, int_id: int, default=None):
+        info = self.get(int_id)
+        if info is None:
+            return default
+        self.remove(int_id)
+        return info
+
+    def get(self, int_id: int):
+        """Trả về {"product_id", "image_id", "group", "shop_id"} hoặc None (tương thích với dict cũ)."""
+        int_id = int(int_id)
+        if int_id not in self:
+            return None
+        g_code, s_code = self.group_codes[int_id], self.shop_codes[int_id]
+        return {
+            "product_id": self._products[self.product_codes[int_id]],
+            "image_id": self._images[self.image_codes[int_id]],
+            "group": self._groups[g_code] if g_code != EMPTY_CODE else None,
+            "shop_id": self._shops[s_code] if s_code != EMPTY_CODE else None
+        }
+
+    def __contains__(self, int_id) -> bool:
+        int_id = int(int_id)
+        return 0 <= int_id < len(self.product_codes) and self.product_codes[int_id] != EMPTY_CODE
+
+    def __len__(self) -> int:
+        return self._count
+
+    def keys(self) -> np.ndarray:
+        """Danh sách FAISS id còn hiệu lực (đã sắp xếp)."""
+        return np.flatnonzero(self.product_codes != EMPTY_CODE).astype(np.int64)
+
+    def clear(self):
+        self.__init__()
+
+    # --- Reverse index ---
+    def ids_for_product(self, product_id: str) -> list:
+        p_code = self._product_lookup.get(product_id)
+        if p_code is None:
+            return []
+        return sorted(self._product_ids.get(p_code, ()))
+
+    def ids_for_images(self, product_id: str, image_ids) -> list:
+        """FAISS id của các ảnh thuộc product_id có image_id nằm trong image_ids."""
+        target_codes = {self._image_lookup[i] for i in image_ids if i in self._image_lookup}
+        if not target_codes:
+            return []
+        return [int_id for int_id in self.ids_for_product(product_id) if self.image_codes[int_id] in target_codes]
+
+    # --- Filter theo metadata (áp dụng bên trong FAISS) ---
+    def filter_mask(self, group: str = None, shop_id: str = None) -> np.ndarray:
+        """Mask bool theo FAISS id: ID còn hiệu lực và khớp group / shop_id (None = không lọc)."""
+        mask = self.product_codes != EMPTY_CODE
+        for value, lookup, column in (
+            (group, self._group_lookup, self.group_codes),
+            (shop_id, self._shop_lookup, self.shop_codes),
+        ):
+            if value is None:
+                continue
+            code = lookup.get(str(value))
+            if code is None:
+                return np.zeros_like(mask)
+            mask &= column == code
+        return mask
+
+    def selector_for(self, group: str = None, shop_id: str = None):
+        """
+        IDSelectorBitmap cho FAISS (None nếu không lọc) + số ID khớp.
+        Bitmap được cache theo (group, shop_id) cho tới lần thay đổi tiếp theo.
+        """
+        if group is None and shop_id is None:
+            return None, len(self)
+        key = (group, None if shop_id is None else str(shop_id))
+        cached = self._selector_cache.get(key)
+        if cached is not None and cached[0] == self.version:
+            return cached[1], cached[2]
+
+        mask = self.filter_mask(group, shop_id)
+        bitmap = np.packbits(mask, bitorder="little")
+        # n = số byte của bitmap; ID nằm ngoài bitmap được coi là không khớp
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+        selector.referenced = bitmap # Giữ bitmap sống cùng selector
+        count = int(mask.sum())
+        if len(self._selector_cache) > 64:
+            self._selector_cache.clear()
+        self._selector_cache[key] = (self.version, selector, count)
+        return selector, count
+
+    # --- Tra cứu vector hóa cho kết quả search ---
+    def lookup_product_codes(self, ids: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+        """
+        Map mảng FAISS id (có thể chứa -1) -> mảng product code (-1 nếu không hợp lệ).
+        mask (từ filter_mask): ID không khớp filter cũng trả -1 (lọc sau search khi index không nhận IDSelector).
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        valid = (ids >= 0) & (ids < len(self.product_codes))
+        if mask is not None:
+            valid[valid] = mask[ids[valid]]
+        codes = np.full(ids.shape, EMPTY_CODE, dtype=np.int32)
+        codes[valid] = self.product_codes[ids[valid]]
+        return codes
+
+    def product_id_of(self, code: int) -> str:
+        return self._products[code]
+
+    def image_id_at(self, int_id: int) -> str:
+        return self._images[self.image_codes[int(int_id)]]
+
+    # --- Persistence ---
+    def to_dict(self) -> dict:
+        """Serialize dạng cột; chỉ giữ chuỗi còn được dùng (tự compact bảng intern)."""
+        ids = self.keys()
+        p_used, p_codes = np.unique(self.product_codes[ids], return_inverse=True)
+        i_used, i_codes = np.unique(self.image_codes[ids], return_inverse=True)
+        data = {
+            "ids": ids.tolist(),
+            "products": [self._products[c] for c in p_used],
+            "images": [self._images[c] for c in i_used],
+            "product_codes": p_codes.astype(np.int32).tolist(),
+            "image_codes": i_codes.astype(np.int32).tolist()
+        }
+        # Cột tùy chọn: giữ -1 cho vector chưa có group / shop_id
+        for name, column, table in (("groups", self.group_codes, self._groups), ("shops", self.shop_codes, self._shops)):
+            codes = column[ids]
+            used = np.unique(codes[codes != EMPTY_CODE])
+            remap = np.full(len(table) + 1, EMPTY_CODE, dtype=np.int32)
+            remap[used] = np.arange(len(used), dtype=np.int32)
+            data[name] = [table[c] for c in used]
+            data[name[:-1] + "_codes"] = np.where(codes != EMPTY_CODE, remap[codes], EMPTY_CODE).tolist()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "IdMapStore":
+        """Load từ format cột (to_dict) hoặc format cũ {"mapping": {id: {...}}}."""
+        if "mapping" in data:
+            mapping = data.get("mapping", {})
+            store = cls(capacity=max([int(k) for k in mapping] + [0]) + 1)
+            for k, v in mapping.items():
+                store.add(int(k), v["product_id"], v["image_id"])
+            return store
+
+        ids = np.asarray(data.get("ids", []), dtype=np.int64)
+        store = cls(capacity=int(ids.max()) + 1 if len(ids) else 1024)
+        store._products = list(data.get("products", []))
+        store._product_lookup = {p: c for c, p in enumerate(store._products)}
+        store._images = list(data.get("images", []))
+        store._image_lookup = {i: c for c, i in enumerate(store._images)}
+        store.product_codes[ids] = np.asarray(data.get("product_codes", []), dtype=np.int32)
+        store.image_codes[ids] = np.asarray(data.get("image_codes", []), dtype=np.int32)
+        # Snapshot cũ (trước khi lưu group / shop) không có các cột này
+        store._groups = list(data.get("groups", []))
+        store._group_lookup = {g: c for c, g in enumerate(store._groups)}
+        store._shops = list(data.get("shops", []))
+        store._shop_lookup = {sh: c for c, sh in enumerate(store._shops)}
+        if "group_codes" in data:
+            store.group_codes[ids] = np.asarray(data["group_codes"], dtype=np.int32)
+        if "shop_codes" in data:
+            store.shop_codes[ids] = np.asarray(data["shop_codes"], dtype=np.int32)
+        for int_id, p_code in zip(ids.tolist(), store.product_codes[ids].tolist()):
+            store._product_ids.setdefault(p_code, set()).add(int_id)
+        store._count = len(ids)
+        return store
@@ -206,7 +206,6 @@ import torch
 import numpy as np
 import cv2
 from PIL import Image
-from collections import OrderedDict
 import torchvision.transforms as transforms
 from ultralytics import YOLO
 
@@ -215,22 +214,29 @@ from app.config import (
     YOLO_WEIGHT_PATH, RESNET_WEIGHT_PATH, VIT_WEIGHT_PATH, DEVICE,
     INPUT_SIZE, RGB_MEAN, RGB_STD,
     IMG2IMG_BACKBONE, EMBEDDING_SIZE,
-    SAVE_CROPPED_IMAGES, CROPPED_IMAGE_SAVE_PATH
+    SAVE_CROPPED_IMAGES, CROPPED_IMAGE_SAVE_PATH,
+    IMG2IMG_MICRO_BATCH_ENABLED, IMG2IMG_MICRO_BATCH_MAX_SIZE, IMG2IMG_MICRO_BATCH_MAX_WAIT_MS,
+    IMG2IMG_INFERENCE_BACKEND, IMG2IMG_ONNX_PATH, IMG2IMG_ONNX_THREADS,
+    IMG2IMG_ONNX_VERIFY_ON_LOAD, IMG2IMG_ONNX_MIN_COSINE
 )
-from app.backbones import get_backbone
+from app.backbones import get_backbone, load_backbone_checkpoint, backbone_weight_path
+from app.backbones.onnx_backend import load_verified_onnx
 # Import các hàm logic xử lý ảnh mới
 from app.services.preprocess import (
     resize_with_padding, 
     auto_crop_for_seller, 
+    auto_crop_for_seller_batch,
     detect_candidates_for_buyer
 )
 # === IMPORT MỚI: Sử dụng service YOLO dùng chung ===
 from app.services.yolo_service import yolo_service
+from app.services.embedding_cache import embedding_cache, content_hash, model_tag
+from app.services.micro_batcher import MicroBatcher
 from app.utils.logger import logger
 from app.utils.timer import Timer
 
 class Img2ImgService:
-    def __init__(self, device=DEVICE):
+    def __init__(self, device=DEVICE, micro_batch: bool = IMG2IMG_MICRO_BATCH_ENABLED):
         self.device = device
         self.backbone = None
         
@@ -242,6 +248,33 @@ class Img2ImgService:
         
         self.load_models()
 
+        # Backend ONNX Runtime (tùy chọn): load lỗi / lệch so với checkpoint -> vẫn chạy PyTorch
+        self.onnx_backbone = None
+        if IMG2IMG_INFERENCE_BACKEND == 'onnx':
+            self.onnx_backbone = load_verified_onnx(
+                self.backbone, IMG2IMG_ONNX_PATH, self.device, IMG2IMG_ONNX_THREADS, INPUT_SIZE,
+                verify=IMG2IMG_ONNX_VERIFY_ON_LOAD, min_cosine=IMG2IMG_ONNX_MIN_COSINE
+            )
+        elif IMG2IMG_INFERENCE_BACKEND != 'torch':
+            logger.warning(f"Unknown IMG2IMG_INFERENCE_BACKEND '{IMG2IMG_INFERENCE_BACKEND}', using PyTorch.")
+
+        # Cache theo nội dung ảnh; tag gắn với backbone + file trọng số đang dùng
+        self.cache = embedding_cache
+        self._cache_tag = f"img2img:{model_tag(IMG2IMG_BACKBONE, backbone_weight_path(IMG2IMG_BACKBONE))}"
+
+        # Request embed một ảnh từ nhiều thread -> gom thành batch trước khi vào backbone
+        self.batcher = None
+        if micro_batch and self.backbone is not None:
+            self.batcher = MicroBatcher(
+                "Img2Img_Backbone", self._forward_tensors,
+                max_batch_size=IMG2IMG_MICRO_BATCH_MAX_SIZE, max_wait_ms=IMG2IMG_MICRO_BATCH_MAX_WAIT_MS
+            )
+
+    def close(self):
+        """Dừng thread micro-batching (gọi khi shutdown)."""
+        if self.batcher is not None:
+            self.batcher.stop()
+
     # === PHIÊN BẢN MỚI: Đã loại bỏ logic load YOLO ===
     def load_models(self):
         with Timer("Img2Img Load Models"):
@@ -269,15 +302,7 @@ class Img2ImgService:
                 if 'ResNet' in IMG2IMG_BACKBONE:
                     if os.path.exists(RESNET_WEIGHT_PATH):
                         logger.info(f"Loading ResNet weights from {RESNET_WEIGHT_PATH}")
-                        ckpt = torch.load(RESNET_WEIGHT_PATH, map_location=self.device, weights_only=False)
-                        sd = ckpt.get('backbone_state_dict', ckpt)
-                        
-                        new_sd = OrderedDict()
-                        for k, v in sd.items():
-                            if k.startswith("module."): k = k[7:]
-                            new_sd[k] = v
-                        
-                        self.backbone.load_state_dict(new_sd, strict=False)
+                        load_backbone_checkpoint(self.backbone, RESNET_WEIGHT_PATH, self.device)
                         logger.info(f"ArcFace {IMG2IMG_BACKBONE} Loaded from {RESNET_WEIGHT_PATH}")
                     else:
                         logger.error(f"ResNet weights not found at {RESNET_WEIGHT_PATH}")
@@ -286,17 +311,7 @@ class Img2ImgService:
                 elif IMG2IMG_BACKBONE == 'ViT':
                     if os.path.exists(VIT_WEIGHT_PATH):
                         logger.info(f"Loading ViT weights from {VIT_WEIGHT_PATH}")
-                        ckpt = torch.load(VIT_WEIGHT_PATH, map_location=self.device, weights_only=False)
-                        sd = ckpt.get('backbone_state_dict', ckpt)
-                        if not isinstance(sd, dict):
-                            raise KeyError("Không tìm thấy 'backbone_state_dict' hợp lệ trong checkpoint ViT.")
-
-                        new_sd = OrderedDict()
-                        for k, v in sd.items():
-                            if k.startswith("module."): k = k[7:]
-                            new_sd[k] = v
-
-                        self.backbone.load_state_dict(new_sd, strict=False)
+                        load_backbone_checkpoint(self.backbone, VIT_WEIGHT_PATH, self.device)
                         logger.info(f"Fine-tuned ViT Loaded from {VIT_WEIGHT_PATH}")
                     else:
                         logger.error(f"ViT weights not found at {VIT_WEIGHT_PATH}.")
@@ -316,6 +331,26 @@ class Img2ImgService:
             raise ValueError("Cannot decode image bytes")
         return img_np
 
+    def _cache_namespace(self, stage: str, group: str = None) -> str:
+        """Vector phụ thuộc công đoạn (search không crop, index crop theo group)."""
+        return f"{self._cache_tag}:{stage}" + (f":{group}" if group else "")
+
+    def _cache_lookup(self, image_bytes, stage: str, group: str = None):
+        """Trả về (digest, entry hoặc None). Cache tắt -> (None, None)."""
+        if self.cache is None or image_bytes is None:
+            return None, None
+        digest = content_hash(image_bytes)
+        return digest, self.cache.get(self._cache_namespace(stage, group), digest)
+
+    def _save_cached_crop_for_debug(self, image_bytes, entry, product_id, image_id):
+        """Cache hit: chỉ decode + cắt theo crop_box đã lưu khi cần ghi ảnh debug (bỏ qua YOLO)."""
+        if not SAVE_CROPPED_IMAGES or entry.get("crop_box") is None:
+            return
+        x1, y1, x2, y2 = entry["crop_box"]
+        self._save_cropped_image_for_debug(
+            self._decode_image(image_bytes)[y1:y2, x1:x2], product_id, image_id, entry["crop_method"]
+        )
+
     def _save_cropped_image_for_debug(self, img_np, product_id, image_id, method_used):
         """
         Lưu ảnh đã crop vào thư mục chỉ định nếu config được bật.
@@ -349,28 +384,36 @@ class Img2ImgService:
         if self.backbone is None:
             raise RuntimeError("Backbone model is not loaded!")
 
-        # Chuyển ảnh sang Tensor
-        img_tensor = self.transform(img_pil).unsqueeze(0).to(self.device)
+        # Chuyển ảnh sang Tensor (làm ở thread của request, song song giữa các request)
+        img_tensor = self.transform(img_pil)
+
+        # Micro-batching: forward chung với các request đồng thời khác
+        if self.batcher is not None:
+            return self.batcher.run(img_tensor)
+
+        # Trả numpy float32 để dùng FAISS hoặc cosine similarity
+        return self._forward_batch(img_tensor.unsqueeze(0).to(self.device))[0]
+
+    def _forward_batch(self, batch) -> np.ndarray:
+        """Forward một tensor (N, C, H, W) -> (N, D) float32 đã chuẩn hóa L2."""
+        if self.onnx_backbone is not None:
+            feat = self.onnx_backbone(batch.cpu().numpy())
+            return (feat / (np.linalg.norm(feat, axis=1, keepdims=True) + 1e-12)).astype("float32")
 
         with torch.no_grad():
             # Nếu class có định nghĩa forward() → đây là FULL MODEL (VD: ResNet, ViT_EvoLVe)
             # thì dùng forward() để lấy embedding cuối.
-            if hasattr(self, "forward"):
-                feat = self.forward(img_tensor)
-
             # Nếu class này chỉ là "wrapper" có backbone riêng thì dùng backbone
-            else:
-                feat = self.backbone(img_tensor)
-
-            # Bỏ batch -> shape [C]
-            feat = feat.squeeze(0)
+            feat = self.forward(batch) if hasattr(self, "forward") else self.backbone(batch)
 
             # L2 Normalize trên torch
-            feat = feat / (feat.norm(p=2) + 1e-12)
-
-        # Trả numpy float32 để dùng FAISS hoặc cosine similarity
+            feat = feat / (feat.norm(p=2, dim=1, keepdim=True) + 1e-12)
         return feat.cpu().numpy().astype("float32")
 
+    def _forward_tensors(self, tensors: list) -> list:
+        """batch_fn của MicroBatcher: list tensor (C, H, W) -> list vector (D,)."""
+        return list(self._forward_batch(torch.stack(tensors).to(self.device)))
+
 
     # # --- LOGIC CHO KHÁCH HÀNG (SEARCH - SAU KHI CHỌN BOX) ---
     def process_image_for_search(self, image_bytes):
@@ -398,13 +441,19 @@ class Img2ImgService:
         }
         # Tên task cũng rõ ràng hơn
         with Timer("Indexing_Total", metadata=task_metadata) as t:
+            digest, cached = self._cache_lookup(image_bytes, "index", target_group)
+            t.metadata["cache"] = "hit" if cached else "miss"
+            if cached is not None:
+                self._save_cached_crop_for_debug(image_bytes, cached, product_id, image_id)
+                return cached["vector"], cached["crop_method"]
+
             img_np = self._decode_image(image_bytes)
 
             if not yolo_service or not yolo_service.model:
                 raise RuntimeError("YOLO service is not available.")
             
             with Timer("Indexing_Crop", metadata=task_metadata):
-                final_img_np, method_used = auto_crop_for_seller(
+                final_img_np, method_used, crop_box = auto_crop_for_seller(
                     yolo_service.model, img_np, target_group
                 )
             
@@ -420,10 +469,121 @@ class Img2ImgService:
             with Timer("Indexing_Extraction", metadata=task_metadata):
                 img_pil = Image.fromarray(cv2.cvtColor(img_padded, cv2.COLOR_BGR2RGB))
                 vector = self.extract_feature(img_pil)
-        
+
+            if digest is not None:
+                self.cache.put(self._cache_namespace("index", target_group), digest, vector,
+                               method_used, crop_box)
             logger.info(f"Indexing Done. Method: {method_used}")
             return vector, method_used
 
+    def extract_features_batch(self, img_pils) -> np.ndarray:
+        """Trích xuất feature cho nhiều ảnh trong MỘT lần forward. Trả về (N, D) đã chuẩn hóa L2."""
+        if self.backbone is None:
+            raise RuntimeError("Backbone model is not loaded!")
+
+        batch = torch.stack([self.transform(img) for img in img_pils]).to(self.device)
+        return self._forward_batch(batch)
+
+    def process_images_for_indexing(self, items: list) -> list:
+        """
+        Pipeline batch cho bulk indexing: Decode -> YOLO (1 lần cho cả batch) -> Crop -> Resize
+        -> Embed (1 lần forward).
+        items: list dict {"content": bytes (hoặc "image": ảnh BGR đã decode), "group", "product_id", "image_id"}
+        Trả về list dict cùng thứ tự: {"vector", "crop_method"} hoặc {"error"}.
+        Ảnh lỗi (decode / resize) chỉ đánh dấu lỗi, không làm hỏng cả batch.
+        Ảnh có "content" đã có trong embedding cache không đi qua YOLO / backbone.
+        """
+        task_metadata = {"service": "img2img", "action": "indexing", "batch": len(items)}
+        outputs = [{} for _ in items]
+        digests, crop_boxes = {}, {}
+        with Timer("BulkIndexing_Batch", metadata=task_metadata) as t:
+            decoded = []
+            for i, item in enumerate(items):
+                digest, cached = self._cache_lookup(item.get("content"), "index", item["group"])
+                if cached is not None:
+                    self._save_cached_crop_for_debug(item["content"], cached, item["product_id"], item["image_id"])
+                    outputs[i] = {"vector": cached["vector"], "crop_method": cached["crop_method"]}
+                    continue
+                if digest is not None:
+                    digests[i] = digest
+                try:
+                    img_np = item.get("image")
+                    decoded.append((i, img_np if img_np is not None else self._decode_image(item["content"])))
+                except ValueError as e:
+                    outputs[i]["error"] = str(e)
+            t.metadata["cache_hits"] = len(items) - len(decoded) - sum("error" in out for out in outputs)
+            if not decoded:
+                return outputs
+
+            if not yolo_service or not yolo_service.model:
+                raise RuntimeError("YOLO service is not available.")
+
+            with Timer("BulkIndexing_Crop", metadata=task_metadata):
+                crops = auto_crop_for_seller_batch(
+                    yolo_service.model, [img for _, img in decoded], [items[i]["group"] for i, _ in decoded]
+                )
+
+            rows, img_pils = [], []
+            with Timer("BulkIndexing_Resize", metadata=task_metadata):
+                for (i, _), (crop_np, method_used, crop_box) in zip(decoded, crops):
+                    outputs[i]["crop_method"] = method_used
+                    crop_boxes[i] = crop_box
+                    self._save_cropped_image_for_debug(crop_np, items[i]["product_id"], items[i]["image_id"], method_used)
+                    img_padded = resize_with_padding(crop_np, target_size=INPUT_SIZE)
+                    if img_padded is None:
+                        outputs[i]["error"] = "Resize failed"
+                        continue
+                    rows.append(i)
+                    img_pils.append(Image.fromarray(cv2.cvtColor(img_padded, cv2.COLOR_BGR2RGB)))
+
+            if img_pils:
+                with Timer("BulkIndexing_Extraction", metadata=task_metadata):
+                    vectors = self.extract_features_batch(img_pils)
+                for i, vector in zip(rows, vectors):
+                    outputs[i]["vector"] = vector
+                    if i in digests:
+                        self.cache.put(self._cache_namespace("index", items[i]["group"]), digests[i],
+                                       vector, outputs[i]["crop_method"], crop_boxes[i])
+        return outputs
+
+    def process_images_for_search(self, images: list):
+        """
+        Bản batch của process_image_for_search: Decode -> Resize từng ảnh -> MỘT lần forward.
+        Trả về (vectors (N, EMBEDDING_SIZE) float32, errors): errors[i] là chuỗi lỗi của ảnh i
+        (hàng tương ứng trong vectors là 0) hoặc None nếu thành công.
+        """
+        task_metadata = {"service": "img2img", "action": "search", "batch": len(images)}
+        vectors = np.zeros((len(images), EMBEDDING_SIZE), dtype=np.float32)
+        errors = [None] * len(images)
+        with Timer("Search_Embedding_Batch", metadata=task_metadata) as t:
+            rows, digests, img_pils = [], [], []
+            for i, image_bytes in enumerate(images):
+                digest, cached = self._cache_lookup(image_bytes, "search")
+                if cached is not None:
+                    vectors[i] = cached["vector"]
+                    continue
+                try:
+                    img_padded = resize_with_padding(self._decode_image(image_bytes), target_size=INPUT_SIZE)
+                    if img_padded is None:
+                        raise ValueError("Resize failed")
+                except Exception as e:
+                    # Lỗi của một ảnh (decode / resize / cv2) chỉ ghi vào errors[i], không làm hỏng cả batch
+                    errors[i] = str(e)
+                    continue
+                rows.append(i)
+                digests.append(digest)
+                img_pils.append(Image.fromarray(cv2.cvtColor(img_padded, cv2.COLOR_BGR2RGB)))
+            t.metadata["cache_hits"] = len(images) - len(rows) - sum(e is not None for e in errors)
+
+            if img_pils:
+                with Timer("Search_Extraction", metadata=task_metadata):
+                    features = self.extract_features_batch(img_pils)
+                vectors[rows] = features
+                for digest, vector in zip(digests, features):
+                    if digest is not None:
+                        self.cache.put(self._cache_namespace("search"), digest, vector)
+        return vectors, errors
+
     def detect_search_candidates(self, image_bytes):
         task_metadata = {
             "service": "img2img",
@@ -442,13 +602,20 @@ class Img2ImgService:
             "service": "img2img",
             "action": "search" 
         }
-        with Timer("Search_Embedding_Total", metadata=task_metadata):
+        with Timer("Search_Embedding_Total", metadata=task_metadata) as t:
+            digest, cached = self._cache_lookup(image_bytes, "search")
+            t.metadata["cache"] = "hit" if cached else "miss"
+            if cached is not None:
+                return cached["vector"]
+
             img_np = self._decode_image(image_bytes)
             with Timer("Search_Resize", metadata=task_metadata):
                 img_padded = resize_with_padding(img_np, target_size=INPUT_SIZE)
             with Timer("Search_Extraction", metadata=task_metadata):
                 img_pil = Image.fromarray(cv2.cvtColor(img_padded, cv2.COLOR_BGR2RGB))
                 vector = self.extract_feature(img_pil)
+            if digest is not None:
+                self.cache.put(self._cache_namespace("search"), digest, vector)
             return vector
 
     # def extract_feature(self, img_pil):
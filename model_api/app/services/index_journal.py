@@ -0,0 +1,228 @@
+# model_api/app/services/index_journal.py
+import base64
+import glob
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from app.utils.logger import logger
+
+
+class JournalDurabilityError(RuntimeError):
+    """Record chưa chắc đã nằm trên đĩa: fsync nền bị lỗi (đầy đĩa, EIO...) hoặc chờ quá timeout."""
+
+
+def encode_vector(vector) -> str:
+    """float32 vector -> base64 (gọn hơn nhiều so với list số trong JSON)."""
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_vector(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+
+class IndexJournal:
+    """
+    Write-ahead journal append-only cho các thao tác add/remove của index.
+    - Mỗi record là một dòng JSON có số thứ tự `seq` tăng dần, được fsync ngay khi ghi.
+    - Group commit (group_commit_window_s > 0): append chỉ ghi vào file (chưa fsync);
+      một thread nền gom mọi record trong cửa sổ và fsync MỘT lần cho cả nhóm.
+      Caller gọi wait_durable(seq) nếu cần chờ record thực sự nằm trên đĩa.
+    - Journal chia thành các segment `<path>.<n>`; khi snapshot, segment hiện tại được
+      đóng lại (rotate) và các segment cũ bị xóa sau khi snapshot ghi xong.
+    """
+    def __init__(self, path: str, group_commit_window_s: float = 0.0):
+        self.path = path
+        self._lock = threading.Lock()
+        # Tuần tự hóa fsync với rotate/close (fsync nằm ngoài _lock để append không bị chặn)
+        self._sync_lock = threading.Lock()
+        self._durable_cond = threading.Condition()
+        self._file = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        segments = self._list_segments()
+        self.last_seq = self._scan_last_seq(segments)
+        # Luôn mở segment mới khi khởi động để record mới không nằm sau một dòng bị ghi dở
+        self.segment = segments[-1] + 1 if segments else 1
+        self.pending = 0 # Số record chưa được gộp vào snapshot
+        self.durable_seq = self.last_seq # seq lớn nhất đã được fsync
+        # Lỗi fsync gần nhất và seq lớn nhất mà lần fsync đó lẽ ra phải xác nhận;
+        # các thread chờ record <= flush_error_seq sẽ nhận lỗi thay vì chờ vô hạn
+        self.flush_error = None
+        self.flush_error_seq = 0
+
+        self.group_commit_window_s = group_commit_window_s
+        self._flusher = None
+        if group_commit_window_s > 0:
+            self._wakeup = threading.Event()
+            self._stopped = False
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name=f"journal-flush-{os.path.basename(path)}", daemon=True
+            )
+            self._flusher.start()
+
+    # --- Segment helpers ---
+    def _segment_path(self, segment: int) -> str:
+        return f"{self.path}.{segment:06d}"
+
+    def _list_segments(self) -> list:
+        segments = []
+        for p in glob.glob(f"{glob.escape(self.path)}.*"):
+            suffix = p.rsplit(".", 1)[-1]
+            if suffix.isdigit():
+                segments.append(int(suffix))
+        return sorted(segments)
+
+    def _read_segment(self, segment: int):
+        """Đọc record của một segment; dừng ở dòng bị ghi dở (crash giữa lúc append)."""
+        with open(self._segment_path(segment), "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"[Journal] Torn record at {self._segment_path(segment)}:{line_no}, ignoring tail")
+                    return
+
+    def _scan_last_seq(self, segments: list) -> int:
+        last_seq = 0
+        for segment in segments:
+            for record in self._read_segment(segment):
+                last_seq = max(last_seq, record.get("seq", 0))
+        return last_seq
+
+    # --- API ---
+    def ensure_seq_at_least(self, seq: int):
+        """Đồng bộ seq với snapshot (khi mọi segment đã bị xóa sau lần snapshot trước)."""
+        with self._lock:
+            self.last_seq = max(self.last_seq, seq)
+
+    def append(self, record: dict) -> int:
+        """
+        Ghi 1 record. Trả về seq của record.
+        Không bật group commit: fsync ngay. Có group commit: fsync do thread nền làm theo nhóm.
+        """
+        with self._lock:
+            if self._file is None:
+                self._file = open(self._segment_path(self.segment), "ab")
+            seq = self.last_seq + 1
+            line = json.dumps({"seq": seq, **record}, ensure_ascii=False, separators=(",", ":"))
+            self._file.write(line.encode("utf-8") + b"\n")
+            self._file.flush()
+            if self._flusher is None:
+                os.fsync(self._file.fileno())
+            self.last_seq = seq
+            self.pending += 1
+        if self._flusher is None:
+            self._mark_durable(seq)
+        else:
+            self._wakeup.set()
+        return seq
+
+    # --- Group commit ---
+    def _mark_durable(self, seq: int):
+        with self._durable_cond:
+            if seq > self.durable_seq:
+                self.durable_seq = seq
+                self._durable_cond.notify_all()
+
+    def sync(self):
+        """fsync mọi record đã append; các thread đang wait_durable được đánh thức."""
+        with self._sync_lock:
+            with self._lock:
+                target_seq = self.last_seq
+                file = self._file
+            if target_seq <= self.durable_seq:
+                return
+            if file is not None:
+                try:
+                    # Ngoài _lock: các append mới vẫn ghi tiếp trong lúc fsync
+                    os.fsync(file.fileno())
+                except OSError as e:
+                    with self._durable_cond:
+                        self.flush_error = e
+                        self.flush_error_seq = max(self.flush_error_seq, target_seq)
+                        self._durable_cond.notify_all()
+                    raise
+            self._mark_durable(target_seq)
+
+    def wait_durable(self, seq: int, timeout: float = None) -> bool:
+        """
+        Chờ tới khi record `seq` đã được fsync. Trả về False nếu hết timeout.
+        fsync nền lỗi trong lúc chờ -> JournalDurabilityError (không chờ vô hạn).
+        """
+        with self._durable_cond:
+            durable = self._durable_cond.wait_for(
+                lambda: self.durable_seq >= seq or self.flush_error_seq >= seq, timeout
+            )
+            if self.durable_seq >= seq:
+                return True
+            if self.flush_error_seq >= seq:
+                raise JournalDurabilityError(
+                    f"Journal {self.path}: fsync failed before record {seq} was durable: {self.flush_error}"
+                ) from self.flush_error
+            return durable
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait()
+            if self._stopped:
+                return
+            # Gom thêm các record tới trong cửa sổ rồi fsync một lần cho cả nhóm
+            time.sleep(self.group_commit_window_s)
+            self._wakeup.clear()
+            try:
+                self.sync()
+            except Exception as e:
+                # sync() đã báo lỗi cho các thread đang wait_durable; append tiếp theo sẽ thử fsync lại
+                logger.error(f"[Journal] Group commit fsync failed for {self.path}: {e}")
+
+    def replay(self, after_seq: int = 0):
+        """Duyệt các record có seq > after_seq theo thứ tự."""
+        for segment in self._list_segments():
+            for record in self._read_segment(segment):
+                if record.get("seq", 0) > after_seq:
+                    yield record
+
+    def rotate(self):
+        """
+        Đóng segment hiện tại và chuyển sang segment mới.
+        Trả về (last_seq, segment vừa đóng) để snapshot ghi nhận và xóa segment sau đó.
+        """
+        with self._sync_lock, self._lock:
+            if self._file is not None:
+                if self._flusher is not None:
+                    os.fsync(self._file.fileno()) # Segment đóng lại phải bền trước khi snapshot tham chiếu
+                self._file.close()
+                self._file = None
+            closed_segment = self.segment
+            self.segment += 1
+            self.pending = 0
+            last_seq = self.last_seq
+        self._mark_durable(last_seq)
+        return last_seq, closed_segment
+
+    def drop_segments_through(self, segment: int):
+        """Xóa các segment <= segment (đã được gộp vào snapshot)."""
+        for s in self._list_segments():
+            if s <= segment:
+                try:
+                    os.remove(self._segment_path(s))
+                except OSError as e:
+                    logger.error(f"[Journal] Failed to remove segment {s}: {e}")
+
+    def close(self):
+        if self._flusher is not None:
+            self._stopped = True
+            self._wakeup.set()
+            self._flusher.join()
+            self.sync()
+        with self._sync_lock, self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -2,87 +2,554 @@
 import faiss
 import numpy as np
 import os
-import json
+import threading
+from app.config import (
+    IMG2IMG_JOURNAL_ENABLED, IMG2IMG_SNAPSHOT_DIRTY_THRESHOLD, IMG2IMG_SNAPSHOT_INTERVAL_S,
+    IMG2IMG_INDEX_TYPE, IMG2IMG_IVF_NLIST, IMG2IMG_PQ_M, IMG2IMG_PQ_NBITS,
+    IMG2IMG_HNSW_M, IMG2IMG_HNSW_EF_CONSTRUCTION,
+    IMG2IMG_DEFAULT_NPROBE, IMG2IMG_DEFAULT_EF_SEARCH, IMG2IMG_INDEX_AUTO_MIGRATE,
+    IMG2IMG_COLLAPSE_FETCH_FACTOR, IMG2IMG_COLLAPSE_GROWTH, IMG2IMG_COLLAPSE_MAX_ROUNDS,
+    IMG2IMG_FULL_VECTORS_ON_DISK, IMG2IMG_RERANK_FACTOR, IMG2IMG_INDEX_MMAP,
+    IMG2IMG_COMPACT_DELETED_RATIO, IMG2IMG_COMPACT_MIN_DELETED,
+    SEARCH_CACHE_ENABLED, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_S, SEARCH_CACHE_QUANT_STEP
+)
+from app.services.id_store import IdMapStore
+from app.services.index_journal import IndexJournal, encode_vector, decode_vector
+from app.services.snapshot import SnapshotScheduler, write_snapshot, load_snapshot
+from app.services.search_utils import collapse_search
+from app.services.vector_store import VectorStore, rerank_exact, exact_topk
+from app.services.segmented_index import SegmentedIndex, read_index_mmap
+from app.services.search_cache import SearchResultCache
+from app.utils.rwlock import ReadWriteLock
 from app.utils.logger import logger
 from app.utils.timer import Timer
 
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw_flat", "sq8", "fp16", "pq")
+IVF_INDEX_TYPES = ("ivf_flat", "ivf_pq")
+# Index chỉ giữ mã nén (score xấp xỉ) -> cần re-rank bằng vector gốc
+COMPRESSED_INDEX_TYPES = ("ivf_pq", "sq8", "fp16", "pq")
+# IndexPQ từ chối SearchParameters (kể cả IDSelector) -> lọc ID đã xóa / filter sau khi search
+POST_FILTER_INDEX_TYPES = ("pq",)
+SCALAR_QUANTIZER_TYPES = {"sq8": faiss.ScalarQuantizer.QT_8bit, "fp16": faiss.ScalarQuantizer.QT_fp16}
+# FAISS khuyến nghị tối thiểu ~39 điểm train cho mỗi centroid
+IVF_MIN_POINTS_PER_CENTROID = 39
+
 class IndexService:
-    def __init__(self, index_path, mapping_path, dim=512):
+    def __init__(self, index_path, mapping_path, dim=512, index_type=IMG2IMG_INDEX_TYPE,
+                 use_journal=IMG2IMG_JOURNAL_ENABLED, full_vectors=IMG2IMG_FULL_VECTORS_ON_DISK,
+                 mmap=IMG2IMG_INDEX_MMAP, result_cache=SEARCH_CACHE_ENABLED):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Index type '{index_type}' không được hỗ trợ. Chọn một trong: {INDEX_TYPES}")
+
         self.index_path = index_path
         self.mapping_path = mapping_path
         self.dim = dim
-        self.id_map = {} # Map: unique_int_id -> {"product_id": str, "image_id": str}
+        self.target_index_type = index_type # Loại index mong muốn (từ config)
+        self.index_type = "flat" # Loại index thực tế đang dùng
+        self.id_map = IdMapStore() # Map: unique_int_id -> (product_id, image_id), dạng cột NumPy
         self.next_id = 0 # Bộ đếm ID tự tăng
+        self.use_mmap = mmap # Base index read-only qua mmap + delta segment trong RAM
+        # Tăng sau mỗi add/remove/rebuild -> cache kết quả search cũ tự hết hiệu lực
+        self.generation = 0
+        # Tombstone: ID đã xóa khỏi id_map nhưng vector vẫn nằm trong index (lọc khi search),
+        # được xóa vật lý khi compact. mmap dùng cơ chế riêng của SegmentedIndex (deleted).
+        self._tombstones = set()
+        self._tombstone_selector = None
+        # Thay đổi xảy ra trong lúc compact (ngoài mutex) -> áp lại lên index đã compact
+        self._compaction_ops = None
+        self._compaction_thread = None
+        self.result_cache = SearchResultCache(
+            "img2img", SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_S, SEARCH_CACHE_QUANT_STEP
+        ) if result_cache else None
+        snapshot_seq = 0 # seq cuối cùng của journal đã nằm trong snapshot
+        vectors_in_snapshot = False # Snapshot đã kèm file vector float32 đầy đủ
 
-        # 1. Load hoặc Tạo Index mới
-        if os.path.exists(index_path):
-            try:
-                self.index = faiss.read_index(index_path)
-                logger.info(f"Loaded FAISS index from {index_path}")
-            except Exception as e:
-                logger.error(f"Error loading index: {e}")
-                self._create_new_index()
-        else:
-            self._create_new_index()
+        # Khóa 2 tầng:
+        # - _write_mutex: tuần tự hóa các writer (cấp ID, ghi journal + fsync, build index mới).
+        #   RLock vì _remove_ids có thể gọi rebuild_index.
+        # - _rwlock: search giữ read lock (nhiều search song song); writer chỉ giữ write lock
+        #   trong khoảng ngắn áp thay đổi vào RAM, không giữ khi fsync / ghi file.
+        self._write_mutex = threading.RLock()
+        self._rwlock = ReadWriteLock()
+        # Đảm bảo chỉ một snapshot được ghi tại một thời điểm
+        self._save_lock = threading.Lock()
+        self._prev_closed_segment = None
 
-        # 2. Load Mapping
-        if os.path.exists(mapping_path):
+        # 1 + 2. Load snapshot (Index + Mapping) đã kiểm tra checksum, hoặc tạo Index mới
+        index, data = load_snapshot(index_path, mapping_path, tag="Img2ImgIndex", mmap=mmap)
+        if index is not None:
+            self.index_type = self._detect_index_type(index)
+            # mmap: base không được ghi, mọi thay đổi đi vào delta segment
+            self.index = SegmentedIndex(index) if mmap else index
+            logger.info(f"Loaded FAISS index ({self.index_type}, mmap={mmap}) from {index_path}")
             try:
-                with open(mapping_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Convert key từ string về int
-                    self.id_map = {int(k): v for k, v in data.get("mapping", {}).items()}
-                    self.next_id = data.get("next_id", 0)
+                # Hỗ trợ cả format cột mới và format {"mapping": {...}} cũ
+                self.id_map = IdMapStore.from_dict(data)
+                self.next_id = data.get("next_id", 0)
+                snapshot_seq = data.get("journal_seq", 0)
+                vectors_in_snapshot = data.get("full_vectors", False)
+                self._restore_tombstones(data.get("tombstones", []))
                 logger.info(f"Loaded Mapping. Next ID: {self.next_id}")
             except Exception as e:
                 logger.error(f"Error loading mapping: {e}")
-                self.id_map = {}
+                self.id_map = IdMapStore()
                 self.next_id = 0
+        else:
+            self._create_new_index()
+
+        # 2b. Vector float32 đầy đủ trên đĩa (cho re-rank + rebuild chính xác)
+        self.vector_store = None
+        if full_vectors:
+            self.vector_store = VectorStore(os.path.splitext(index_path)[0] + ".vectors", dim)
+            if len(self.id_map) and (self.vector_store.created or not vectors_in_snapshot):
+                self._backfill_vector_store()
+
+        # 3. Journal: replay các thao tác xảy ra sau snapshot cuối cùng
+        self.journal = None
+        replayed = 0
+        if use_journal:
+            self.journal = IndexJournal(os.path.splitext(index_path)[0] + ".journal")
+            self.journal.ensure_seq_at_least(snapshot_seq)
+            replayed = self._replay_journal(snapshot_seq)
+
+        # 4. Migration: file index cũ (VD: flat) khác loại với config -> chuyển đổi
+        if self.index_type != self.target_index_type:
+            if IMG2IMG_INDEX_AUTO_MIGRATE:
+                logger.info(f"Migrating index {self.index_type} -> {self.target_index_type}")
+                self.migrate_index(self.target_index_type)
+            else:
+                logger.warning(
+                    f"Index on disk is '{self.index_type}' but config wants '{self.target_index_type}'. "
+                    f"Call rebuild_index() (POST /img2img/rebuild-index) to convert."
+                )
+
+        # 5. Thread nền ghi snapshot (gộp journal) theo chu kỳ / số thay đổi
+        self._snapshots = SnapshotScheduler(
+            "img2img", self.save,
+            interval_s=IMG2IMG_SNAPSHOT_INTERVAL_S,
+            dirty_threshold=IMG2IMG_SNAPSHOT_DIRTY_THRESHOLD
+        )
+        if replayed:
+            # Gộp các record vừa replay vào snapshot mới ở nền
+            self._snapshots.mark_dirty(replayed)
+        self._maybe_schedule_compaction()
 
     def _create_new_index(self):
         """Tạo index hỗ trợ ID tùy chỉnh"""
         logger.info(f"Creating a new, empty index at {self.index_path}")
-        quantizer = faiss.IndexFlatIP(self.dim)
-        self.index = faiss.IndexIDMap2(quantizer)
-        self.id_map = {}
+        # Index rỗng chưa có dữ liệu để train IVF -> luôn bắt đầu bằng flat,
+        # sau đó rebuild_index() khi catalog đủ lớn.
+        self.index, self.index_type = self._build_index("flat")
+        self.id_map = IdMapStore()
         self.next_id = 0
 
-    def add_item(self, vector, product_id: str, image_id: str):
-        """Thêm vector + metadata"""
+    def _build_index(self, index_type, train_vectors=None):
+        """
+        Tạo index rỗng theo loại yêu cầu (đã train nếu cần).
+        Trả về: (index, loại index thực tế). Nếu không đủ dữ liệu để train IVF/PQ
+        thì fallback về flat.
+        """
+        n_train = 0 if train_vectors is None else len(train_vectors)
+
+        if index_type == "hnsw_flat":
+            # HNSW không hỗ trợ add_with_ids -> bọc trong IndexIDMap2
+            hnsw = faiss.IndexHNSWFlat(self.dim, IMG2IMG_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            hnsw.hnsw.efConstruction = IMG2IMG_HNSW_EF_CONSTRUCTION
+            return faiss.IndexIDMap2(hnsw), "hnsw_flat"
+
+        if index_type in IVF_INDEX_TYPES:
+            nlist = min(IMG2IMG_IVF_NLIST, n_train // IVF_MIN_POINTS_PER_CENTROID)
+            min_pq_train = 2 ** IMG2IMG_PQ_NBITS
+            if nlist < 1 or (index_type == "ivf_pq" and n_train < min_pq_train):
+                logger.warning(f"Not enough vectors ({n_train}) to train '{index_type}'. Falling back to flat.")
+                return self._build_index("flat")
+
+            quantizer = faiss.IndexFlatIP(self.dim)
+            if index_type == "ivf_flat":
+                index = faiss.IndexIVFFlat(quantizer, self.dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            else:
+                if self.dim % IMG2IMG_PQ_M != 0:
+                    raise ValueError(f"IMG2IMG_PQ_M={IMG2IMG_PQ_M} phải chia hết cho dim={self.dim}")
+                index = faiss.IndexIVFPQ(
+                    quantizer, self.dim, nlist, IMG2IMG_PQ_M, IMG2IMG_PQ_NBITS, faiss.METRIC_INNER_PRODUCT
+                )
+
+            with Timer("Indexing_FAISS_Train", metadata={"service": "img2img", "index_type": index_type, "nlist": nlist}):
+                index.train(train_vectors)
+            # IVF hỗ trợ ID tùy chỉnh trực tiếp; Hashtable cho phép reconstruct/xóa theo ID
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+            return index, index_type
+
+        if index_type in SCALAR_QUANTIZER_TYPES or index_type == "pq":
+            if index_type == "pq":
+                if self.dim % IMG2IMG_PQ_M != 0:
+                    raise ValueError(f"IMG2IMG_PQ_M={IMG2IMG_PQ_M} phải chia hết cho dim={self.dim}")
+                codec = faiss.IndexPQ(self.dim, IMG2IMG_PQ_M, IMG2IMG_PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+                min_train = 2 ** IMG2IMG_PQ_NBITS
+            else:
+                codec = faiss.IndexScalarQuantizer(
+                    self.dim, SCALAR_QUANTIZER_TYPES[index_type], faiss.METRIC_INNER_PRODUCT
+                )
+                min_train = 1 if index_type == "sq8" else 0
+
+            if not codec.is_trained:
+                if n_train < min_train:
+                    logger.warning(f"Not enough vectors ({n_train}) to train '{index_type}'. Falling back to flat.")
+                    return self._build_index("flat")
+                with Timer("Indexing_FAISS_Train", metadata={"service": "img2img", "index_type": index_type}):
+                    codec.train(train_vectors)
+            return faiss.IndexIDMap2(codec), index_type
+
+        quantizer = faiss.IndexFlatIP(self.dim)
+        return faiss.IndexIDMap2(quantizer), "flat"
+
+    @staticmethod
+    def _detect_index_type(index):
+        """Xác định loại index của một object FAISS (dùng khi load file từ đĩa)."""
+        inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+        if isinstance(inner, faiss.IndexHNSWFlat):
+            return "hnsw_flat"
+        if isinstance(inner, faiss.IndexIVFPQ):
+            return "ivf_pq"
+        if isinstance(inner, faiss.IndexIVFFlat):
+            return "ivf_flat"
+        if isinstance(inner, faiss.IndexPQ):
+            return "pq"
+        if isinstance(inner, faiss.IndexScalarQuantizer):
+            return "sq8" if inner.sq.qtype == faiss.ScalarQuantizer.QT_8bit else "fp16"
+        return "flat"
+
+    @property
+    def is_loaded(self) -> bool:
+        """Index FAISS đã được load / tạo (dùng cho health check)."""
+        return self.index is not None
+
+    @property
+    def ntotal(self) -> int:
+        """Số vector còn hiệu lực (không tính tombstone)."""
+        return int(self.index.ntotal) - len(self._tombstones)
+
+    @property
+    def deleted_ratio(self) -> float:
+        total = int(self.index.ntotal)
+        return len(self._tombstones) / total if total else 0.0
+
+    @property
+    def rerank_enabled(self) -> bool:
+        return (self.vector_store is not None and IMG2IMG_RERANK_FACTOR > 0
+                and self.index_type in COMPRESSED_INDEX_TYPES)
+
+    def _backfill_vector_store(self):
+        """Tạo file vector float32 từ index hiện có (lần đầu bật tính năng / file bị mất)."""
+        if self.index_type in COMPRESSED_INDEX_TYPES:
+            logger.warning(
+                f"Index '{self.index_type}' is lossy: full-precision vectors are backfilled from "
+                f"compressed codes, re-ranking will only be exact for items indexed from now on."
+            )
+        store, self.vector_store = self.vector_store, None # _export_vectors đọc từ index
+        ids, vectors = self._export_vectors()
+        store.put(ids, vectors)
+        store.flush()
+        self.vector_store = store
+        logger.info(f"Backfilled {len(ids)} full-precision vectors into {store.path}")
+
+    def _export_vectors(self):
+        """
+        Lấy lại toàn bộ (ids, vectors) đang có trong index, theo thứ tự ID.
+        Ưu tiên file vector float32 đầy đủ; nếu không có thì reconstruct từ index
+        (với index nén, vector được giải nén từ mã nên chỉ là xấp xỉ).
+        """
+        ids = self.id_map.keys()
+        if len(ids) == 0:
+            return ids, np.empty((0, self.dim), dtype='float32')
+        if self.vector_store is not None:
+            return ids, self.vector_store.get(ids)
+        try:
+            vectors = self.index.reconstruct_batch(ids)
+        except RuntimeError:
+            # Map và index lệch nhau -> reconstruct từng ID, bỏ qua ID không còn trong index
+            kept_ids, kept_vectors = [], []
+            for int_id in ids:
+                try:
+                    kept_vectors.append(self.index.reconstruct(int(int_id)))
+                    kept_ids.append(int_id)
+                except RuntimeError:
+                    logger.warning(f"ID {int_id} missing from FAISS index, dropping its mapping")
+                    self.id_map.remove(int_id)
+            ids = np.array(kept_ids, dtype='int64')
+            vectors = np.array(kept_vectors, dtype='float32').reshape(-1, self.dim)
+        return ids, np.ascontiguousarray(vectors, dtype='float32')
+
+    def rebuild_index(self, index_type=None):
+        """
+        Train + build lại index từ các vector đang lưu (VD: flat -> ivf_flat khi catalog lớn).
+        Trả về thông tin index mới.
+        """
+        index_type = index_type or self.target_index_type
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Index type '{index_type}' không được hỗ trợ. Chọn một trong: {INDEX_TYPES}")
+
+        metadata = {"service": "img2img", "action": "rebuild", "index_type": index_type}
+        with self._write_mutex, Timer("Indexing_FAISS_Rebuild", metadata=metadata):
+            # Build index mới trong khi search vẫn chạy trên index cũ (writer khác bị chặn bởi mutex)
+            ids, vectors = self._export_vectors()
+            new_index, actual_type = self._build_index(index_type, vectors)
+            if len(ids) > 0:
+                new_index.add_with_ids(vectors, ids)
+
+            with self._rwlock.write_lock():
+                self.index = new_index
+                self.index_type = actual_type
+                # Index mới chỉ chứa ID còn trong id_map -> không còn tombstone
+                self._clear_tombstones()
+                self.generation += 1
+        logger.info(f"Rebuilt index as '{actual_type}' with {self.index.ntotal} vectors")
+        return {"index_type": actual_type, "ntotal": int(self.index.ntotal)}
+
+    def _index_from_vectors(self, ids, vectors):
+        """Build index cùng loại hiện tại từ (ids, vectors) - dùng khi gộp delta cho HNSW."""
+        index, _ = self._build_index(self.index_type, vectors)
+        if len(ids) > 0:
+            index.add_with_ids(vectors, ids)
+        return index
+
+    def migrate_index(self, index_type=None):
+        """Chuyển đổi index hiện tại (VD: file flat cũ) sang loại mới và lưu lại."""
+        info = self.rebuild_index(index_type)
+        self.save()
+        return info
+
+    def _remove_ids(self, ids_to_remove):
+        """
+        Xóa vector khỏi FAISS.
+        - mmap (SegmentedIndex): remove_ids chỉ ghi vào delta / tập deleted, vốn đã rẻ.
+        - Còn lại: chỉ đánh dấu tombstone (O(số ID xóa)), remove_ids trên IndexIDMap2 / IVF phải
+          dịch cả mảng vector còn HNSW phải rebuild; việc đó để compact() chạy ở nền.
+        """
+        if isinstance(self.index, SegmentedIndex):
+            self.index.remove_ids(np.array(ids_to_remove).astype('int64'))
+            return
+        self._tombstones.update(int(i) for i in ids_to_remove)
+        self._tombstone_selector = None
+
+    # --- Tombstone + compaction ---
+    def _restore_tombstones(self, tombstones):
+        """Tombstone lưu trong snapshot (index chưa compact khi ghi)."""
+        if not tombstones:
+            return
+        if isinstance(self.index, SegmentedIndex):
+            # Base mmap read-only -> để SegmentedIndex lọc, lần snapshot sau sẽ xóa vật lý
+            self.index.remove_ids(np.asarray(tombstones, dtype='int64'))
+        else:
+            self._tombstones = set(int(i) for i in tombstones)
+        logger.info(f"Restored {len(tombstones)} tombstones from snapshot")
+
+    def _clear_tombstones(self, ids=None):
+        if ids is None:
+            self._tombstones.clear()
+        else:
+            self._tombstones.difference_update(ids)
+        self._tombstone_selector = None
+
+    def _live_params(self, params):
+        """Không có filter của caller mà còn tombstone -> loại các ID đã xóa ngay trong lúc FAISS quét."""
+        if not self._tombstones or (params is not None and params.sel is not None):
+            # Filter theo group / shop (IDSelectorBitmap từ id_map) vốn đã bỏ qua ID đã xóa
+            return params
+        if self.index_type in POST_FILTER_INDEX_TYPES:
+            # Không gắn được selector: ID đã xóa không còn trong id_map (code -1) nên collapse_search tự bỏ qua
+            return params
+        if self._tombstone_selector is None:
+            dead = np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+            batch = faiss.IDSelectorBatch(dead)
+            selector = faiss.IDSelectorNot(batch)
+            selector.referenced = batch # Giữ batch sống cùng selector (SWIG không tự giữ)
+            self._tombstone_selector = selector
+        params = params or faiss.SearchParameters()
+        params.sel = self._tombstone_selector
+        return params
+
+    def _needs_compaction(self) -> bool:
+        return (len(self._tombstones) >= IMG2IMG_COMPACT_MIN_DELETED
+                and self.deleted_ratio >= IMG2IMG_COMPACT_DELETED_RATIO)
+
+    def _maybe_schedule_compaction(self):
+        """Gọi sau khi xóa: vượt ngưỡng -> compact bằng thread nền (tối đa một thread)."""
+        if not self._needs_compaction():
+            return
+        with self._write_mutex:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(target=self.compact, name="img2img-compact", daemon=True)
+            self._compaction_thread.start()
+
+    def compact(self):
+        """
+        Xóa vật lý các vector tombstone, search và writer vẫn chạy trong lúc compact:
+        1. Dưới mutex: chụp tập tombstone + copy index (hoặc export vector còn lại với HNSW).
+        2. Ngoài mutex: remove_ids / build index mới trên bản copy (phần O(n)),
+           add xảy ra trong lúc này được ghi lại vào _compaction_ops.
+        3. Dưới mutex + write lock: áp lại các add, đổi sang index mới, bỏ các tombstone đã xóa.
+        Tombstone phát sinh trong lúc compact vẫn giữ nguyên (vector của chúng vẫn nằm trong bản copy).
+        Trả về số vector đã xóa vật lý.
+        """
+        metadata = {"service": "img2img", "action": "compact", "index_type": self.index_type}
+        with Timer("Indexing_FAISS_Compact", metadata=metadata):
+            with self._write_mutex:
+                if not self._tombstones or isinstance(self.index, SegmentedIndex):
+                    return 0
+                source = self.index
+                dead = set(self._tombstones)
+                with self._rwlock.read_lock():
+                    if self.index_type == "hnsw_flat":
+                        # HNSW không hỗ trợ remove_ids -> build lại từ vector còn hiệu lực
+                        live_ids, live_vectors = self._export_vectors()
+                        compacted = None
+                    else:
+                        compacted = faiss.clone_index(source)
+                self._compaction_ops = []
+
+            try:
+                if compacted is None:
+                    compacted = self._index_from_vectors(live_ids, live_vectors)
+                else:
+                    compacted.remove_ids(np.fromiter(dead, dtype=np.int64, count=len(dead)))
+
+                with self._write_mutex:
+                    if self.index is not source: # rebuild_index đã thay index trong lúc compact
+                        logger.info("Index replaced during compaction, discarding compacted copy")
+                        return 0
+                    for ids, vectors in self._compaction_ops:
+                        compacted.add_with_ids(vectors, ids)
+                    with self._rwlock.write_lock():
+                        self.index = compacted
+                        self._clear_tombstones(dead)
+                        self.generation += 1
+            finally:
+                with self._write_mutex:
+                    self._compaction_ops = None
+
+        # Snapshot kế tiếp ghi index đã compact (file hiện tại vẫn đúng nhờ danh sách tombstone)
+        self._snapshots.mark_dirty()
+        logger.info(f"Compacted index: removed {len(dead)} deleted vectors, {self.ntotal} remaining")
+        return len(dead)
+
+    def _search_params(self, nprobe=None, ef_search=None):
+        """Tham số search theo từng request (nprobe cho IVF, efSearch cho HNSW)."""
+        if self.index_type in IVF_INDEX_TYPES:
+            return faiss.SearchParametersIVF(nprobe=nprobe or IMG2IMG_DEFAULT_NPROBE)
+        if self.index_type == "hnsw_flat":
+            return faiss.SearchParametersHNSW(efSearch=ef_search or IMG2IMG_DEFAULT_EF_SEARCH)
+        return None
+
+    # --- Áp dụng thay đổi vào RAM (dùng chung cho request và replay journal) ---
+    def _apply_add(self, int_ids, vectors, product_ids, image_ids, groups=None, shop_ids=None):
+        ids_np = np.asarray(int_ids, dtype='int64')
+        groups = groups or [None] * len(ids_np)
+        shop_ids = shop_ids or [None] * len(ids_np)
+        vectors_np = np.asarray(vectors, dtype='float32').reshape(len(ids_np), self.dim)
+        if self.vector_store is not None:
+            self.vector_store.put(ids_np, vectors_np)
+        self.index.add_with_ids(vectors_np, ids_np)
+        if self._compaction_ops is not None:
+            self._compaction_ops.append((ids_np, vectors_np.copy()))
+        for int_id, product_id, image_id, group, shop_id in zip(ids_np.tolist(), product_ids, image_ids, groups, shop_ids):
+            self.id_map.add(int_id, product_id, image_id, group=group, shop_id=shop_id)
+        self.generation += 1
+        self.next_id = max(self.next_id, int(ids_np.max()) + 1)
+
+    def _apply_remove(self, ids_to_remove):
+        for int_id in ids_to_remove:
+            self.id_map.remove(int_id)
+        self._remove_ids(ids_to_remove)
+        self.generation += 1
+
+    def _replay_journal(self, after_seq):
+        replayed = 0
+        with Timer("Indexing_Journal_Replay", metadata={"service": "img2img", "after_seq": after_seq}):
+            for record in self.journal.replay(after_seq):
+                op = record.get("op")
+                if op == "add":
+                    items = [it for it in record["items"] if it["id"] not in self.id_map]
+                    if items:
+                        self._apply_add(
+                            [it["id"] for it in items],
+                            np.stack([decode_vector(it["vector"]) for it in items]),
+                            [it["product_id"] for it in items],
+                            [it["image_id"] for it in items],
+                            [it.get("group") for it in items],
+                            [it.get("shop_id") for it in items]
+                        )
+                elif op == "remove":
+                    ids = [i for i in record["ids"] if i in self.id_map]
+                    if ids:
+                        self._apply_remove(ids)
+                replayed += 1
+        if replayed:
+            logger.info(f"Replayed {replayed} journal records (after seq {after_seq})")
+        return replayed
+
+    def _log(self, record: dict, count: int = 1):
+        """Ghi record vào journal (fsync) TRƯỚC khi áp dụng vào RAM, và báo cho snapshot scheduler."""
+        if self.journal is not None:
+            self.journal.append(record)
+        self._snapshots.mark_dirty(count)
+
+    def add_item(self, vector, product_id: str, image_id: str, group: str = None, shop_id: str = None):
+        """Thêm vector + metadata (group / shop_id dùng để lọc khi search)"""
         vector = np.array([vector]).astype('float32')
-        ids = np.array([self.next_id]).astype('int64')
         metadata = {
             "service": "img2img", 
             "action": "indexing"
             # "product_id": product_id, 
             # "image_id": image_id
         }
-        with Timer("Indexing_FAISS_Add", metadata=metadata):
-            self.index.add_with_ids(vector, ids)
+        with self._write_mutex:
+            int_id = self.next_id
+            self._log({"op": "add", "items": [{
+                "id": int_id, "product_id": product_id, "image_id": image_id,
+                "group": group, "shop_id": shop_id,
+                "vector": encode_vector(vector[0])
+            }]})
+            with self._rwlock.write_lock(), Timer("Indexing_FAISS_Add", metadata=metadata):
+                self._apply_add([int_id], vector, [product_id], [image_id], [group], [shop_id])
 
-        self.id_map[self.next_id] = {
-            "product_id": product_id,
-            "image_id": image_id
-        }
-        self.next_id += 1
+    def add_items(self, vectors, product_ids: list, image_ids: list, groups: list = None, shop_ids: list = None):
+        """Thêm nhiều vector trong MỘT record journal và MỘT lần giữ write lock (dùng cho bulk indexing)"""
+        vectors = np.asarray(vectors, dtype='float32').reshape(-1, self.dim)
+        n = len(vectors)
+        if n == 0:
+            return 0
+        groups = groups or [None] * n
+        shop_ids = shop_ids or [None] * n
+        metadata = {"service": "img2img", "action": "indexing", "batch": n}
+        with self._write_mutex:
+            int_ids = list(range(self.next_id, self.next_id + n))
+            self._log({"op": "add", "items": [
+                {
+                    "id": int_id, "product_id": product_id, "image_id": image_id,
+                    "group": group, "shop_id": shop_id, "vector": encode_vector(vector)
+                }
+                for int_id, vector, product_id, image_id, group, shop_id
+                in zip(int_ids, vectors, product_ids, image_ids, groups, shop_ids)
+            ]}, count=n)
+            with self._rwlock.write_lock(), Timer("Indexing_FAISS_Add", metadata=metadata):
+                self._apply_add(int_ids, vectors, product_ids, image_ids, groups, shop_ids)
+        return n
 
     def remove_list_images(self, product_id: str, image_ids: list):
         """Xóa danh sách nhiều ảnh của 1 sản phẩm (Batch Delete)"""
-        ids_to_remove = []
-        
-        # Duyệt map để tìm các ID cần xóa
-        # Lưu ý: Convert image_ids sang set để tìm kiếm O(1) nếu list dài
-        target_images = set(image_ids)
-        
-        for int_id, info in list(self.id_map.items()):
-            if info['product_id'] == product_id and info['image_id'] in target_images:
-                ids_to_remove.append(int_id)
-                del self.id_map[int_id]
+        with self._write_mutex:
+            # Reverse index: chỉ duyệt các ảnh của product_id này
+            ids_to_remove = self.id_map.ids_for_images(product_id, image_ids)
+            if ids_to_remove:
+                self._log({"op": "remove", "ids": ids_to_remove})
+                with self._rwlock.write_lock():
+                    self._apply_remove(ids_to_remove)
 
         if ids_to_remove:
-            ids_np = np.array(ids_to_remove).astype('int64')
-            self.index.remove_ids(ids_np)
             logger.info(f"Deleted batch: {len(ids_to_remove)} vectors for product {product_id}")
+            self._maybe_schedule_compaction()
             return len(ids_to_remove)
         
         logger.warning(f"No images found to delete for product {product_id}")
@@ -90,84 +557,259 @@ class IndexService:
 
     def remove_product(self, product_id: str):
         """Xóa toàn bộ ảnh của 1 sản phẩm"""
-        ids_to_remove = []
-        for int_id, info in list(self.id_map.items()):
-            if info['product_id'] == product_id:
-                ids_to_remove.append(int_id)
-                del self.id_map[int_id]
+        with self._write_mutex:
+            ids_to_remove = self.id_map.ids_for_product(product_id)
+            if ids_to_remove:
+                self._log({"op": "remove", "ids": ids_to_remove})
+                with self._rwlock.write_lock():
+                    self._apply_remove(ids_to_remove)
 
         if ids_to_remove:
-            ids_np = np.array(ids_to_remove).astype('int64')
-            self.index.remove_ids(ids_np)
             logger.info(f"Deleted product {product_id} ({len(ids_to_remove)} vectors)")
+            self._maybe_schedule_compaction()
             return len(ids_to_remove)
         return 0
 
+    def commit(self):
+        """
+        Gọi sau mỗi request thay đổi index.
+        Có journal: thay đổi đã được fsync khi ghi record -> snapshot để thread nền lo.
+        Không có journal: ghi snapshot ngay (đồng bộ) như trước.
+        """
+        if self.journal is None:
+            self._snapshots.flush()
+
     def save(self):
-        """Lưu Index và Map xuống đĩa"""
+        """Lưu snapshot Index và Map xuống đĩa, sau đó xóa phần journal đã được gộp"""
         metadata = {"service": "img2img", "action": "indexing"}
-        with Timer("Indexing_FAISS_Save", metadata=metadata):
+        with self._save_lock, Timer("Indexing_FAISS_Save", metadata=metadata):
             try:
-                # Lưu Index
-                faiss.write_index(self.index, self.index_path)
-                
-                # Lưu Map
-                data = {
-                    "next_id": self.next_id,
-                    "mapping": self.id_map
-                }
-                # Tạo thư mục cha nếu chưa có (đề phòng)
-                os.makedirs(os.path.dirname(self.mapping_path), exist_ok=True)
-                
-                with open(self.mapping_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
+                # Chụp trạng thái khi không có writer (search vẫn chạy song song), ghi file ngoài lock
+                segmented = None
+                with self._write_mutex, self._rwlock.read_lock():
+                    journal_seq, closed_segment = self.journal.rotate() if self.journal else (0, None)
+                    if self.use_mmap and not isinstance(self.index, SegmentedIndex):
+                        self.index = SegmentedIndex(self.index)
+                    if isinstance(self.index, SegmentedIndex):
+                        # Gộp base + delta thành index đầy đủ chỉ để serialize
+                        segmented = self.index
+                        index_bytes = faiss.serialize_index(segmented.begin_snapshot(self._index_from_vectors))
+                    else:
+                        index_bytes = faiss.serialize_index(self.index)
+                    # Vector gốc phải nằm trên đĩa trước khi snapshot đánh dấu journal_seq
+                    if self.vector_store is not None:
+                        self.vector_store.flush()
+                    # Lưu Map (dạng cột, không indent để file gọn)
+                    data = {
+                        "next_id": self.next_id,
+                        "journal_seq": journal_seq,
+                        "full_vectors": self.vector_store is not None,
+                        "tombstones": sorted(self._tombstones),
+                        **self.id_map.to_dict()
+                    }
+
+                # Ghi file tạm -> checksum -> rename (bản cũ giữ ở .prev), crash giữa chừng không làm hỏng index
+                try:
+                    write_snapshot(self.index_path, index_bytes, self.mapping_path, data)
+                except Exception:
+                    if segmented is not None:
+                        segmented.abort_snapshot()
+                    raise
+                del index_bytes
+
+                if segmented is not None:
+                    # mmap lại snapshot vừa ghi làm base mới; delta chỉ còn các thay đổi xảy ra trong lúc ghi
+                    new_base, _ = read_index_mmap(self.index_path)
+                    with self._write_mutex, self._rwlock.write_lock():
+                        if self.index is segmented: # rebuild_index có thể đã thay index trong lúc ghi
+                            self.index = segmented.rebase(new_base)
+
+                # Snapshot đã chứa mọi record <= journal_seq. Giữ lại journal của một thế hệ
+                # để nếu phải lùi về snapshot .prev thì vẫn replay đủ.
+                if closed_segment is not None:
+                    if self._prev_closed_segment is not None:
+                        self.journal.drop_segments_through(self._prev_closed_segment)
+                    self._prev_closed_segment = closed_segment
                 
                 logger.info("Index and Mapping saved successfully.")
+                return True
             except Exception as e:
                 logger.error(f"Failed to save index: {e}")
+                return False
+
+    def close(self, save: bool = True):
+        """Dừng thread nền và ghi snapshot cuối cùng (gọi khi shutdown). save=False: bỏ thay đổi chưa snapshot."""
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        self._snapshots.stop(flush=save)
+        if self.journal is not None:
+            self.journal.close()
 
-    def search(self, query_emb, k=20):
+    def _raw_search(self, queries, k, params=None):
+        if params is not None:
+            return self.index.search(queries, k, params=params)
+        return self.index.search(queries, k)
+
+    def search(self, query_emb, k=20, nprobe=None, ef_search=None, group=None, shop_id=None):
         if self.index.ntotal == 0: return []
+        return self.search_batch(np.array([query_emb]), k=k, nprobe=nprobe, ef_search=ef_search,
+                                 group=group, shop_id=shop_id)[0]
 
-        query_emb = np.array([query_emb]).astype('float32')
-        
-        # Lấy gấp 10 lần k để lọc trùng sản phẩm
-        fetch_k = min(k * 10, self.index.ntotal)
+    def search_batch(self, queries, k=20, nprobe=None, ef_search=None, group=None, shop_id=None):
+        """
+        Tìm kiếm N query trong MỘT lần gọi FAISS (tận dụng BLAS batch).
+        Trả về list N phần tử, mỗi phần tử là danh sách kết quả đã khử trùng sản phẩm.
+        """
+        return self.search_batch_collapsed(queries, k=k, nprobe=nprobe, ef_search=ef_search,
+                                           group=group, shop_id=shop_id)[0]
+
+    def search_batch_collapsed(self, queries, k=20, nprobe=None, ef_search=None, group=None, shop_id=None):
+        """
+        Search gom theo sản phẩm: mỗi sản phẩm chỉ giữ ảnh có điểm cao nhất.
+        Số hàng xóm lấy về được nới rộng dần cho tới khi đủ k sản phẩm khác nhau
+        (xem search_utils.collapse_search). Trả về (results, rounds) với rounds[i]
+        là số lượt search FAISS query i đã cần.
+        group / shop_id: chỉ quét các vector khớp (IDSelectorBitmap truyền vào FAISS).
+        Query đã có trong cache (cùng generation) không cần search lại.
+        """
+        queries = np.asarray(queries, dtype='float32').reshape(-1, self.dim)
+        if self.result_cache is None:
+            return self._search_uncached(queries, k, nprobe, ef_search, group, shop_id)
+
+        rows = self.result_cache.batch_lookup(
+            queries, (k, nprobe, ef_search, group, shop_id), self.generation,
+            lambda missing: list(zip(*self._search_uncached(missing, k, nprobe, ef_search, group, shop_id)))
+        )
+        return [results for results, _ in rows], [rounds for _, rounds in rows]
+
+    def _search_uncached(self, queries, k, nprobe, ef_search, group, shop_id):
+        # Read lock: nhiều search chạy song song, chỉ chờ khi writer đang áp thay đổi
+        with self._rwlock.read_lock():
+            return self._search_locked(queries, k, nprobe, ef_search, group, shop_id)
+
+    def _search_locked(self, queries, k, nprobe, ef_search, group, shop_id):
+        empty = [[] for _ in range(len(queries))], [0] * len(queries)
+        if self.index.ntotal == 0: return empty
+
+        selector, n_matching = self.id_map.selector_for(group, shop_id)
+        if n_matching == 0: return empty
+
+        ntotal = min(self.index.ntotal, n_matching)
+        fetch_factor = IMG2IMG_COLLAPSE_FETCH_FACTOR
+        lookup_codes = self.id_map.lookup_product_codes
+        params = self._search_params(nprobe, ef_search)
+        if self.index_type in POST_FILTER_INDEX_TYPES:
+            if selector is not None or self._tombstones:
+                # FAISS vẫn trả về ID đã xóa / không khớp filter (code -1, collapse_search bỏ qua)
+                # -> quét tới toàn bộ index và lấy dư theo tỉ lệ ID không khớp
+                ntotal = self.index.ntotal
+                fetch_factor *= -(-ntotal // n_matching)
+            if selector is not None:
+                mask = self.id_map.filter_mask(group, shop_id)
+                lookup_codes = lambda ids: self.id_map.lookup_product_codes(ids, mask)
+        elif selector is not None:
+            params = params or faiss.SearchParameters()
+            params.sel = selector
+        params = self._live_params(params)
         search_metadata = {
             "service": "img2img",
             "action": "search",
-            "k": k, 
-            "fetch_k": fetch_k
+            "k": k,
+            "n_queries": len(queries),
+            "index_type": self.index_type,
+            "filtered": selector is not None
         }
-        with Timer("Search_FAISS_Query", metadata=search_metadata):
-            # Search (Cosine Similarity dùng IndexFlatIP)
-            D, I = self.index.search(query_emb, fetch_k)
-        
-        unique_results = []
-        seen_product_ids = set()
-        
-        with Timer("Search_Result_Filter", metadata=search_metadata):
-            for rank, (idx, score) in enumerate(zip(I[0], D[0])):
-                if idx == -1: continue 
-                
-                info = self.id_map.get(idx)
-                if not info: continue
-                
-                p_id = info['product_id']
-                
-                # Chỉ lấy ảnh đại diện có điểm cao nhất của mỗi sản phẩm
-                if p_id not in seen_product_ids:
-                    seen_product_ids.add(p_id)
-                    
-                    unique_results.append({
-                        "product_id": p_id,
-                        "image_id": info['image_id'],
-                        "score": float(score),
-                        "rank": len(unique_results) + 1
-                    })
-                
-                # Kiểm tra điều kiện dừng với biến k
-                if len(unique_results) >= k:
-                    break
-                
-        return unique_results
+
+        rerank = self.rerank_enabled
+        search_metadata["rerank"] = rerank
+
+        def run_search(batch, fetch_k):
+            # Index nén: lấy thêm ứng viên rồi re-rank bằng vector float32 gốc
+            n_candidates = min(fetch_k * IMG2IMG_RERANK_FACTOR, ntotal) if rerank else fetch_k
+            with Timer("Search_FAISS_Query", metadata={**search_metadata, "fetch_k": n_candidates, "batch": len(batch)}):
+                # Search (Cosine Similarity - Inner Product)
+                D, I = self._raw_search(batch, n_candidates, params)
+            if not rerank:
+                return D, I
+            with Timer("Search_Rerank", metadata={**search_metadata, "candidates": n_candidates}):
+                return rerank_exact(batch, D, I, self.vector_store, fetch_k)
+
+        hits, rounds = collapse_search(
+            run_search, lookup_codes, queries, k, ntotal,
+            fetch_factor=fetch_factor,
+            growth=IMG2IMG_COLLAPSE_GROWTH,
+            max_rounds=IMG2IMG_COLLAPSE_MAX_ROUNDS
+        )
+
+        with Timer("Search_Result_Filter", metadata={**search_metadata, "max_rounds": max(rounds)}):
+            all_results = []
+            for D, I, codes, keep in hits:
+                all_results.append([
+                    {
+                        "product_id": self.id_map.product_id_of(codes[pos]),
+                        "image_id": self.id_map.image_id_at(I[pos]),
+                        "score": float(D[pos]),
+                        "rank": rank + 1
+                    }
+                    for rank, pos in enumerate(np.flatnonzero(keep))
+                ])
+
+        return all_results, rounds
+
+    def storage_report(self, sample_size=200, k=10, nprobe=None, ef_search=None):
+        """
+        Báo cáo bộ nhớ + recall của index hiện tại.
+        - Bộ nhớ: kích thước index serialize (≈ RAM) so với float32 thuần.
+        - Recall@k (theo ảnh, chưa gom sản phẩm): lấy ngẫu nhiên sample_size vector đã index
+          làm query, so top-k của index (có / không re-rank) với brute-force trên vector gốc.
+        """
+        with self._rwlock.read_lock():
+            return self._storage_report_locked(sample_size, k, nprobe, ef_search)
+
+    def _storage_report_locked(self, sample_size, k, nprobe, ef_search):
+        ntotal = self.ntotal
+        if isinstance(self.index, SegmentedIndex):
+            # Base nằm trong page cache (mmap, dùng chung giữa các worker) + delta trong RAM
+            index_bytes = (len(faiss.serialize_index(self.index.base))
+                           + len(faiss.serialize_index(self.index.delta)))
+        else:
+            index_bytes = len(faiss.serialize_index(self.index))
+        float32_bytes = ntotal * self.dim * 4
+        report = {
+            "index_type": self.index_type,
+            "ntotal": ntotal,
+            "index_bytes": index_bytes,
+            "bytes_per_vector": round(index_bytes / ntotal, 1) if ntotal else None,
+            "float32_bytes": float32_bytes,
+            "compression_ratio": round(float32_bytes / index_bytes, 2) if ntotal else None,
+            "mmap": isinstance(self.index, SegmentedIndex),
+            "full_vectors_on_disk": self.vector_store is not None,
+            "full_vectors_disk_bytes": self.vector_store.disk_bytes() if self.vector_store else 0,
+            "rerank_factor": IMG2IMG_RERANK_FACTOR if self.rerank_enabled else 0,
+            "tombstones": len(self._tombstones),
+            "deleted_ratio": round(self.deleted_ratio, 4),
+        }
+        if ntotal == 0 or self.vector_store is None:
+            return report
+
+        ids = self.id_map.keys()
+        k = min(k, len(ids))
+        rng = np.random.default_rng(0)
+        sample = rng.choice(ids, size=min(sample_size, len(ids)), replace=False)
+        queries = self.vector_store.get(sample)
+        params = self._live_params(self._search_params(nprobe, ef_search))
+
+        with Timer("Index_Storage_Report", metadata={"service": "img2img", "index_type": self.index_type, "sample": len(sample)}):
+            _, gt = exact_topk(queries, ids, self.vector_store, k)
+            _, approx = self._raw_search(queries, k, params)
+
+            def recall(found):
+                return float(np.mean([len(np.intersect1d(a, b)) / k for a, b in zip(found, gt)]))
+
+            report["recall_at_k"] = {"k": k, "sample_size": len(sample), "index": round(recall(approx), 4)}
+            if self.rerank_enabled:
+                n_candidates = min(k * IMG2IMG_RERANK_FACTOR, ntotal)
+                D, I = self._raw_search(queries, n_candidates, params)
+                _, reranked = rerank_exact(queries, D, I, self.vector_store, k)
+                report["recall_at_k"]["reranked"] = round(recall(reranked), 4)
+        return report
@@ -0,0 +1,124 @@
+# model_api/app/services/inference_pools.py
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import INFERENCE_DETECT_WORKERS, INFERENCE_EMBED_WORKERS, INFERENCE_INDEX_WORKERS, INFERENCE_MAX_QUEUE
+from app.utils.histogram import Histogram
+from app.utils.logger import logger
+
+QUEUE_WAIT_MS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000, 5000)
+RUN_MS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 5000)
+
+
+class PoolSaturatedError(RuntimeError):
+    """Hàng đợi của pool đã đầy -> route trả 503 để client thử lại sau."""
+    def __init__(self, pool_name: str, limit: int):
+        super().__init__(f"Inference pool '{pool_name}' is saturated ({limit} jobs pending)")
+        self.pool_name = pool_name
+
+
+class BoundedExecutor:
+    """
+    ThreadPoolExecutor có giới hạn hàng đợi:
+    - Tối đa max_workers job chạy cùng lúc, thêm tối đa max_queue job chờ;
+      vượt quá -> PoolSaturatedError ngay lúc submit (không chặn event loop, không phình RAM).
+    - Đếm số job đang chờ / đang chạy, histogram thời gian chờ và thời gian chạy (ms).
+    Route gọi `await pool.run(fn, *args)`: event loop rảnh trong lúc model / FAISS chạy.
+    """
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"{name}-pool")
+        self._lock = threading.Lock()
+        self._pending = 0 # đang chờ + đang chạy
+        self._active = 0
+
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_MS_BUCKETS)
+        self.run_ms = Histogram(RUN_MS_BUCKETS)
+        self.completed = 0
+        self.errors = 0
+        self.rejected = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Số job đã nhận nhưng chưa có thread chạy."""
+        with self._lock:
+            return self._pending - self._active
+
+    def _call(self, enqueued_at: float, fn, args, kwargs):
+        started = time.perf_counter()
+        self.queue_wait_ms.observe((started - enqueued_at) * 1000)
+        with self._lock:
+            self._active += 1
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            self.run_ms.observe((time.perf_counter() - started) * 1000)
+            with self._lock:
+                self._active -= 1
+                self._pending -= 1
+                self.completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        limit = self.max_workers + self.max_queue
+        with self._lock:
+            if self._pending >= limit:
+                self.rejected += 1
+                raise PoolSaturatedError(self.name, limit)
+            self._pending += 1
+        try:
+            future = self._executor.submit(self._call, time.perf_counter(), fn, args, kwargs)
+        except RuntimeError:
+            # Executor đã shutdown
+            self._release_pending()
+            raise
+        # Job bị hủy khi còn trong hàng đợi (client ngắt kết nối) -> _call không chạy, trả slot tại đây
+        future.add_done_callback(lambda f: self._release_pending() if f.cancelled() else None)
+        return future
+
+    def _release_pending(self):
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending, active = self._pending, self._active
+            completed, errors, rejected = self.completed, self.errors, self.rejected
+        return {
+            "name": self.name,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "active": active,
+            "queue_depth": pending - active,
+            "completed": completed,
+            "errors": errors,
+            "rejected": rejected,
+            "queue_wait_ms": self.queue_wait_ms.snapshot(),
+            "run_ms": self.run_ms.snapshot(),
+        }
+
+
+# --- Singleton: mỗi công đoạn một pool để YOLO chậm không chiếm hết thread của FAISS search ---
+detect_pool = BoundedExecutor("detect", INFERENCE_DETECT_WORKERS, INFERENCE_MAX_QUEUE)
+embed_pool = BoundedExecutor("embed", INFERENCE_EMBED_WORKERS, INFERENCE_MAX_QUEUE)
+index_pool = BoundedExecutor("index", INFERENCE_INDEX_WORKERS, INFERENCE_MAX_QUEUE)
+inference_pools = {pool.name: pool for pool in (detect_pool, embed_pool, index_pool)}
+
+
+def shutdown_inference_pools():
+    for pool in inference_pools.values():
+        pool.shutdown(wait=True)
+    logger.info("[InferencePools] All inference pools shut down.")
@@ -0,0 +1,114 @@
+# model_api/app/services/micro_batcher.py
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from app.utils.histogram import Histogram
+from app.utils.logger import logger
+from app.utils.timer import Timer
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+QUEUE_WAIT_MS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000)
+
+
+class MicroBatcher:
+    """
+    Gom các lời gọi đơn lẻ (mỗi request một ảnh) thành một batch cho model:
+    - Thread nền chờ request đầu tiên, sau đó gom thêm tới khi đủ max_batch_size
+      hoặc hết max_wait_ms (tính từ lúc request đầu tiên của batch vào hàng đợi).
+    - batch_fn(list input) -> list output cùng thứ tự, chạy MỘT lần cho cả batch;
+      kết quả / exception được trả về Future của từng caller.
+    - Histogram: kích thước batch và thời gian chờ trong hàng đợi (ms) của từng request.
+    """
+    def __init__(self, name: str, batch_fn, max_batch_size: int = 16, max_wait_ms: float = 2.0):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000.0
+
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_MS_BUCKETS)
+        self.batches = 0
+        self.errors = 0
+
+        self._queue = deque() # (input, future, thời điểm vào hàng đợi)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name=f"{name}-batcher", daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def submit(self, item) -> Future:
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError(f"[{self.name}] Micro-batcher is stopped")
+            self._queue.append((item, future, time.perf_counter()))
+            self._cond.notify()
+        return future
+
+    def run(self, item):
+        """Gửi một input và chờ kết quả (gọi từ thread của request)."""
+        return self.submit(item).result()
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._queue and not self._stopped:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            deadline = self._queue[0][2] + self.max_wait_s
+            while len(self._queue) < self.max_batch_size and not self._stopped:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(timeout=remaining)
+            return [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            for _, _, enqueued_at in batch:
+                self.queue_wait_ms.observe((started - enqueued_at) * 1000)
+            self.batch_sizes.observe(len(batch))
+            self.batches += 1
+
+            try:
+                with Timer(f"{self.name}_MicroBatch", metadata={"batch": len(batch)}):
+                    outputs = self.batch_fn([item for item, _, _ in batch])
+                if len(outputs) != len(batch):
+                    raise RuntimeError(f"batch_fn returned {len(outputs)} outputs for {len(batch)} inputs")
+            except Exception as e:
+                logger.error(f"[{self.name}] Micro-batch of {len(batch)} failed: {e}")
+                self.errors += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def stop(self):
+        """Dừng nhận request mới; các request đang chờ vẫn được xử lý hết."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout=10)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_s * 1000,
+            "batches": self.batches,
+            "errors": self.errors,
+            "queue_depth": self.queue_depth,
+            "batch_size": self.batch_sizes.snapshot(),
+            "queue_wait_ms": self.queue_wait_ms.snapshot(),
+        }
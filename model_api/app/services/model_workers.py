@@ -0,0 +1,356 @@
+# model_api/app/services/model_workers.py
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from app.config import MODEL_WORKER_PROCESSES, MODEL_WORKER_TORCH_THREADS, EMBEDDING_SIZE, TEXT2IMG_EMBEDDING_DIM
+from app.utils.logger import logger
+from app.utils.timer import Timer
+
+# Process worker nhận biết qua biến môi trường mang pid process điều phối (đặt trong start()).
+# Phải biết ngay lúc import: với spawn, worker có thể import lại __main__ của process cha
+# (VD `python -m app.main`) trước khi initializer chạy.
+_WORKER_ENV = "MODEL_WORKER_PARENT_PID"
+_IN_WORKER = os.environ.get(_WORKER_ENV) == str(os.getppid())
+_services = {}
+
+
+def use_model_workers() -> bool:
+    """True ở process FastAPI khi bật MODEL_WORKER_PROCESSES: không load model, chỉ điều phối."""
+    return MODEL_WORKER_PROCESSES > 0 and not _IN_WORKER
+
+
+# ==============================================================================
+# SHARED MEMORY: bytes ảnh / ảnh đã decode / vector đi qua một block, không pickle
+# ==============================================================================
+
+def _pack(payloads: list):
+    """
+    Ghi list payload (bytes hoặc ndarray) nối tiếp vào MỘT SharedMemory.
+    Trả về (block, specs); spec = (offset, nbytes, dtype, shape), dtype None nghĩa là bytes.
+    Process tạo block chịu trách nhiệm close + unlink.
+    """
+    specs, offset = [], 0
+    for payload in payloads:
+        if isinstance(payload, np.ndarray):
+            payload = np.ascontiguousarray(payload)
+            specs.append((offset, payload.nbytes, payload.dtype.str, payload.shape))
+        else:
+            specs.append((offset, len(payload), None, None))
+        offset += specs[-1][1]
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for payload, (start, nbytes, dtype, shape) in zip(payloads, specs):
+        if dtype is None:
+            block.buf[start:start + nbytes] = payload
+        else:
+            np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=start)[...] = payload
+    return block, specs
+
+
+def _unpack(name: str, specs: list) -> list:
+    """Đọc lại các payload (bản copy, để đóng block ngay mà không giữ con trỏ vào buffer)."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        payloads = []
+        for start, nbytes, dtype, shape in specs:
+            if dtype is None:
+                payloads.append(bytes(block.buf[start:start + nbytes]))
+            else:
+                payloads.append(np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=start).copy())
+        return payloads
+    finally:
+        block.close()
+
+
+def _write_vectors(name: str, shape: tuple, vectors):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        np.ndarray(shape, dtype=np.float32, buffer=block.buf)[...] = np.asarray(vectors, dtype=np.float32).reshape(shape)
+    finally:
+        block.close()
+
+
+def _release(block):
+    if block is not None:
+        block.close()
+        block.unlink()
+
+
+# ==============================================================================
+# PHÍA WORKER: mỗi process giữ một bộ model, nhận job qua ProcessPoolExecutor
+# ==============================================================================
+
+def _init_worker(torch_threads: int):
+    import torch
+    torch.set_num_threads(torch_threads)
+
+    from app.services.img2img_service import Img2ImgService
+    from app.services.txt2img_service import txt2img_service
+    # Worker chạy từng job một -> micro-batcher chỉ thêm độ trễ chờ batch
+    _services["img2img"] = Img2ImgService(micro_batch=False)
+    _services["txt2img"] = txt2img_service
+    logger.info(f"[ModelWorker] pid={os.getpid()} ready (torch threads: {torch_threads})")
+
+
+def _worker_status() -> dict:
+    img2img, txt2img = _services.get("img2img"), _services.get("txt2img")
+    from app.services.yolo_service import yolo_service
+    return {
+        "pid": os.getpid(),
+        "yolo": bool(yolo_service and yolo_service.model),
+        "backbone": bool(img2img and img2img.backbone is not None),
+        "txt2img": bool(txt2img and txt2img.model is not None),
+        "tokenizer": bool(txt2img and txt2img.tokenizer is not None),
+    }
+
+
+def _invoke(service: str, method: str, shm_in, kind: str, shm_out, layout: str, args: tuple, kwargs: dict):
+    """
+    Chạy getattr(service, method) với payload đọc từ shared memory.
+    kind: "one" (payload là tham số đầu), "many" (tham số đầu là list payload),
+          "items" (list dict, payload gắn lại vào key ghi trong args[0]).
+    layout: cách tách vector khỏi kết quả -> vector ghi vào shm_out, phần còn lại pickle trả về.
+    """
+    if shm_in is not None:
+        payloads = _unpack(*shm_in)
+        if kind == "one":
+            args = (payloads[0], *args)
+        elif kind == "many":
+            args = (payloads, *args)
+        else:
+            items, keys = args[0], args[1]
+            for item, key, payload in zip(items, keys, payloads):
+                item[key] = payload
+            args = (items, *args[2:])
+    result = getattr(_services[service], method)(*args, **kwargs)
+
+    if layout == "plain":
+        return result
+    if layout == "vector":
+        # None = service báo lỗi (VD embed_image trả None)
+        if result is None:
+            return False
+        _write_vectors(*shm_out, result)
+        return True
+    if layout == "vector_meta":
+        vector, meta = result
+        _write_vectors(*shm_out, vector)
+        return meta
+    if layout == "matrix_errors":
+        vectors, errors = result
+        _write_vectors(*shm_out, vectors)
+        return errors
+    # layout == "items": list dict {"vector", ...}; hàng không có vector giữ 0
+    name, shape = shm_out
+    matrix = np.zeros(shape, dtype=np.float32)
+    metas = []
+    for row, output in enumerate(result):
+        output = dict(output)
+        if output.get("vector") is not None:
+            matrix[row] = np.asarray(output.pop("vector")).reshape(-1)
+            output["has_vector"] = True
+        metas.append(output)
+    _write_vectors(name, shape, matrix)
+    return metas
+
+
+# ==============================================================================
+# PHÍA FASTAPI: điều phối job, không giữ model
+# ==============================================================================
+
+class ModelWorkerPool:
+    """
+    Pool process, mỗi process load YOLO + backbone img2img + PhoCLIP một lần (_init_worker).
+    Tiền / hậu xử lý (decode, YOLO NMS, OpenCV, PIL) chạy song song thật sự thay vì tranh GIL
+    trong một process. Input (bytes ảnh, ảnh đã decode) và vector output đi qua shared memory;
+    chỉ tham số nhỏ (tên method, group, id) và metadata kết quả được pickle.
+    call() chặn tới khi có kết quả -> gọi từ thread (inference pool), không gọi trên event loop.
+    """
+    def __init__(self, num_workers: int, torch_threads: int = 0):
+        self.num_workers = max(1, num_workers)
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // self.num_workers)
+        self._executor = None
+        self._status = None
+        self._start_lock = threading.Lock()
+
+    def start(self) -> dict:
+        """Spawn worker và chờ tất cả load xong model. Trả về trạng thái model (dùng cho health check)."""
+        with self._start_lock:
+            if self._executor is None:
+                self._spawn()
+        return self._status
+
+    def _spawn(self):
+        with Timer("ModelWorkers_Start", metadata={"workers": self.num_workers}):
+            # spawn: không fork process đang có thread (thread pool, snapshot, micro-batcher)
+            os.environ[_WORKER_ENV] = str(os.getpid())
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.torch_threads,),
+            )
+            statuses = [f.result() for f in [self._executor.submit(_worker_status) for _ in range(self.num_workers)]]
+        # Model coi là sẵn sàng khi đã load được ở worker trả lời
+        self._status = {key: all(s[key] for s in statuses) for key in ("yolo", "backbone", "txt2img", "tokenizer")}
+        logger.info(f"[ModelWorkers] {self.num_workers} workers up, pids={sorted({s['pid'] for s in statuses})}, "
+                    f"models={self._status}")
+
+    @property
+    def status(self) -> dict:
+        return self.start()
+
+    def call(self, service: str, method: str, *args, payloads=None, kind: str = "one",
+             out_shape: tuple = None, layout: str = "plain", **kwargs):
+        """
+        Gửi một job tới worker. payloads: list bytes / ndarray đặt vào shared memory.
+        out_shape: kích thước ma trận vector (float32) worker ghi trả. Trả về (vectors, metadata).
+        """
+        self.start()
+        in_block = out_block = None
+        try:
+            shm_in = None
+            if payloads is not None:
+                in_block, specs = _pack(payloads)
+                shm_in = (in_block.name, specs)
+            shm_out = None
+            if out_shape is not None:
+                out_block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(out_shape)) * 4, 1))
+                shm_out = (out_block.name, out_shape)
+
+            meta = self._executor.submit(_invoke, service, method, shm_in, kind, shm_out, layout, args, kwargs).result()
+            vectors = None
+            if out_block is not None:
+                vectors = np.ndarray(out_shape, dtype=np.float32, buffer=out_block.buf).copy()
+            return vectors, meta
+        finally:
+            _release(in_block)
+            _release(out_block)
+
+    def shutdown(self):
+        with self._start_lock:
+            if self._executor is None:
+                return
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            logger.info("[ModelWorkers] Worker processes stopped.")
+
+
+class RemoteImg2ImgService:
+    """Cùng interface với Img2ImgService (các method route / bulk indexer / reindex dùng), chạy ở worker."""
+    batcher = None
+
+    def __init__(self, pool: ModelWorkerPool):
+        self.pool = pool
+
+    @property
+    def backbone(self):
+        return self.pool.status["backbone"] or None
+
+    @property
+    def yolo_model(self):
+        return self.pool.status["yolo"] or None
+
+    def process_image_for_search(self, image_bytes):
+        # ValueError trong worker (VD: decode lỗi) được ProcessPoolExecutor raise lại ở đây
+        vectors, ok = self.pool.call("img2img", "process_image_for_search", payloads=[image_bytes],
+                                     out_shape=(EMBEDDING_SIZE,), layout="vector")
+        if not ok:
+            # Worker không tạo được vector -> ValueError để route trả 400 như khi chạy trong process
+            raise ValueError("Could not compute an embedding for this image")
+        return vectors
+
+    def process_image_for_indexing(self, image_bytes, target_group, product_id: str, image_id: str):
+        vectors, method_used = self.pool.call(
+            "img2img", "process_image_for_indexing", target_group, product_id, image_id,
+            payloads=[image_bytes], out_shape=(EMBEDDING_SIZE,), layout="vector_meta"
+        )
+        return vectors, method_used
+
+    def process_images_for_search(self, images: list):
+        return self.pool.call("img2img", "process_images_for_search", payloads=list(images), kind="many",
+                              out_shape=(len(images), EMBEDDING_SIZE), layout="matrix_errors")
+
+    def process_images_for_indexing(self, items: list) -> list:
+        # "content" (bytes) hoặc "image" (ảnh BGR đã decode) đi qua shared memory, phần còn lại pickle
+        keys = ["image" if item.get("image") is not None else "content" for item in items]
+        payloads = [item[key] for item, key in zip(items, keys)]
+        light_items = [{k: v for k, v in item.items() if k not in ("image", "content")} for item in items]
+        vectors, metas = self.pool.call(
+            "img2img", "process_images_for_indexing", light_items, keys,
+            payloads=payloads, kind="items", out_shape=(len(items), EMBEDDING_SIZE), layout="items"
+        )
+        outputs = []
+        for row, meta in enumerate(metas):
+            if meta.pop("has_vector", False):
+                meta["vector"] = vectors[row]
+            outputs.append(meta)
+        return outputs
+
+    def detect_search_candidates(self, image_bytes):
+        _, candidates = self.pool.call("img2img", "detect_search_candidates", payloads=[image_bytes])
+        return candidates
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class RemoteText2ImgService:
+    """Cùng interface với Text2ImgService; model PhoCLIP nằm ở worker."""
+    def __init__(self, pool: ModelWorkerPool):
+        self.pool = pool
+
+    @property
+    def model(self):
+        return self.pool.status["txt2img"] or None
+
+    @property
+    def tokenizer(self):
+        return self.pool.status["tokenizer"] or None
+
+    def embed_text(self, text: str):
+        # Text ngắn -> pickle trực tiếp, chỉ vector output đi qua shared memory
+        vectors, ok = self.pool.call("txt2img", "embed_text", text, out_shape=(1, TEXT2IMG_EMBEDDING_DIM),
+                                     layout="vector")
+        return vectors if ok else None
+
+    def embed_texts(self, texts: list):
+        return self.pool.call("txt2img", "embed_texts", list(texts), out_shape=(len(texts), TEXT2IMG_EMBEDDING_DIM),
+                              layout="matrix_errors")
+
+    def embed_image(self, image_data):
+        if isinstance(image_data, str):
+            with open(image_data, "rb") as f:
+                image_bytes = f.read()
+        else:
+            image_bytes = image_data.read()
+        vectors, ok = self.pool.call("txt2img", "embed_image", payloads=[image_bytes],
+                                     out_shape=(1, TEXT2IMG_EMBEDDING_DIM), layout="vector")
+        return vectors if ok else None
+
+    def embed_images(self, images: list):
+        payloads = []
+        for image_data in images:
+            if isinstance(image_data, (bytes, bytearray)):
+                payloads.append(bytes(image_data))
+            elif isinstance(image_data, str):
+                with open(image_data, "rb") as f:
+                    payloads.append(f.read())
+            else:
+                payloads.append(image_data.read())
+        return self.pool.call("txt2img", "embed_images", payloads=payloads, kind="many",
+                              out_shape=(len(images), TEXT2IMG_EMBEDDING_DIM), layout="matrix_errors")
+
+    def embed_image_tensors(self, image_tensors: np.ndarray):
+        vectors, ok = self.pool.call("txt2img", "embed_image_tensors",
+                                     payloads=[np.asarray(image_tensors, dtype=np.float32)],
+                                     out_shape=(len(image_tensors), TEXT2IMG_EMBEDDING_DIM), layout="vector")
+        return vectors if ok else None
+
+
+# --- Singleton: None = chạy model ngay trong process FastAPI (mặc định) ---
+model_worker_pool = ModelWorkerPool(MODEL_WORKER_PROCESSES, MODEL_WORKER_TORCH_THREADS) if MODEL_WORKER_PROCESSES > 0 else None
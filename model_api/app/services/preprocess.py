@@ -1,6 +1,6 @@
 import cv2
 import numpy as np
-from app.config import YOLO_CLASS_GROUPS, INPUT_SIZE, YOLO_CONF_THRESHOLD
+from app.config import YOLO_CLASS_GROUPS, INPUT_SIZE, YOLO_CONF_THRESHOLD, RGB_MEAN, RGB_STD
 
 # --- 1. CÁC HÀM CƠ BẢN (Resize, Center Crop) ---
 
@@ -37,25 +37,53 @@ def resize_with_padding(img_np, target_size=None, color=(255, 255, 255)):
     )
     return img_padded
 
+def build_clip_image_transform():
+    """
+    Transform ảnh cho image encoder của PhoCLIP (giống `transform_val` trong file training).
+    Tách ra đây để process con của reindex dùng được mà không phải load model.
+    """
+    from torchvision import transforms
+    return transforms.Compose([
+        transforms.Resize((INPUT_SIZE[0], INPUT_SIZE[1])),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=RGB_MEAN, std=RGB_STD)
+    ])
+
 def get_center_crop(img_np, crop_ratio=0.6):
     """
     Cắt lấy vùng trung tâm ảnh (Fallback khi YOLO thất bại).
     crop_ratio=0.8 nghĩa là lấy 80% ảnh ở giữa.
     """
+    x1, y1, x2, y2 = _center_crop_coords(img_np, crop_ratio)
+    # Cắt ảnh
+    return img_np[y1:y2, x1:x2]
+
+def _center_crop_coords(img_np, crop_ratio):
+    """Toạ độ [x1, y1, x2, y2] của vùng trung tâm (ảnh rỗng -> cả ảnh)."""
     h, w = img_np.shape[:2]
-    if h == 0 or w == 0: return img_np
+    if h == 0 or w == 0: return [0, 0, w, h]
 
     new_h = int(h * crop_ratio)
     new_w = int(w * crop_ratio)
     
     y1 = (h - new_h) // 2
     x1 = (w - new_w) // 2
-    
-    # Cắt ảnh
-    return img_np[y1 : y1+new_h, x1 : x1+new_w]
+    return [x1, y1, x1 + new_w, y1 + new_h]
+
+def _center_crop_with_box(img_np, crop_ratio):
+    coords = _center_crop_coords(img_np, crop_ratio)
+    x1, y1, x2, y2 = coords
+    return img_np[y1:y2, x1:x2], coords
+
+def _full_image_box(img_np):
+    h, w = img_np.shape[:2]
+    return [0, 0, w, h]
 
 # --- 2. LOGIC CHO NGƯỜI BÁN (SHOP - INDEXING) ---
 
+# Ngưỡng conf khi retry (pha 2) cho ảnh của người bán
+SELLER_LOW_CONF = 0.15
+
 def auto_crop_for_seller(yolo_model, img_np, target_group: str):
     """
     Logic thông minh cho người bán:
@@ -64,18 +92,19 @@ def auto_crop_for_seller(yolo_model, img_np, target_group: str):
     3. Nếu không thấy -> Hạ conf xuống 0.15 tìm lại (Lặp lại logic trên).
     4. Nếu vẫn không thấy -> Cắt 80% trung tâm (Center Crop).
     
-    Trả về: (cropped_img_np, method_used)
+    Trả về: (cropped_img_np, method_used, crop_box) với crop_box = [x1, y1, x2, y2] trong ảnh gốc.
     """
     if target_group not in YOLO_CLASS_GROUPS:
         # Nếu group không hợp lệ hoặc là 'none', dùng ảnh gốc resize (hoặc center crop tùy ý)
         # Ở đây trả về ảnh gốc để giữ nguyên context nếu user chọn None
-        return img_np, "original"
+        return img_np, "original", _full_image_box(img_np)
 
     # === PHA 1: Thử với Confidence chuẩn (YOLO_CONF_THRESHOLD) ===
     # 1.1 Tìm chính xác group (VD: full_body -> tìm dress, jumpsuit)
     best_box = _find_best_box(yolo_model, img_np, target_group, conf=YOLO_CONF_THRESHOLD)
     if best_box is not None:
-        return _crop_by_box(img_np, best_box), f"yolo_high_conf_{target_group}"
+        crop, box = _crop_by_box(img_np, best_box)
+        return crop, f"yolo_high_conf_{target_group}", box
 
     # 1.2 [LOGIC MỚI] Nếu là full_body mà không thấy dress/jumpsuit -> Thử Merge Upper + Lower
     if target_group == "full_body":
@@ -83,16 +112,17 @@ def auto_crop_for_seller(yolo_model, img_np, target_group: str):
         lower_box = _find_best_box(yolo_model, img_np, "lower_body", conf=YOLO_CONF_THRESHOLD)
         
         if upper_box is not None and lower_box is not None:
-            merged_coords = _merge_boxes(upper_box, lower_box)
-            return _crop_by_coords(img_np, merged_coords), "yolo_high_conf_merged_full"
+            crop, box = _crop_by_coords(img_np, _merge_boxes(upper_box, lower_box))
+            return crop, "yolo_high_conf_merged_full", box
 
     # === PHA 2: Thử với Confidence thấp (Retry - 0.15) ===
-    LOW_CONF = 0.15
+    LOW_CONF = SELLER_LOW_CONF
     
     # 2.1 Tìm chính xác group
     best_box_retry = _find_best_box(yolo_model, img_np, target_group, conf=LOW_CONF)
     if best_box_retry is not None:
-        return _crop_by_box(img_np, best_box_retry), f"yolo_low_conf_{target_group}"
+        crop, box = _crop_by_box(img_np, best_box_retry)
+        return crop, f"yolo_low_conf_{target_group}", box
 
     # 2.2 [LOGIC MỚI] Retry Merge cho full_body
     if target_group == "full_body":
@@ -100,11 +130,71 @@ def auto_crop_for_seller(yolo_model, img_np, target_group: str):
         lower_box = _find_best_box(yolo_model, img_np, "lower_body", conf=LOW_CONF)
         
         if upper_box is not None and lower_box is not None:
-            merged_coords = _merge_boxes(upper_box, lower_box)
-            return _crop_by_coords(img_np, merged_coords), "yolo_low_conf_merged_full"
+            crop, box = _crop_by_coords(img_np, _merge_boxes(upper_box, lower_box))
+            return crop, "yolo_low_conf_merged_full", box
 
     # === PHA 3: Đường cùng -> Center Crop 80% ===
-    return get_center_crop(img_np, crop_ratio=0.8), "center_crop_fallback"
+    crop, box = _center_crop_with_box(img_np, crop_ratio=0.8)
+    return crop, "center_crop_fallback", box
+
+
+def auto_crop_for_seller_batch(yolo_model, imgs, target_groups):
+    """
+    Phiên bản batch của auto_crop_for_seller (dùng cho bulk indexing):
+    YOLO chỉ chạy MỘT lần cho cả batch ở conf thấp nhất (LOW_CONF); box của pha conf chuẩn
+    được lọc lại từ cùng kết quả đó thay vì detect lại. Thứ tự ưu tiên giống hệt bản đơn.
+
+    Trả về: list (cropped_img_np, method_used, crop_box) cùng thứ tự với imgs.
+    """
+    outputs = [None] * len(imgs)
+    detect_rows = []
+    for i, group in enumerate(target_groups):
+        if group in YOLO_CLASS_GROUPS:
+            detect_rows.append(i)
+        else:
+            outputs[i] = (imgs[i], "original", _full_image_box(imgs[i]))
+
+    if detect_rows:
+        results = yolo_model([imgs[i] for i in detect_rows], conf=SELLER_LOW_CONF, verbose=False)
+        for i, result in zip(detect_rows, results):
+            outputs[i] = _crop_from_detections(imgs[i], result.boxes, target_groups[i])
+    return outputs
+
+
+def _crop_from_detections(img_np, boxes, target_group):
+    """
+    Áp logic High conf -> Low conf -> Center Crop lên các box đã detect sẵn.
+    Trả về (cropped_img_np, method_used, crop_box).
+    """
+    for conf, tag in ((YOLO_CONF_THRESHOLD, "high"), (SELLER_LOW_CONF, "low")):
+        best_box = _best_box_in(boxes, target_group, conf)
+        if best_box is not None:
+            crop, box = _crop_by_box(img_np, best_box)
+            return crop, f"yolo_{tag}_conf_{target_group}", box
+
+        if target_group == "full_body":
+            upper_box = _best_box_in(boxes, "upper_body", conf)
+            lower_box = _best_box_in(boxes, "lower_body", conf)
+            if upper_box is not None and lower_box is not None:
+                crop, box = _crop_by_coords(img_np, _merge_boxes(upper_box, lower_box))
+                return crop, f"yolo_{tag}_conf_merged_full", box
+
+    crop, box = _center_crop_with_box(img_np, crop_ratio=0.8)
+    return crop, "center_crop_fallback", box
+
+
+def _best_box_in(boxes, group, conf):
+    """Giống _find_best_box nhưng chọn trong các box đã có (chỉ giữ box có score >= conf)"""
+    class_indices = YOLO_CLASS_GROUPS[group]
+    best_conf = -1
+    best_box = None
+    for box in boxes:
+        cls_id = int(box.cls[0].item())
+        conf_score = float(box.conf[0].item())
+        if cls_id in class_indices and conf_score >= conf and conf_score > best_conf:
+            best_conf = conf_score
+            best_box = box
+    return best_box
 
 
 def _find_best_box(model, img, group, conf):
@@ -140,16 +230,16 @@ def _merge_boxes(box1, box2):
     return [x1, y1, x2, y2]
 
 def _crop_by_coords(img, coords):
-    """Cắt ảnh theo toạ độ list [x1, y1, x2, y2]"""
+    """Cắt ảnh theo toạ độ list [x1, y1, x2, y2]. Trả về (ảnh crop, toạ độ đã kẹp trong khung hình)"""
     x1, y1, x2, y2 = coords
     h, w = img.shape[:2]
     # Kẹp tọa độ trong khung hình
     x1, y1 = max(0, x1), max(0, y1)
     x2, y2 = min(w, x2), min(h, y2)
-    return img[y1:y2, x1:x2]
+    return img[y1:y2, x1:x2], [x1, y1, x2, y2]
 
 def _crop_by_box(img, box):
-    """Hàm phụ trợ cắt ảnh theo box YOLO object"""
+    """Hàm phụ trợ cắt ảnh theo box YOLO object. Trả về (ảnh crop, toạ độ)"""
     coords = list(map(int, box.xyxy[0].tolist()))
     return _crop_by_coords(img, coords)
 
@@ -0,0 +1,87 @@
+# model_api/app/services/search_cache.py
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SearchResultCache:
+    """
+    Cache LRU + TTL cho kết quả search.
+    - Key = hash của vector query đã lượng tử hóa (các query gần như trùng nhau dùng chung entry)
+      + các tham số ảnh hưởng kết quả (k, filter, nprobe...).
+    - Mỗi entry ghi lại generation của index lúc tính; index đổi generation (add/remove)
+      -> entry cũ bị coi là miss, không bao giờ trả kết quả cũ.
+    """
+    def __init__(self, name: str, max_entries: int = 2048, ttl_s: float = 300, quant_step: float = 1e-3):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.quant_step = quant_step
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, vector, params: tuple) -> bytes:
+        quantized = np.round(np.asarray(vector, dtype=np.float32) / self.quant_step).astype(np.int32)
+        h = hashlib.blake2b(quantized.tobytes(), digest_size=16)
+        h.update(repr(params).encode("utf-8"))
+        return h.digest()
+
+    def get(self, key: bytes, generation: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expires_at, value = entry
+                if entry_generation == generation and expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: bytes, generation: int, value):
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic() + self.ttl_s, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def batch_lookup(self, queries: np.ndarray, params: tuple, generation: int, compute_fn):
+        """
+        Tra cache cho từng hàng của ma trận query; chỉ các hàng miss được gửi vào
+        compute_fn(sub_queries) -> list kết quả (cùng thứ tự). Trả về list kết quả đủ N hàng.
+        """
+        keys = [self.make_key(q, params) for q in queries]
+        results = [self.get(key, generation) for key in keys]
+        missing = [i for i, value in enumerate(results) if value is None]
+        if missing:
+            computed = compute_fn(queries[missing])
+            for i, value in zip(missing, computed):
+                results[i] = value
+                self.put(keys[i], generation, value)
+        return results
@@ -0,0 +1,74 @@
+# model_api/app/services/search_utils.py
+import numpy as np
+
+
+def first_unique_per_row(codes: np.ndarray, k: int) -> np.ndarray:
+    """
+    Khử trùng sản phẩm cho nhiều query cùng lúc (vector hóa bằng NumPy).
+    - codes: ma trận (n_queries, n_hits) mã sản phẩm theo thứ tự score giảm dần, -1 = bỏ qua.
+    - Trả về mask bool cùng shape: giữ lần xuất hiện ĐẦU TIÊN (score cao nhất) của mỗi
+      sản phẩm trong từng hàng, tối đa k phần tử mỗi hàng.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    n_rows, n_cols = codes.shape
+    keep = np.zeros(codes.size, dtype=bool)
+
+    valid = codes >= 0
+    if valid.any():
+        # Ghép (hàng, mã) thành một khóa duy nhất để np.unique xử lý tất cả hàng trong 1 lần
+        stride = int(codes.max()) + 1
+        rows = np.arange(n_rows, dtype=np.int64)[:, None]
+        keys = (rows * stride + codes).ravel()
+        valid_pos = np.flatnonzero(valid.ravel())
+        _, first = np.unique(keys[valid_pos], return_index=True)
+        keep[valid_pos[first]] = True
+
+    keep = keep.reshape(n_rows, n_cols)
+    keep &= np.cumsum(keep, axis=1) <= k
+    return keep
+
+
+def collapse_search(search_fn, lookup_codes, queries: np.ndarray, k: int, ntotal: int,
+                    fetch_factor: int = 4, growth: int = 4, max_rounds: int = 5):
+    """
+    Tìm kiếm gom theo sản phẩm (product-collapsed) với over-fetch thích ứng.
+    Thay vì cố định k*10, bắt đầu lấy k*fetch_factor hàng xóm; các query chưa đủ
+    k sản phẩm khác nhau được search lại với fetch_k nhân growth cho tới khi:
+    đủ k sản phẩm, index đã cạn (fetch_k >= ntotal / FAISS trả -1) hoặc hết max_rounds.
+
+    - search_fn(queries, fetch_k) -> (D, I)
+    - lookup_codes(I) -> ma trận mã sản phẩm (-1 = bỏ qua)
+    Trả về (hits, rounds): hits[i] = (D_row, I_row, codes_row, keep_row) của query i,
+    rounds[i] = số lần search query i cần. k <= 0 -> hàng rỗng, không gọi search_fn.
+    """
+    n_queries = len(queries)
+    if k <= 0 or ntotal <= 0:
+        # Không cần search: mỗi query một hàng rỗng (tránh FAISS search với k = 0)
+        empty = (np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64),
+                 np.empty(0, dtype=np.int32), np.empty(0, dtype=bool))
+        return [empty] * n_queries, [0] * n_queries
+
+    hits = [None] * n_queries
+    rounds = [0] * n_queries
+    pending = np.arange(n_queries)
+    fetch_k = min(max(k * fetch_factor, k), ntotal)
+    round_no = 0
+
+    while len(pending) > 0:
+        round_no += 1
+        D, I = search_fn(queries[pending], fetch_k)
+        codes = lookup_codes(I)
+        keep = first_unique_per_row(codes, k)
+
+        exhausted = fetch_k >= ntotal or round_no >= max_rounds
+        # FAISS trả -1 ở cuối hàng khi không còn ứng viên (VD: IVF chỉ quét nprobe cluster)
+        done = (keep.sum(axis=1) >= k) | (I[:, -1] < 0) | exhausted
+        for j in np.flatnonzero(done):
+            row = int(pending[j])
+            hits[row] = (D[j], I[j], codes[j], keep[j])
+            rounds[row] = round_no
+
+        pending = pending[~done]
+        fetch_k = min(fetch_k * growth, ntotal)
+
+    return hits, rounds
@@ -0,0 +1,246 @@
+# model_api/app/services/segmented_index.py
+import faiss
+import numpy as np
+
+from app.utils.logger import logger
+
+# Thứ tự thử khi đọc index bằng mmap:
+# - MMAP_IFC: map trực tiếp mảng code của IndexFlat / SQ / PQ / HNSW storage
+# - MMAP: map inverted lists của IVF
+MMAP_FLAGS = (
+    faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY,
+    faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+)
+
+
+def read_index_mmap(path: str):
+    """
+    Đọc index ở chế độ memory-mapped, read-only: dữ liệu vector nằm trong page cache
+    của OS và được chia sẻ giữa các process (uvicorn workers) thay vì copy vào heap.
+    Trả về (index, mmapped). Loại index không hỗ trợ mmap -> đọc bình thường.
+    """
+    for flags in MMAP_FLAGS:
+        try:
+            return faiss.read_index(path, flags), True
+        except RuntimeError as e:
+            logger.debug(f"[MMap] read_index({path}, flags={flags}) failed: {e}")
+    logger.warning(f"[MMap] Index {path} cannot be memory-mapped, loading into RAM")
+    return faiss.read_index(path), False
+
+
+def supports_search_params(index) -> bool:
+    """
+    IndexPQ (flat PQ) từ chối mọi SearchParameters khi search ("invalid search params"),
+    kể cả chỉ có IDSelector -> với loại này phải lọc ID sau khi search.
+    """
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return not isinstance(inner, faiss.IndexPQ)
+
+
+class SegmentedIndex:
+    """
+    Index gồm 3 phần, dùng thay cho một index FAISS thông thường khi base được mmap:
+    - base: index read-only (mmap, KHÔNG BAO GIỜ được ghi - FAISS sẽ abort nếu ghi vào vùng mmap)
+    - delta: IndexIDMap2(IndexFlatIP) nhỏ trong RAM chứa vector mới thêm sau snapshot
+    - deleted: tập ID của base đã bị xóa (lọc bằng IDSelector khi search)
+    Khi ghi snapshot, 3 phần được gộp lại (materialize) thành một index bình thường.
+    """
+    def __init__(self, base, metric=faiss.METRIC_INNER_PRODUCT):
+        self.base = base
+        self.d = base.d
+        self.metric = metric
+        self.delta = faiss.IndexIDMap2(faiss.IndexFlat(self.d, metric))
+        self.delta_ids = set()
+        self.deleted = set()
+        self._deleted_selector = None
+        # Base không nhận SearchParameters (PQ) -> lọc deleted sau khi search
+        self.base_filterable = supports_search_params(base)
+        # Thao tác xảy ra sau begin_snapshot() -> dùng để áp lại lên base mới (rebase)
+        self._ops = None
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal - len(self.deleted) + self.delta.ntotal
+
+    @property
+    def is_trained(self) -> bool:
+        return True
+
+    # --- Thay đổi (chỉ tác động lên delta / deleted) ---
+    def add_with_ids(self, x, ids):
+        x = np.ascontiguousarray(x, dtype=np.float32).reshape(-1, self.d)
+        ids = np.asarray(ids, dtype=np.int64)
+        self.delta.add_with_ids(x, ids)
+        self.delta_ids.update(ids.tolist())
+        if self._ops is not None:
+            self._ops.append(("add", x.copy(), ids.copy()))
+
+    def remove_ids(self, ids) -> int:
+        ids = np.asarray(ids, dtype=np.int64)
+        in_delta = [i for i in ids.tolist() if i in self.delta_ids]
+        if in_delta:
+            self.delta.remove_ids(np.array(in_delta, dtype=np.int64))
+            self.delta_ids.difference_update(in_delta)
+        in_base = [i for i in ids.tolist() if i not in self.deleted and i not in in_delta]
+        if in_base:
+            self.deleted.update(in_base)
+            self._deleted_selector = None
+        if self._ops is not None:
+            self._ops.append(("remove", None, ids.copy()))
+        return len(in_delta) + len(in_base)
+
+    # --- Đọc ---
+    def _base_params(self, params, user_sel):
+        if not self.deleted:
+            return params
+        if self._deleted_selector is None:
+            batch = faiss.IDSelectorBatch(np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted)))
+            selector = faiss.IDSelectorNot(batch)
+            selector.referenced = batch # Giữ batch sống cùng selector (SWIG không tự giữ)
+            self._deleted_selector = selector
+        if params is None:
+            params = faiss.SearchParameters()
+        if user_sel is not None:
+            # Filter của caller (VD: theo group) AND với danh sách đã xóa
+            combined = faiss.IDSelectorAnd(user_sel, self._deleted_selector)
+            combined.referenced = (user_sel, self._deleted_selector)
+            params.sel = combined
+        else:
+            params.sel = self._deleted_selector
+        return params
+
+    def _search_base_unfiltered(self, x, k):
+        """Search base không có selector: lấy dư len(deleted) ứng viên rồi bỏ ID đã xóa."""
+        if not self.deleted:
+            return self.base.search(x, k)
+        fetch_k = min(k + len(self.deleted), max(self.base.ntotal, k))
+        D, I = self.base.search(x, fetch_k)
+        dead = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+        alive = (I >= 0) & ~np.isin(I, dead)
+        # Dồn ID còn sống lên đầu mỗi hàng (giữ thứ tự score), phần thiếu là -1
+        order = np.argsort(~alive, axis=1, kind="stable")[:, :k]
+        alive = np.take_along_axis(alive, order, axis=1)
+        D = np.where(alive, np.take_along_axis(D, order, axis=1),
+                     -np.inf if self.metric == faiss.METRIC_INNER_PRODUCT else np.inf).astype(np.float32)
+        I = np.where(alive, np.take_along_axis(I, order, axis=1), -1)
+        return D, I
+
+    def search(self, x, k, params=None):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        user_sel = params.sel if params is not None else None
+        if not self.base_filterable:
+            if user_sel is not None:
+                raise ValueError("Base index does not support IDSelector; filter the results after search")
+            D, I = self._search_base_unfiltered(x, k)
+        else:
+            base_params = self._base_params(params, user_sel)
+            if base_params is not None:
+                D, I = self.base.search(x, k, params=base_params)
+            else:
+                D, I = self.base.search(x, k)
+            if params is not None:
+                params.sel = user_sel # Trả lại selector gốc cho caller
+        if self.delta.ntotal == 0:
+            return D, I
+
+        if user_sel is not None:
+            dD, dI = self.delta.search(x, min(k, self.delta.ntotal), params=faiss.SearchParameters(sel=user_sel))
+        else:
+            dD, dI = self.delta.search(x, min(k, self.delta.ntotal))
+        D = np.concatenate([D, dD], axis=1)
+        I = np.concatenate([I, dI], axis=1)
+        # Gộp 2 kết quả theo score (IP: cao hơn tốt hơn, L2: thấp hơn tốt hơn)
+        order = np.argsort(-D if self.metric == faiss.METRIC_INNER_PRODUCT else D, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+    def range_search(self, x, radius, params=None):
+        """range_search trên base (trừ ID đã xóa) + delta; kết quả mỗi query không sắp xếp (giống FAISS)."""
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        user_sel = params.sel if params is not None else None
+        base_params = self._base_params(params, user_sel)
+        if base_params is not None:
+            lims, D, I = self.base.range_search(x, radius, params=base_params)
+        else:
+            lims, D, I = self.base.range_search(x, radius)
+        if params is not None:
+            params.sel = user_sel
+        if self.delta.ntotal == 0:
+            return lims, D, I
+
+        if user_sel is not None:
+            d_lims, dD, dI = self.delta.range_search(x, radius, params=faiss.SearchParameters(sel=user_sel))
+        else:
+            d_lims, dD, dI = self.delta.range_search(x, radius)
+        # Ghép từng query: [hit của base, hit của delta]
+        out_D, out_I, out_lims = [], [], [0]
+        for row in range(len(x)):
+            out_D += [D[lims[row]:lims[row + 1]], dD[d_lims[row]:d_lims[row + 1]]]
+            out_I += [I[lims[row]:lims[row + 1]], dI[d_lims[row]:d_lims[row + 1]]]
+            out_lims.append(out_lims[-1] + (lims[row + 1] - lims[row]) + (d_lims[row + 1] - d_lims[row]))
+        return np.array(out_lims, dtype=lims.dtype), np.concatenate(out_D), np.concatenate(out_I)
+
+    def reconstruct(self, key):
+        key = int(key)
+        if key in self.delta_ids:
+            return self.delta.reconstruct(key)
+        if key in self.deleted:
+            raise RuntimeError(f"id {key} has been removed")
+        return self.base.reconstruct(key)
+
+    def reconstruct_batch(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if any(i in self.deleted for i in ids.tolist()):
+            raise RuntimeError("reconstruct_batch: some ids have been removed")
+        out = np.empty((len(ids), self.d), dtype=np.float32)
+        in_delta = np.array([i in self.delta_ids for i in ids.tolist()], dtype=bool)
+        if in_delta.any():
+            out[in_delta] = self.delta.reconstruct_batch(ids[in_delta])
+        if (~in_delta).any():
+            out[~in_delta] = self.base.reconstruct_batch(ids[~in_delta])
+        return out
+
+    # --- Snapshot ---
+    def materialize(self, rebuild_fn=None):
+        """
+        Gộp base + delta - deleted thành một index bình thường trong RAM.
+        Không có thay đổi nào -> trả về chính base (không copy).
+        rebuild_fn(ids, vectors) dùng cho loại index không hỗ trợ remove_ids (HNSW).
+        """
+        if not self.deleted and self.delta.ntotal == 0:
+            return self.base
+        # serialize -> deserialize tạo bản copy sở hữu bộ nhớ riêng (ghi được)
+        merged = faiss.deserialize_index(faiss.serialize_index(self.base))
+        if self.deleted:
+            deleted = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+            try:
+                merged.remove_ids(deleted)
+            except RuntimeError:
+                if rebuild_fn is None:
+                    raise
+                base_ids = faiss.vector_to_array(merged.id_map)
+                live = base_ids[~np.isin(base_ids, deleted)]
+                merged = rebuild_fn(live, merged.reconstruct_batch(live))
+        if self.delta.ntotal:
+            delta_ids = faiss.vector_to_array(self.delta.id_map)
+            merged.add_with_ids(self.delta.reconstruct_batch(delta_ids), delta_ids)
+        return merged
+
+    def begin_snapshot(self, rebuild_fn=None):
+        """Chụp index gộp để serialize; từ giờ ghi lại các thay đổi để rebase sau khi ghi file."""
+        merged = self.materialize(rebuild_fn)
+        self._ops = []
+        return merged
+
+    def abort_snapshot(self):
+        self._ops = None
+
+    def rebase(self, new_base) -> "SegmentedIndex":
+        """Tạo SegmentedIndex mới trên base vừa ghi, áp lại các thay đổi xảy ra trong lúc ghi."""
+        seg = SegmentedIndex(new_base, self.metric)
+        for op, x, ids in self._ops or []:
+            if op == "add":
+                seg.add_with_ids(x, ids)
+            else:
+                seg.remove_ids(ids)
+        self._ops = None
+        return seg
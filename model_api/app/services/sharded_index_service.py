@@ -0,0 +1,270 @@
+# model_api/app/services/sharded_index_service.py
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app.config import (
+    IMG2IMG_NUM_SHARDS, IMG2IMG_SHARD_SEARCH_THREADS,
+    SEARCH_CACHE_ENABLED, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_S, SEARCH_CACHE_QUANT_STEP
+)
+from app.services.index_journal import IndexJournal
+from app.services.index_service import IndexService
+from app.services.search_cache import SearchResultCache
+from app.utils.logger import logger
+from app.utils.timer import Timer
+
+
+# Import index một-file cũ: mỗi lần add_items của một shard = một record journal + một fsync
+IMPORT_CHUNK_SIZE = 4096
+# Có file này khi khởi động = lần import trước chưa xong -> xóa shard và import lại
+IMPORT_MARKER_SUFFIX = ".importing"
+
+
+def shard_path(path: str, shard: int) -> str:
+    """index/img2img_fashion.faiss -> index/img2img_fashion.shard00.faiss"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard:02d}{ext}"
+
+
+class ShardedIndexService:
+    """
+    Chia vector img2img thành N shard theo hash(product_id); mỗi shard là một IndexService
+    độc lập (file index, mapping, journal, snapshot riêng) nên save/rebuild theo từng shard.
+    - Mọi ảnh của một sản phẩm nằm cùng shard -> gom sản phẩm trong từng shard là đủ.
+    - Search: scatter song song trên thread pool (FAISS nhả GIL khi search), gather top-k.
+    Cung cấp cùng API với IndexService để route không cần biết có shard hay không.
+    """
+    def __init__(self, index_path, mapping_path, dim=512, num_shards=IMG2IMG_NUM_SHARDS,
+                 search_threads=IMG2IMG_SHARD_SEARCH_THREADS, result_cache=SEARCH_CACHE_ENABLED, **shard_kwargs):
+        if num_shards < 1:
+            raise ValueError(f"num_shards phải >= 1 (nhận {num_shards})")
+        self.index_path = index_path
+        self.mapping_path = mapping_path
+        self.dim = dim
+        self.num_shards = num_shards
+        # Cache đặt ở tầng gộp kết quả (shard không cache riêng)
+        shard_kwargs["result_cache"] = False
+        self.result_cache = SearchResultCache(
+            "img2img", SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_S, SEARCH_CACHE_QUANT_STEP
+        ) if result_cache else None
+
+        with Timer("Index_Shards_Load", metadata={"service": "img2img", "num_shards": num_shards}):
+            self.shards = [
+                IndexService(shard_path(index_path, i), shard_path(mapping_path, i), dim=dim, **shard_kwargs)
+                for i in range(num_shards)
+            ]
+        self._pool = ThreadPoolExecutor(
+            max_workers=search_threads or num_shards, thread_name_prefix="img2img-shard"
+        )
+
+        marker = index_path + IMPORT_MARKER_SUFFIX
+        if os.path.exists(index_path) and (os.path.exists(marker) or self.ntotal == 0):
+            if os.path.exists(marker):
+                # Shard chỉ chứa một phần dữ liệu của lần import bị dừng -> không tin ntotal, làm lại từ đầu
+                logger.warning(f"Previous import of {index_path} did not finish, clearing shards and importing again")
+                self._reset_shards(shard_kwargs)
+            self._import_unsharded(shard_kwargs)
+        elif os.path.exists(marker):
+            # Crash sau khi file cũ đã được đổi tên: shard đã đủ, chỉ còn dọn journal cũ
+            self._finish_import()
+        logger.info(f"Sharded img2img index ready: {num_shards} shards, {self.ntotal} vectors")
+
+    # --- Routing ---
+    def shard_of(self, product_id: str) -> int:
+        return zlib.crc32(str(product_id).encode("utf-8")) % self.num_shards
+
+    def shard_for(self, product_id: str) -> IndexService:
+        return self.shards[self.shard_of(product_id)]
+
+    def _import_unsharded(self, shard_kwargs):
+        """
+        Lần đầu bật sharding: chia index một-file cũ vào các shard rồi giữ file cũ ở .migrated.
+        Marker <index>.importing tồn tại suốt quá trình, chỉ bị xóa sau khi shard đã save và file cũ đã đổi tên.
+        """
+        logger.info(f"Importing unsharded index {self.index_path} into {self.num_shards} shards")
+        with open(self.index_path + IMPORT_MARKER_SUFFIX, "w", encoding="utf-8") as f:
+            f.write(f"{self.num_shards}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        legacy = IndexService(self.index_path, self.mapping_path, dim=self.dim, **shard_kwargs)
+        try:
+            ids, vectors = legacy._export_vectors()
+            infos = [legacy.id_map.get(int_id) for int_id in ids.tolist()]
+            rows_by_shard = [[] for _ in range(self.num_shards)]
+            for row, info in enumerate(infos):
+                rows_by_shard[self.shard_of(info["product_id"])].append(row)
+            for shard, rows in zip(self.shards, rows_by_shard):
+                for start in range(0, len(rows), IMPORT_CHUNK_SIZE):
+                    chunk = [infos[row] for row in rows[start:start + IMPORT_CHUNK_SIZE]]
+                    shard.add_items(
+                        vectors[rows[start:start + IMPORT_CHUNK_SIZE]],
+                        [info["product_id"] for info in chunk],
+                        [info["image_id"] for info in chunk],
+                        groups=[info["group"] for info in chunk],
+                        shop_ids=[info["shop_id"] for info in chunk]
+                    )
+        finally:
+            legacy.close()
+        if not self.save():
+            raise RuntimeError(f"Failed to save shards while importing {self.index_path}")
+        legacy_vectors = os.path.splitext(self.index_path)[0] + ".vectors"
+        for path in (self.index_path, self.mapping_path, legacy_vectors):
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+        self._finish_import()
+        logger.info(f"Imported {len(ids)} vectors into shards")
+
+    def _finish_import(self):
+        """Dữ liệu đã nằm trong snapshot của các shard -> bỏ journal của file cũ rồi xóa marker."""
+        legacy_journal = IndexJournal(os.path.splitext(self.index_path)[0] + ".journal")
+        legacy_journal.drop_segments_through(legacy_journal.segment)
+        legacy_journal.close()
+        os.remove(self.index_path + IMPORT_MARKER_SUFFIX)
+
+    def _reset_shards(self, shard_kwargs):
+        """Xóa toàn bộ dữ liệu (snapshot, vector, journal) của mọi shard và tạo lại shard rỗng."""
+        for i, shard in enumerate(self.shards):
+            shard.close(save=False)
+            if shard.journal is not None:
+                shard.journal.drop_segments_through(shard.journal.segment)
+            for path in (shard.index_path, shard.index_path + ".prev",
+                         shard.mapping_path, shard.mapping_path + ".prev",
+                         os.path.splitext(shard.index_path)[0] + ".vectors"):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.shards[i] = IndexService(shard.index_path, shard.mapping_path, dim=self.dim, **shard_kwargs)
+
+    # --- Thông tin ---
+    @property
+    def is_loaded(self) -> bool:
+        return all(shard.is_loaded for shard in self.shards)
+
+    @property
+    def ntotal(self) -> int:
+        return sum(shard.ntotal for shard in self.shards)
+
+    @property
+    def generation(self) -> int:
+        # Generation của từng shard chỉ tăng -> tổng cũng chỉ tăng khi có shard thay đổi
+        return sum(shard.generation for shard in self.shards)
+
+    @property
+    def index_type(self) -> str:
+        types = {shard.index_type for shard in self.shards}
+        return types.pop() if len(types) == 1 else "mixed"
+
+    # --- Thay đổi: chỉ chạm vào shard chứa sản phẩm ---
+    def add_item(self, vector, product_id: str, image_id: str, group: str = None, shop_id: str = None):
+        self.shard_for(product_id).add_item(vector, product_id, image_id, group=group, shop_id=shop_id)
+
+    def add_items(self, vectors, product_ids: list, image_ids: list, groups: list = None, shop_ids: list = None):
+        vectors = np.asarray(vectors, dtype='float32').reshape(-1, self.dim)
+        groups = groups or [None] * len(vectors)
+        shop_ids = shop_ids or [None] * len(vectors)
+        by_shard = {}
+        for row, product_id in enumerate(product_ids):
+            by_shard.setdefault(self.shard_of(product_id), []).append(row)
+        for shard, rows in by_shard.items():
+            self.shards[shard].add_items(
+                vectors[rows], [product_ids[r] for r in rows], [image_ids[r] for r in rows],
+                [groups[r] for r in rows], [shop_ids[r] for r in rows]
+            )
+        return len(vectors)
+
+    def remove_list_images(self, product_id: str, image_ids: list):
+        return self.shard_for(product_id).remove_list_images(product_id, image_ids)
+
+    def remove_product(self, product_id: str):
+        return self.shard_for(product_id).remove_product(product_id)
+
+    def commit(self):
+        for shard in self.shards:
+            shard.commit()
+
+    def save(self):
+        return all([shard.save() for shard in self.shards])
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self._pool.shutdown(wait=True)
+
+    def rebuild_index(self, index_type=None):
+        infos = list(self._pool.map(lambda shard: shard.rebuild_index(index_type), self.shards))
+        return {"index_type": self.index_type, "ntotal": self.ntotal, "shards": infos}
+
+    def compact(self):
+        return sum(self._pool.map(lambda shard: shard.compact(), self.shards))
+
+    def migrate_index(self, index_type=None):
+        infos = list(self._pool.map(lambda shard: shard.migrate_index(index_type), self.shards))
+        return {"index_type": self.index_type, "ntotal": self.ntotal, "shards": infos}
+
+    def storage_report(self, **kwargs):
+        reports = list(self._pool.map(lambda shard: shard.storage_report(**kwargs), self.shards))
+        return {
+            "index_type": self.index_type,
+            "ntotal": sum(r["ntotal"] for r in reports),
+            "index_bytes": sum(r["index_bytes"] for r in reports),
+            "num_shards": self.num_shards,
+            "shards": reports,
+        }
+
+    # --- Search: scatter-gather ---
+    def search(self, query_emb, k=20, nprobe=None, ef_search=None, group=None, shop_id=None):
+        return self.search_batch(np.array([query_emb]), k=k, nprobe=nprobe, ef_search=ef_search,
+                                 group=group, shop_id=shop_id)[0]
+
+    def search_batch(self, queries, k=20, nprobe=None, ef_search=None, group=None, shop_id=None):
+        return self.search_batch_collapsed(queries, k=k, nprobe=nprobe, ef_search=ef_search,
+                                           group=group, shop_id=shop_id)[0]
+
+    def search_batch_collapsed(self, queries, k=20, nprobe=None, ef_search=None, group=None, shop_id=None):
+        """
+        Search tất cả shard song song rồi gộp top-k theo score.
+        rounds[i] = số lượt search lớn nhất mà một shard cần cho query i.
+        """
+        queries = np.asarray(queries, dtype='float32').reshape(-1, self.dim)
+        if self.result_cache is None:
+            return self._search_uncached(queries, k, nprobe, ef_search, group, shop_id)
+
+        rows = self.result_cache.batch_lookup(
+            queries, (k, nprobe, ef_search, group, shop_id), self.generation,
+            lambda missing: list(zip(*self._search_uncached(missing, k, nprobe, ef_search, group, shop_id)))
+        )
+        return [results for results, _ in rows], [rounds for _, rounds in rows]
+
+    def _search_uncached(self, queries, k, nprobe, ef_search, group, shop_id):
+        metadata = {"service": "img2img", "action": "search", "k": k,
+                    "n_queries": len(queries), "num_shards": self.num_shards}
+
+        with Timer("Search_Shards_Scatter", metadata=metadata):
+            shard_outputs = list(self._pool.map(
+                lambda shard: shard.search_batch_collapsed(
+                    queries, k=k, nprobe=nprobe, ef_search=ef_search, group=group, shop_id=shop_id
+                ),
+                self.shards
+            ))
+
+        with Timer("Search_Shards_Gather", metadata=metadata):
+            all_results, all_rounds = [], []
+            for row in range(len(queries)):
+                candidates = [item for results, _ in shard_outputs for item in results[row]]
+                candidates.sort(key=lambda item: item["score"], reverse=True)
+
+                merged, seen = [], set()
+                for item in candidates:
+                    # Sản phẩm chỉ nằm ở một shard; vẫn khử trùng phòng khi số shard bị đổi
+                    if item["product_id"] in seen:
+                        continue
+                    seen.add(item["product_id"])
+                    merged.append({**item, "rank": len(merged) + 1})
+                    if len(merged) >= k:
+                        break
+                all_results.append(merged)
+                all_rounds.append(max(rounds[row] for _, rounds in shard_outputs))
+
+        return all_results, all_rounds
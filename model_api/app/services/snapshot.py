@@ -0,0 +1,168 @@
+# model_api/app/services/snapshot.py
+import json
+import os
+import threading
+import time
+
+import faiss
+
+from app.services.segmented_index import read_index_mmap
+from app.utils.io_utils import atomic_write_bytes, sha256_file
+from app.utils.logger import logger
+from app.utils.timer import Timer
+
+
+def write_snapshot(index_path: str, index_bytes, mapping_path: str, mapping_data: dict):
+    """
+    Ghi snapshot (index + mapping) an toàn:
+    1. Index ghi ra file tạm -> rename (bản cũ giữ ở .prev).
+    2. Mapping chứa checksum của index -> ghi tạm -> rename.
+    Crash ở bất kỳ bước nào thì load_snapshot vẫn tìm được một cặp file khớp checksum.
+    """
+    index_sha256 = atomic_write_bytes(index_path, index_bytes)
+    payload = json.dumps(
+        {**mapping_data, "index_sha256": index_sha256, "index_size": len(index_bytes)}, ensure_ascii=False
+    )
+    atomic_write_bytes(mapping_path, payload.encode("utf-8"))
+    return index_sha256
+
+
+def load_snapshot(index_path: str, mapping_path: str, tag: str = "Snapshot", mmap: bool = False):
+    """
+    Load cặp (index, mapping) hợp lệ gần nhất.
+    Thứ tự thử: (index, mapping) -> (index.prev, mapping) -> (index.prev, mapping.prev).
+    Trả về (index, mapping_data) hoặc (None, None) nếu chưa có snapshot nào.
+    mmap=True: index được memory-map read-only (xem segmented_index.read_index_mmap) và
+    chỉ kiểm tra kích thước file thay vì sha256 để khởi động không phụ thuộc kích thước catalog.
+    Nếu có file nhưng tất cả đều hỏng, các file hỏng được đổi tên sang .corrupt-<ts>
+    để không bị ghi đè, sau đó trả về (None, None).
+    """
+    candidates = [
+        (index_path, mapping_path),
+        (index_path + ".prev", mapping_path),
+        (index_path + ".prev", mapping_path + ".prev"),
+    ]
+    found_any = False
+    for idx_path, map_path in candidates:
+        if not os.path.exists(idx_path):
+            continue
+        found_any = True
+        try:
+            mapping_data = {}
+            if os.path.exists(map_path):
+                with open(map_path, "r", encoding="utf-8") as f:
+                    mapping_data = json.load(f)
+
+            # Snapshot cũ (trước khi có checksum) không có index_sha256 -> chấp nhận như cũ
+            expected = mapping_data.get("index_sha256")
+            expected_size = mapping_data.get("index_size")
+            if mmap and expected_size is not None:
+                if os.path.getsize(idx_path) != expected_size:
+                    logger.warning(f"[{tag}] Size mismatch for {idx_path} vs {map_path}, trying older snapshot")
+                    continue
+            elif expected is not None and sha256_file(idx_path) != expected:
+                logger.warning(f"[{tag}] Checksum mismatch for {idx_path} vs {map_path}, trying older snapshot")
+                continue
+
+            with Timer(f"{tag}_ReadIndex", metadata={"mmap": mmap}):
+                if mmap:
+                    index, _ = read_index_mmap(idx_path)
+                else:
+                    index = faiss.read_index(idx_path)
+            if idx_path != index_path:
+                logger.warning(f"[{tag}] Recovered from previous snapshot {idx_path}")
+            return index, mapping_data
+        except Exception as e:
+            logger.error(f"[{tag}] Failed to load snapshot ({idx_path}, {map_path}): {e}")
+
+    if found_any:
+        suffix = f".corrupt-{int(time.time())}"
+        for path in (index_path, mapping_path):
+            if os.path.exists(path):
+                os.replace(path, path + suffix)
+        logger.error(f"[{tag}] No valid snapshot found. Corrupt files kept with suffix {suffix}; starting empty.")
+    return None, None
+
+
+class SnapshotScheduler:
+    """
+    Gộp (debounce) nhiều thay đổi và ghi snapshot bằng thread nền, ngoài luồng request.
+    - Ghi ngay khi số thay đổi chưa lưu >= dirty_threshold.
+    - Hoặc khi đã có thay đổi và đã chờ đủ interval_s giây kể từ thay đổi đầu tiên.
+    """
+    def __init__(self, name: str, save_fn, interval_s: float, dirty_threshold: int):
+        self.name = name
+        self.save_fn = save_fn
+        self.interval_s = interval_s
+        self.dirty_threshold = dirty_threshold
+
+        self._cond = threading.Condition()
+        self._dirty = 0
+        self._first_dirty_at = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name=f"{name}-snapshot", daemon=True)
+        self._thread.start()
+
+    @property
+    def dirty(self) -> int:
+        return self._dirty
+
+    def mark_dirty(self, count: int = 1):
+        with self._cond:
+            if self._dirty == 0:
+                self._first_dirty_at = time.monotonic()
+            self._dirty += count
+            if self._dirty >= self.dirty_threshold:
+                self._cond.notify()
+
+    def _take_dirty(self) -> int:
+        dirty, self._dirty, self._first_dirty_at = self._dirty, 0, None
+        return dirty
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._dirty >= self.dirty_threshold:
+                        break
+                    if self._dirty > 0:
+                        remaining = self.interval_s - (time.monotonic() - self._first_dirty_at)
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(timeout=remaining)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+                dirty = self._take_dirty()
+            if not self._run_save(dirty):
+                # Lưu thất bại -> chờ một chu kỳ trước khi thử lại, tránh lặp liên tục
+                with self._cond:
+                    if not self._stopped:
+                        self._cond.wait(timeout=self.interval_s)
+
+    def _run_save(self, dirty: int) -> bool:
+        try:
+            ok = self.save_fn() is not False
+        except Exception as e:
+            logger.error(f"[{self.name}] Snapshot failed: {e}", exc_info=True)
+            ok = False
+        if not ok:
+            # Giữ lại số thay đổi chưa lưu để lần sau ghi tiếp
+            self.mark_dirty(dirty)
+        return ok
+
+    def flush(self):
+        """Ghi snapshot ngay (đồng bộ) nếu có thay đổi chưa lưu."""
+        with self._cond:
+            dirty = self._take_dirty()
+        if dirty:
+            self._run_save(dirty)
+
+    def stop(self, flush: bool = True):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout=10)
+        if flush:
+            self.flush()
@@ -1,5 +1,6 @@
 # /model_api/app/services/txt2img_service.py
 
+import io
 import os
 import torch
 import torch.nn as nn
@@ -7,14 +8,16 @@ import torch.nn.functional as F
 import numpy as np
 from PIL import Image
 from transformers import AutoTokenizer, AutoModel
-from torchvision import models, transforms
+from torchvision import models
 from typing import Union, IO
 from pyvi import ViTokenizer
 
 from app.config import (
-    TEXT2IMG_MODEL_PATH, TEXT2IMG_BASE_ARCH, TEXT2IMG_EMBEDDING_DIM, DEVICE,
-    RGB_MEAN, RGB_STD, INPUT_SIZE
+    TEXT2IMG_MODEL_PATH, TEXT2IMG_BASE_ARCH, TEXT2IMG_EMBEDDING_DIM, DEVICE
 )
+from app.services.preprocess import build_clip_image_transform
+from app.services.embedding_cache import embedding_cache, content_hash, model_tag
+from app.services.model_workers import use_model_workers, model_worker_pool, RemoteText2ImgService
 from app.utils.logger import logger
 from app.utils.timer import Timer
 
@@ -77,14 +80,14 @@ class Text2ImgService:
         # --- ĐỒNG BỘ HÓA TRANSFORM ---
         # Transform này giống hệt `transform_val` trong file training.
         # Nó xử lý đúng màu RGB và resize không bị lỗi.
-        self.transform = transforms.Compose([
-            transforms.Resize((INPUT_SIZE[0], INPUT_SIZE[1])),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=RGB_MEAN, std=RGB_STD)
-        ])
+        self.transform = build_clip_image_transform()
         
         self.load_model()
 
+        # Cache vector ảnh theo nội dung (cùng ảnh được index lại khi sửa sản phẩm)
+        self.cache = embedding_cache
+        self._cache_namespace = f"txt2img:{model_tag('PhoCLIP', TEXT2IMG_MODEL_PATH)}:image"
+
     def load_model(self):
         with Timer("Txt2Img_LoadModel"):
             logger.info("--- LOADING TEXT2IMG MODEL (v7 Architecture) ---")
@@ -149,17 +152,128 @@ class Text2ImgService:
                 logger.error(f"Text embed error: {e}", exc_info=True)
                 return None
 
+    def embed_texts(self, texts: list):
+        """
+        Bản batch của embed_text: tách từ từng câu, tokenize + encode cả list trong MỘT lần forward.
+        Trả về (vectors (N, D) float32, errors): hàng lỗi là 0 và errors[i] chứa lý do.
+        """
+        vectors = np.zeros((len(texts), TEXT2IMG_EMBEDDING_DIM), dtype=np.float32)
+        if not self.model or not self.tokenizer:
+            logger.warning("PhoCLIP model not available. Skipping text embedding.")
+            return vectors, ["PhoCLIP model not available"] * len(texts)
+
+        errors = [None] * len(texts)
+        with Timer("Txt2Img_TextEmbeddingBatch", metadata={"batch": len(texts)}):
+            rows, segmented = [], []
+            for i, text in enumerate(texts):
+                try:
+                    if not text or not text.strip():
+                        raise ValueError("Empty query")
+                    segmented.append(ViTokenizer.tokenize(text))
+                    rows.append(i)
+                except Exception as e:
+                    errors[i] = str(e)
+            if not rows:
+                return vectors, errors
+
+            try:
+                tokens = self.tokenizer(
+                    segmented, padding="max_length", truncation=True,
+                    max_length=64, return_tensors="pt"
+                ).to(self.device)
+                with torch.no_grad():
+                    features = self.model.get_text_encoder()(tokens["input_ids"], tokens["attention_mask"])
+                    normalized_features = F.normalize(features, p=2, dim=-1)
+                vectors[rows] = normalized_features.cpu().numpy().astype('float32')
+            except Exception as e:
+                logger.error(f"Text batch embed error: {e}", exc_info=True)
+                for i in rows:
+                    errors[i] = str(e)
+        return vectors, errors
+
+    def embed_images(self, images: list):
+        """
+        Bản batch của embed_image: mỗi phần tử là đường dẫn, file-like hoặc bytes.
+        Decode + transform từng ảnh, MỘT lần forward cho các ảnh chưa có trong cache.
+        Trả về (vectors (N, D) float32, errors): hàng lỗi là 0 và errors[i] chứa lý do.
+        """
+        vectors = np.zeros((len(images), TEXT2IMG_EMBEDDING_DIM), dtype=np.float32)
+        if not self.model:
+            logger.warning("PhoCLIP model not available. Skipping image embedding.")
+            return vectors, ["PhoCLIP model not available"] * len(images)
+
+        errors = [None] * len(images)
+        with Timer("Txt2Img_ImageEmbeddingBatch", metadata={"batch": len(images)}) as t:
+            rows, digests, tensors = [], [], []
+            for i, image_data in enumerate(images):
+                try:
+                    if isinstance(image_data, (bytes, bytearray)):
+                        image_bytes = bytes(image_data)
+                    elif isinstance(image_data, str):
+                        with open(image_data, "rb") as f:
+                            image_bytes = f.read()
+                    else:
+                        image_bytes = image_data.read()
+
+                    digest = content_hash(image_bytes) if self.cache is not None else None
+                    cached = self.cache.get(self._cache_namespace, digest) if digest else None
+                    if cached is not None:
+                        vectors[i] = cached["vector"].reshape(-1)
+                        continue
+                    image_pil = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+                    tensors.append(self.transform(image_pil))
+                    rows.append(i)
+                    digests.append(digest)
+                except Exception as e:
+                    errors[i] = str(e)
+            t.metadata["cache_hits"] = len(images) - len(rows) - sum(e is not None for e in errors)
+            if not tensors:
+                return vectors, errors
+
+            try:
+                features = self._encode_image_batch(torch.stack(tensors).to(self.device))
+            except Exception as e:
+                logger.error(f"Image batch embed error: {e}", exc_info=True)
+                for i in rows:
+                    errors[i] = str(e)
+                return vectors, errors
+            vectors[rows] = features
+            for digest, vector in zip(digests, features):
+                if digest is not None:
+                    self.cache.put(self._cache_namespace, digest, vector.reshape(1, -1))
+        return vectors, errors
+
+    def _encode_image_batch(self, batch) -> np.ndarray:
+        """Tensor (N, 3, H, W) trên device -> (N, D) float32 đã chuẩn hóa L2."""
+        with torch.no_grad():
+            features = self.model.get_image_encoder()(batch)
+            normalized_features = F.normalize(features, p=2, dim=-1)
+        return normalized_features.cpu().numpy().astype('float32')
+
     def embed_image(self, image_data: Union[str, IO]) -> np.ndarray | None:
         """Chuyển Ảnh -> Vector, sử dụng transform giống hệt training."""
         if not self.model:
             logger.warning("PhoCLIP model not available. Skipping image embedding.")
             return None
 
-        with Timer("Txt2Img_ImageEmbedding"):
+        with Timer("Txt2Img_ImageEmbedding") as t:
             try:
+                # Đọc bytes một lần: dùng cho cả hash cache lẫn decode
+                if isinstance(image_data, str):
+                    with open(image_data, "rb") as f:
+                        image_bytes = f.read()
+                else:
+                    image_bytes = image_data.read()
+
+                digest = content_hash(image_bytes) if self.cache is not None else None
+                cached = self.cache.get(self._cache_namespace, digest) if digest else None
+                t.metadata["cache"] = "hit" if cached else "miss"
+                if cached is not None:
+                    return cached["vector"]
+
                 # --- ĐỒNG BỘ HÓA LOGIC ẢNH ---
                 # Toàn bộ quá trình xử lý ảnh chỉ dùng PIL và Torchvision, đảm bảo đúng màu RGB.
-                image_pil = Image.open(image_data).convert("RGB")
+                image_pil = Image.open(io.BytesIO(image_bytes)).convert("RGB")
                 
                 # Áp dụng transform giống hệt `transform_val`
                 image_tensor = self.transform(image_pil).unsqueeze(0).to(self.device)
@@ -168,15 +282,32 @@ class Text2ImgService:
                     features = self.model.get_image_encoder()(image_tensor)
                     normalized_features = F.normalize(features, p=2, dim=-1)
                 
-                return normalized_features.cpu().numpy().astype('float32')
+                vector = normalized_features.cpu().numpy().astype('float32')
+                if digest is not None:
+                    self.cache.put(self._cache_namespace, digest, vector)
+                return vector
                 
             except Exception as e:
                 logger.error(f"Error embedding image: {e}", exc_info=True)
                 return None
 
+    def embed_image_tensors(self, image_tensors: np.ndarray) -> np.ndarray | None:
+        """
+        Embed nhiều ảnh đã qua transform (N, 3, H, W) trong MỘT lần forward.
+        Dùng cho reindex: transform được làm sẵn ở process con.
+        """
+        if not self.model:
+            logger.warning("PhoCLIP model not available. Skipping image embedding.")
+            return None
+
+        with Timer("Txt2Img_ImageEmbeddingBatch", metadata={"batch": len(image_tensors)}):
+            batch = torch.from_numpy(np.ascontiguousarray(image_tensors, dtype=np.float32)).to(self.device)
+            return self._encode_image_batch(batch)
+
 # --- Singleton Instance ---
+# Chế độ model worker: proxy gửi job sang process worker (model chỉ load ở đó)
 try:
-    txt2img_service = Text2ImgService()
+    txt2img_service = RemoteText2ImgService(model_worker_pool) if use_model_workers() else Text2ImgService()
 except Exception as e:
     logger.error(f"Failed to initialize Text2ImgService: {e}", exc_info=True)
     txt2img_service = None
\ No newline at end of file
@@ -7,52 +7,104 @@ import traceback
 import threading # ### UPDATE ### Thêm threading để khóa file
 
 from app.utils.logger import logger
-from app.config import TEXT2IMG_INDEX_PATH, TEXT2IMG_EMBEDDING_DIM
+from app.config import (
+    TEXT2IMG_INDEX_PATH, TEXT2IMG_EMBEDDING_DIM,
+    TEXT2IMG_SNAPSHOT_INTERVAL_S, TEXT2IMG_SNAPSHOT_DIRTY_THRESHOLD, TEXT2IMG_INDEX_MMAP,
+    TEXT2IMG_JOURNAL_ENABLED, TEXT2IMG_GROUP_COMMIT_WINDOW_MS, TEXT2IMG_GROUP_COMMIT_WAIT,
+    TEXT2IMG_GROUP_COMMIT_TIMEOUT_S,
+    TEXT2IMG_COLLAPSE_FETCH_FACTOR, TEXT2IMG_COLLAPSE_GROWTH, TEXT2IMG_COLLAPSE_MAX_ROUNDS,
+    TEXT2IMG_SEARCH_SCORE_FLOOR, TEXT2IMG_SEARCH_USE_RANGE,
+    SEARCH_CACHE_ENABLED, SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_S, SEARCH_CACHE_QUANT_STEP
+)
+from app.services.index_journal import IndexJournal, JournalDurabilityError, encode_vector, decode_vector
+from app.services.snapshot import SnapshotScheduler, write_snapshot, load_snapshot
+from app.services.search_utils import first_unique_per_row, collapse_search
+from app.services.segmented_index import SegmentedIndex, read_index_mmap
+from app.services.search_cache import SearchResultCache
+from app.utils.rwlock import ReadWriteLock
 from app.utils.timer import Timer
 
 TEXT2IMG_MAP_PATH = TEXT2IMG_INDEX_PATH.replace(".faiss", "_map.json")
 
 class TextIndexService:
-    def __init__(self):
-        self.index_path = TEXT2IMG_INDEX_PATH
-        self.mapping_path = TEXT2IMG_MAP_PATH
-        self.dim = TEXT2IMG_EMBEDDING_DIM
+    def __init__(self, index_path=TEXT2IMG_INDEX_PATH, mapping_path=TEXT2IMG_MAP_PATH, dim=TEXT2IMG_EMBEDDING_DIM):
+        self.index_path = index_path
+        self.mapping_path = mapping_path
+        self.dim = dim
+        self.use_mmap = TEXT2IMG_INDEX_MMAP
         
         self.index = None
         self.id_map = {}
         self.next_id = 0 
+        # Chỉ mục ngược của id_map (tra O(1) thay vì duyệt cả map):
+        # image_path -> int_id, product_id -> {int_id}
+        self._path_to_id = {}
+        self._product_to_ids = {}
+        # product_id -> mã số (dùng để khử trùng sản phẩm bằng NumPy khi search)
+        self._product_codes = {}
+        # int_id -> mã sản phẩm (-1 = trống): tra kết quả search bằng MỘT phép index NumPy
+        self._id_codes = np.full(0, -1, dtype=np.int32)
+        # Tăng sau mỗi thay đổi index -> kết quả search đã cache tự hết hiệu lực
+        self.generation = 0
+        self.result_cache = SearchResultCache(
+            "txt2img", SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL_S, SEARCH_CACHE_QUANT_STEP
+        ) if SEARCH_CACHE_ENABLED else None
         
-        # ### UPDATE ### Tạo một khóa (lock) để ngăn chặn xung đột khi ghi file
-        # Điều này rất quan trọng trong môi trường đa luồng của API.
-        self._file_lock = threading.Lock()
+        # Khóa 2 tầng (giống IndexService):
+        # - _write_mutex: tuần tự hóa các writer (cấp ID, ghi journal, áp thay đổi).
+        # - _rwlock: search giữ read lock (song song), writer chỉ giữ write lock khi áp vào RAM.
+        # Chờ fsync (group commit) và ghi file snapshot đều nằm ngoài lock.
+        self._write_mutex = threading.RLock()
+        self._rwlock = ReadWriteLock()
+        # Đảm bảo chỉ một snapshot được ghi tại một thời điểm
+        self._save_lock = threading.Lock()
+        self._prev_closed_segment = None
 
-        self._load_index()
+        snapshot_seq = self._load_index()
 
-    def _load_index(self):
+        # Journal (WAL): replay các thao tác xảy ra sau snapshot cuối cùng
+        self.journal = None
+        replayed = 0
+        if TEXT2IMG_JOURNAL_ENABLED:
+            self.journal = IndexJournal(
+                os.path.splitext(self.index_path)[0] + ".journal",
+                group_commit_window_s=TEXT2IMG_GROUP_COMMIT_WINDOW_MS / 1000
+            )
+            self.journal.ensure_seq_at_least(snapshot_seq)
+            replayed = self._replay_journal(snapshot_seq)
+
+        # Snapshot được ghi bằng thread nền (debounce), không nằm trong luồng request
+        self._snapshots = SnapshotScheduler(
+            "txt2img", self.save,
+            interval_s=TEXT2IMG_SNAPSHOT_INTERVAL_S,
+            dirty_threshold=TEXT2IMG_SNAPSHOT_DIRTY_THRESHOLD
+        )
+        if replayed:
+            self._snapshots.mark_dirty(replayed)
+
+    def _load_index(self) -> int:
+        """Load snapshot. Trả về journal seq cuối cùng đã nằm trong snapshot."""
+        snapshot_seq = 0
         with Timer("TextIndex_LoadIndex"):
-            # ### UPDATE ### Sử dụng self._file_lock để đảm bảo an toàn khi đọc file lúc khởi động
-            with self._file_lock:
-                # Load Index
-                if os.path.exists(self.index_path):
-                    try:
-                        self.index = faiss.read_index(self.index_path)
-                        logger.info(f"[TextIndex] Loaded index from {self.index_path} with {self.index.ntotal} vectors.")
-                    except Exception:
-                        logger.error(f"[TextIndex] Error loading index file, creating new one:\n{traceback.format_exc()}")
-                        self._create_new()
+            with self._rwlock.write_lock():
+                # Load Index + Mapping (đã kiểm tra checksum, tự lùi về snapshot .prev nếu bản mới bị hỏng)
+                index, data = load_snapshot(self.index_path, self.mapping_path, tag="TextIndex", mmap=self.use_mmap)
+                if index is not None:
+                    # mmap: base read-only dùng chung giữa các worker, thay đổi mới nằm ở delta segment
+                    self.index = SegmentedIndex(index) if self.use_mmap else index
+                    logger.info(f"[TextIndex] Loaded index from {self.index_path} with {self.index.ntotal} vectors.")
                 else:
                     self._create_new()
 
                 # Load Mapping
-                if os.path.exists(self.mapping_path):
+                if data is not None:
                     try:
-                        with open(self.mapping_path, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
                         temp_map = {int(k): v for k, v in data.get("mapping", {}).items()}
                         self.id_map = temp_map
                         next_id_from_file = data.get("next_id", 0)
                         max_id_in_map = max(self.id_map.keys()) if self.id_map else -1
                         self.next_id = max(next_id_from_file, max_id_in_map + 1, 0)
+                        snapshot_seq = data.get("journal_seq", 0)
                         
                         logger.info(f"[TextIndex] Loaded mapping. Count: {len(self.id_map)}. Next ID set to: {self.next_id}")
                     except (json.JSONDecodeError, Exception):
@@ -62,6 +114,8 @@ class TextIndexService:
                 else:
                     self.id_map = {}
                     self.next_id = 0
+                self._rebuild_lookups()
+        return snapshot_seq
     
     def _create_new(self):
         """Khởi tạo một index mới trong RAM. Chỉ gọi hàm này bên trong một lock."""
@@ -72,6 +126,10 @@ class TextIndexService:
         self.index = faiss.IndexIDMap2(quantizer)
         self.id_map = {}
         self.next_id = 0
+        self._path_to_id = {}
+        self._product_to_ids = {}
+        self._product_codes = {}
+        self._id_codes = np.full(0, -1, dtype=np.int32)
 
     def add_product(self, vector: np.ndarray, product_id: str, image_path: str) -> bool:
         task_metadata = {"product_id": product_id, "image_path": image_path}
@@ -85,133 +143,349 @@ class TextIndexService:
                 vector_np = self._prepare_vector(vector)
                 if vector_np is None: return False
 
-                # ### UPDATE ### Bọc các thao tác thay đổi index trong một lock
-                with self._file_lock:
-                    id_to_remove = self._find_id_by_image_path(image_path)
-                    
-                    # Thêm vector mới
+                with self._write_mutex:
                     new_id = self.next_id
-                    ids_np = np.array([new_id], dtype=np.int64)
-                    self.index.add_with_ids(vector_np, ids_np)
-                    self.id_map[new_id] = {"product_id": product_id, "image_path": image_path}
-                    self.next_id += 1
-                    
-                    # Chỉ xóa vector cũ sau khi đã thêm thành công vector mới
-                    if id_to_remove is not None:
-                        self.index.remove_ids(np.array([id_to_remove], dtype=np.int64))
-                        # id_map đã được cập nhật trước đó
-                        logger.info(f"[TextIndex] Replaced old entry for image: {image_path}")
-
-                    self.save()
+                    # Ghi journal trước, rồi mới áp vào RAM trong write lock
+                    seq = self._log({
+                        "op": "add", "id": new_id, "product_id": product_id,
+                        "image_path": image_path, "vector": encode_vector(vector_np[0])
+                    })
+                    with self._rwlock.write_lock():
+                        replaced = self._apply_add(new_id, vector_np, product_id, image_path)
+
+                if replaced:
+                    logger.info(f"[TextIndex] Replaced old entry for image: {image_path}")
+                self._wait_durable(seq)
+                self._snapshots.mark_dirty()
                 return True
                 
             except Exception:
                 logger.error(f"[TextIndex] ADD CRASHED:\n{traceback.format_exc()}")
                 return False
 
+    def add_products(self, vectors: np.ndarray, product_ids: list, image_paths: list) -> int:
+        """
+        Thêm nhiều ảnh (upsert theo image_path) trong MỘT lần giữ write lock và chờ fsync MỘT lần.
+        Dùng cho reindex / bulk load. Trả về số ảnh đã thêm (0 nếu lỗi / chưa chắc đã ghi xuống đĩa).
+        """
+        with Timer("TextIndex_AddProducts", metadata={"batch": len(product_ids)}):
+            try:
+                vectors_np = self._prepare_vector(vectors)
+                if vectors_np is None or len(vectors_np) != len(product_ids) or len(image_paths) != len(product_ids):
+                    logger.error("[TextIndex] add_products: invalid vectors batch.")
+                    return 0
+
+                with self._write_mutex:
+                    new_ids = list(range(self.next_id, self.next_id + len(vectors_np)))
+                    seq = 0
+                    for new_id, vector_row, product_id, image_path in zip(new_ids, vectors_np, product_ids, image_paths):
+                        seq = self._log({
+                            "op": "add", "id": new_id, "product_id": product_id,
+                            "image_path": image_path, "vector": encode_vector(vector_row)
+                        })
+                    with self._rwlock.write_lock():
+                        self._apply_add_batch(new_ids, vectors_np, product_ids, image_paths)
+
+                self._wait_durable(seq)
+                self._snapshots.mark_dirty(len(new_ids))
+                return len(new_ids)
+            except Exception:
+                logger.error(f"[TextIndex] ADD BATCH CRASHED:\n{traceback.format_exc()}")
+                return 0
+
     def remove_list_images(self, product_id: str, image_paths: list) -> int:
+        """Xóa các ảnh của một product_id. Trả về số entry đã xóa, -1 nếu lỗi."""
         task_metadata = {"product_id": product_id, "num_images": len(image_paths)}
         with Timer("TextIndex_RemoveListImages", metadata=task_metadata):
             try:
-                ids_to_remove = []
                 target_images = set(image_paths)
                 
-                with self._file_lock:
-                    for int_id, info in list(self.id_map.items()):
-                        if isinstance(info, dict) and str(info.get('product_id')) == str(product_id) and info.get('image_path') in target_images:
-                            ids_to_remove.append(int_id)
-                    
+                with self._write_mutex:
+                    ids_to_remove = [
+                        int_id for int_id in self._product_to_ids.get(str(product_id), ())
+                        if self.id_map[int_id].get('image_path') in target_images
+                    ]
                     if not ids_to_remove: return 0
-
-                    for iid in ids_to_remove:
-                        if iid in self.id_map: del self.id_map[iid]
-
-                    self.index.remove_ids(np.array(ids_to_remove, dtype=np.int64))
-                    self.save()
+                    seq = self._log({"op": "remove", "ids": ids_to_remove})
+                    with self._rwlock.write_lock():
+                        self._apply_remove(ids_to_remove)
+                self._wait_durable(seq)
+                self._snapshots.mark_dirty(len(ids_to_remove))
                 
                 logger.info(f"[TextIndex] Removed {len(ids_to_remove)} images for product {product_id}.")
                 return len(ids_to_remove)
             except Exception:
                 logger.error(f"[TextIndex] REMOVE BATCH CRASHED:\n{traceback.format_exc()}")
-                return 0
+                return -1
             
     def remove_product(self, product_id: str) -> int:
         """
         Xóa TẤT CẢ các entry của một product_id.
-        Hàm này sẽ tìm tất cả các image_path của sản phẩm đó và gọi remove_list_images.
+        Các ID được lấy thẳng từ chỉ mục product_id -> {int_id}, không duyệt id_map.
+        Trả về số entry đã xóa, -1 nếu lỗi.
         """
         task_metadata = {"product_id": product_id}
         with Timer("TextIndex_RemoveFullProduct", metadata=task_metadata):
-            # 1. Tìm tất cả các image_path thuộc về product_id này
-            paths_to_remove = []
-            
-            # Phải duyệt qua một bản copy để tránh lỗi thay đổi dict trong lúc duyệt
-            for info in list(self.id_map.values()):
-                if isinstance(info, dict) and str(info.get('product_id')) == str(product_id):
-                    paths_to_remove.append(info.get('image_path'))
+            try:
+                with self._write_mutex:
+                    ids_to_remove = list(self._product_to_ids.get(str(product_id), ()))
+                    if ids_to_remove:
+                        seq = self._log({"op": "remove", "ids": ids_to_remove})
+                        with self._rwlock.write_lock():
+                            self._apply_remove(ids_to_remove)
 
-            if not paths_to_remove:
-                logger.info(f"[TextIndex] No entries found for product '{product_id}'. Nothing to remove.")
-                return 0
-            
-            # 2. Tái sử dụng hàm remove_list_images để xóa
-            # Điều này giúp tập trung logic xóa và ghi file ở một nơi duy nhất.
-            logger.info(f"[TextIndex] Found {len(paths_to_remove)} entries. Requesting removal for product '{product_id}'.")
-            return self.remove_list_images(product_id, paths_to_remove)
+                if not ids_to_remove:
+                    logger.info(f"[TextIndex] No entries found for product '{product_id}'. Nothing to remove.")
+                    return 0
+                self._wait_durable(seq)
+                self._snapshots.mark_dirty(len(ids_to_remove))
+                logger.info(f"[TextIndex] Removed {len(ids_to_remove)} entries for product '{product_id}'.")
+                return len(ids_to_remove)
+            except Exception:
+                logger.error(f"[TextIndex] REMOVE PRODUCT CRASHED:\n{traceback.format_exc()}")
+                return -1
 
     def search(self, vector: np.ndarray, k: int = 20) -> list:
+        results = self.search_batch(vector, k=k)
+        return results[0] if results else []
+
+    def search_batch(self, vectors: np.ndarray, k: int = 20) -> list:
+        """
+        Tìm kiếm nhiều query vector trong MỘT lần gọi FAISS.
+        Trả về list (mỗi query một list kết quả đã khử trùng sản phẩm).
+        Lỗi được log rồi raise lại: trả [] sẽ khiến caller không phân biệt được với "không có kết quả".
+        """
         task_metadata = {"k": k, "index_total": self.index.ntotal if self.index else 0}
         with Timer("TextIndex_Search", metadata=task_metadata):
             try:
-                if not self.index or self.index.ntotal == 0: return []
-                
-                vector_np = self._prepare_vector(vector)
-                if vector_np is None: return []
+                vectors_np = self._prepare_vector(vectors)
+                if vectors_np is None:
+                    raise ValueError(f"Invalid query vectors for text index (dim={self.dim})")
+                task_metadata["n_queries"] = len(vectors_np)
+                if not self.index or self.index.ntotal == 0: return [[] for _ in range(len(vectors_np))]
 
-                distances, indices = self.index.search(vector_np, k)
-                
-                results = []
-                seen_products = set()
-                for i in range(len(indices[0])):
-                    idx = indices[0][i]
-                    score = distances[0][i]
-                    
-                    if idx == -1 or score <= 0: continue
-                    
-                    info = self.id_map.get(idx)
-                    if isinstance(info, dict):
-                        p_id = info.get('product_id')
-                        if p_id and p_id not in seen_products:
-                            seen_products.add(p_id)
-                            results.append({"id": p_id, "score": float(score), "image": info.get('image_path')})
-                return results
+                if self.result_cache is None:
+                    return self._search_uncached(vectors_np, k)
+                return self.result_cache.batch_lookup(
+                    vectors_np, (k,), self.generation, lambda missing: self._search_uncached(missing, k)
+                )
             except Exception:
                 logger.error(f"[TextIndex] SEARCH CRASHED:\n{traceback.format_exc()}")
-                return []
+                raise
+
+    def _search_uncached(self, vectors_np: np.ndarray, k: int) -> list:
+        """
+        Search FAISS + khử trùng sản phẩm (không qua cache).
+        Trả về min(k, số sản phẩm khác nhau có score > TEXT2IMG_SEARCH_SCORE_FLOOR) kết quả mỗi query.
+        """
+        # Read lock: index + id_map không đổi trong suốt các lượt search và lúc tra kết quả
+        with self._rwlock.read_lock():
+            if self.index.ntotal == 0:
+                return [[] for _ in range(len(vectors_np))]
+            if TEXT2IMG_SEARCH_USE_RANGE:
+                hits = self._range_hits(vectors_np, k)
+            else:
+                hits = self._collapsed_hits(vectors_np, k)
+
+            all_results = []
+            for D, I, _, keep in hits:
+                row_results = []
+                for pos in np.flatnonzero(keep):
+                    info = self.id_map[int(I[pos])]
+                    row_results.append({
+                        "id": info.get('product_id'),
+                        "score": float(D[pos]),
+                        "image": info.get('image_path')
+                    })
+                all_results.append(row_results)
+            return all_results
+
+    def _collapsed_hits(self, vectors_np: np.ndarray, k: int) -> list:
+        """Over-fetch thích ứng: bắt đầu với k * FETCH_FACTOR, chỉ search lại các query còn thiếu sản phẩm."""
+        floor = TEXT2IMG_SEARCH_SCORE_FLOOR
+
+        def run_search(batch, fetch_k):
+            with Timer("TextIndex_FAISS_Query", metadata={"fetch_k": fetch_k, "batch": len(batch)}):
+                D, I = self.index.search(batch, fetch_k)
+            # Score đã giảm dần: hit dưới ngưỡng -> -1, collapse_search coi như đã hết ứng viên
+            I[D <= floor] = -1
+            return D, I
+
+        hits, rounds = collapse_search(
+            run_search, self._lookup_product_codes, vectors_np, k, self.index.ntotal,
+            fetch_factor=TEXT2IMG_COLLAPSE_FETCH_FACTOR,
+            growth=TEXT2IMG_COLLAPSE_GROWTH,
+            max_rounds=TEXT2IMG_COLLAPSE_MAX_ROUNDS
+        )
+        logger.debug(f"[TextIndex] Collapsed search rounds: max={max(rounds)}")
+        return hits
+
+    def _range_hits(self, vectors_np: np.ndarray, k: int) -> list:
+        """range_search: lấy MỌI hit có score > floor trong 1 lần quét, rồi sắp xếp + khử trùng từng query."""
+        with Timer("TextIndex_FAISS_RangeSearch", metadata={"batch": len(vectors_np)}):
+            lims, D, I = self.index.range_search(vectors_np, TEXT2IMG_SEARCH_SCORE_FLOOR)
+        hits = []
+        for row in range(len(vectors_np)):
+            row_D, row_I = D[lims[row]:lims[row + 1]], I[lims[row]:lims[row + 1]]
+            order = np.argsort(-row_D, kind="stable")
+            row_D, row_I = row_D[order], row_I[order]
+            codes = self._lookup_product_codes(row_I[None, :])
+            hits.append((row_D, row_I, codes[0], first_unique_per_row(codes, k)[0]))
+        return hits
+
+    def _lookup_product_codes(self, indices: np.ndarray) -> np.ndarray:
+        """Ma trận FAISS id -> mã sản phẩm (-1 = bỏ qua: id trống / không có trong map / thiếu product_id)."""
+        id_codes = self._id_codes
+        indices = np.asarray(indices, dtype=np.int64)
+        valid = (indices >= 0) & (indices < len(id_codes))
+        codes = np.full(indices.shape, -1, dtype=np.int64)
+        codes[valid] = id_codes[indices[valid]]
+        return codes
 
     def reset_index(self):
         with Timer("TextIndex_ResetIndex"):
             try:
                 logger.warning("[TextIndex] RESETTING ENTIRE INDEX...")
-                with self._file_lock:
-                    self._create_new()
-                    self.save()
+                with self._write_mutex:
+                    self._log({"op": "reset"})
+                    with self._rwlock.write_lock():
+                        self._create_new()
+                        self.generation += 1
+                # Reset là thao tác hiếm và quan trọng -> ghi snapshot ngay
+                self._snapshots.mark_dirty()
+                self._snapshots.flush()
                 logger.info("[TextIndex] Index reset successfully.")
                 return True
             except Exception as e:
                 logger.error(f"[TextIndex] RESET FAILED: {e}", exc_info=True)
                 return False
             
-    def save(self):
-        """Lưu index và map xuống ổ cứng. Chỉ nên gọi hàm này bên trong một lock."""
-        with Timer("TextIndex_SaveToDisk"):
+    def save(self) -> bool:
+        """
+        Lưu index và map xuống ổ cứng (được gọi bởi snapshot scheduler).
+        Chỉ giữ lock trong lúc chụp trạng thái; ghi file tạm + rename nằm ngoài lock.
+        """
+        with self._save_lock, Timer("TextIndex_SaveToDisk"):
             try:
-                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
-                faiss.write_index(self.index, self.index_path)
-                with open(self.mapping_path, 'w', encoding='utf-8') as f:
-                    json.dump({"next_id": self.next_id, "mapping": self.id_map}, f, indent=2)
+                segmented = None
+                # Chụp trạng thái khi không có writer (search vẫn chạy song song), ghi file ngoài lock
+                with self._write_mutex, self._rwlock.read_lock():
+                    journal_seq, closed_segment = self.journal.rotate() if self.journal else (0, None)
+                    if self.use_mmap and not isinstance(self.index, SegmentedIndex):
+                        self.index = SegmentedIndex(self.index)
+                    if isinstance(self.index, SegmentedIndex):
+                        segmented = self.index
+                        index_bytes = faiss.serialize_index(segmented.begin_snapshot())
+                    else:
+                        index_bytes = faiss.serialize_index(self.index)
+                    data = {"next_id": self.next_id, "journal_seq": journal_seq, "mapping": dict(self.id_map)}
+                try:
+                    write_snapshot(self.index_path, index_bytes, self.mapping_path, data)
+                except Exception:
+                    if segmented is not None:
+                        segmented.abort_snapshot()
+                    raise
+
+                if segmented is not None:
+                    # mmap lại snapshot vừa ghi; delta chỉ giữ các thay đổi xảy ra trong lúc ghi
+                    new_base, _ = read_index_mmap(self.index_path)
+                    with self._write_mutex, self._rwlock.write_lock():
+                        if self.index is segmented: # reset_index có thể đã thay index
+                            self.index = segmented.rebase(new_base)
+
+                # Snapshot đã chứa mọi record <= journal_seq; giữ journal của một thế hệ cho snapshot .prev
+                if closed_segment is not None:
+                    if self._prev_closed_segment is not None:
+                        self.journal.drop_segments_through(self._prev_closed_segment)
+                    self._prev_closed_segment = closed_segment
+                return True
             except Exception:
                 logger.error(f"[TextIndex] SAVE CRASHED:\n{traceback.format_exc()}")
+                return False
+
+    def close(self):
+        """Dừng thread snapshot và ghi các thay đổi còn lại (gọi khi shutdown)."""
+        self._snapshots.stop(flush=True)
+        if self.journal is not None:
+            self.journal.close()
+
+    # --- Journal + áp thay đổi vào RAM ---
+    def _log(self, record: dict) -> int:
+        """Ghi record vào journal TRƯỚC khi áp dụng vào RAM. Trả về seq (0 nếu tắt journal)."""
+        return self.journal.append(record) if self.journal is not None else 0
+
+    def _wait_durable(self, seq: int):
+        """
+        Group commit: chờ lần fsync chung chứa record này rồi mới báo thành công (ngoài mọi lock).
+        fsync lỗi hoặc quá TEXT2IMG_GROUP_COMMIT_TIMEOUT_S -> JournalDurabilityError.
+        """
+        if seq and TEXT2IMG_GROUP_COMMIT_WAIT:
+            with Timer("TextIndex_WaitDurable", metadata={"seq": seq}):
+                if not self.journal.wait_durable(seq, timeout=TEXT2IMG_GROUP_COMMIT_TIMEOUT_S):
+                    raise JournalDurabilityError(
+                        f"Journal record {seq} not durable after {TEXT2IMG_GROUP_COMMIT_TIMEOUT_S}s"
+                    )
+
+    def _apply_add(self, int_id: int, vector_np: np.ndarray, product_id: str, image_path: str) -> bool:
+        """Thêm (upsert theo image_path). Gọi trong write lock. Trả về True nếu đã thay entry cũ."""
+        id_to_remove = self._find_id_by_image_path(image_path)
+        self.index.add_with_ids(vector_np, np.array([int_id], dtype=np.int64))
+        self.next_id = max(self.next_id, int_id + 1)
+        # Chỉ xóa vector cũ sau khi đã thêm thành công vector mới
+        if id_to_remove is not None:
+            self._forget(id_to_remove)
+            self.index.remove_ids(np.array([id_to_remove], dtype=np.int64))
+        self._remember(int_id, {"product_id": product_id, "image_path": image_path})
+        self.generation += 1
+        return id_to_remove is not None
+
+    def _apply_add_batch(self, new_ids: list, vectors_np: np.ndarray, product_ids: list, image_paths: list):
+        """
+        Như _apply_add cho cả batch nhưng chỉ gọi add_with_ids MỘT lần. Gọi trong write lock.
+        Cùng image_path xuất hiện nhiều lần trong batch -> giữ dòng cuối (giống replay journal từng record).
+        """
+        last_row = {image_path: row for row, image_path in enumerate(image_paths)}
+        rows = sorted(last_row.values())
+        ids_to_remove = [
+            old_id for old_id in (self._find_id_by_image_path(image_paths[row]) for row in rows)
+            if old_id is not None
+        ]
+        self.index.add_with_ids(vectors_np[rows], np.array([new_ids[row] for row in rows], dtype=np.int64))
+        self.next_id = max(self.next_id, new_ids[-1] + 1)
+        # Chỉ xóa vector cũ sau khi đã thêm thành công vector mới
+        if ids_to_remove:
+            for old_id in ids_to_remove:
+                self._forget(old_id)
+            self.index.remove_ids(np.array(ids_to_remove, dtype=np.int64))
+        for row in rows:
+            self._remember(new_ids[row], {"product_id": product_ids[row], "image_path": image_paths[row]})
+        self.generation += 1
+
+    def _apply_remove(self, ids_to_remove: list):
+        for int_id in ids_to_remove:
+            self._forget(int_id)
+        self.index.remove_ids(np.array(ids_to_remove, dtype=np.int64))
+        self.generation += 1
+
+    def _replay_journal(self, after_seq: int) -> int:
+        replayed = 0
+        with Timer("TextIndex_JournalReplay", metadata={"after_seq": after_seq}):
+            for record in self.journal.replay(after_seq):
+                op = record.get("op")
+                if op == "add":
+                    if record["id"] not in self.id_map:
+                        vector_np = decode_vector(record["vector"]).reshape(1, -1)
+                        self._apply_add(record["id"], vector_np, record["product_id"], record["image_path"])
+                elif op == "remove":
+                    ids = [i for i in record["ids"] if i in self.id_map]
+                    if ids:
+                        self._apply_remove(ids)
+                elif op == "reset":
+                    self._create_new()
+                replayed += 1
+        if replayed:
+            logger.info(f"[TextIndex] Replayed {replayed} journal records (after seq {after_seq})")
+        return replayed
 
     # --- ### UPDATE ### Các hàm helper mới ---
     def _prepare_vector(self, vector: np.ndarray) -> np.ndarray | None:
@@ -229,12 +503,55 @@ class TextIndexService:
             return None
 
     def _find_id_by_image_path(self, image_path: str) -> int | None:
-        """Tìm ID nội bộ của FAISS dựa trên image_path."""
-        for int_id, info in self.id_map.items():
-            if isinstance(info, dict) and info.get('image_path') == image_path:
-                del self.id_map[int_id] # Xóa khỏi map ngay lập tức
-                return int_id
-        return None
+        """Tìm ID nội bộ của FAISS dựa trên image_path (O(1))."""
+        return self._path_to_id.get(image_path)
+
+    # --- Chỉ mục ngược (chỉ gọi bên trong write lock) ---
+    def _remember(self, int_id: int, info: dict):
+        """Ghi entry vào id_map và cập nhật 2 chỉ mục ngược."""
+        product_key = str(info.get('product_id'))
+        self.id_map[int_id] = info
+        self._path_to_id[info.get('image_path')] = int_id
+        self._product_to_ids.setdefault(product_key, set()).add(int_id)
+        # Mã chỉ được cấp thêm (không thu hồi) để search dưới read lock không phải ghi dict
+        code = self._product_codes.setdefault(product_key, len(self._product_codes))
+        self._set_id_code(int_id, code if info.get('product_id') else -1)
+
+    def _forget(self, int_id: int):
+        """Xóa entry khỏi id_map và khỏi 2 chỉ mục ngược."""
+        info = self.id_map.pop(int_id, None)
+        if not isinstance(info, dict):
+            return
+        self._set_id_code(int_id, -1)
+        if self._path_to_id.get(info.get('image_path')) == int_id:
+            del self._path_to_id[info.get('image_path')]
+        product_key = str(info.get('product_id'))
+        ids = self._product_to_ids.get(product_key)
+        if ids is not None:
+            ids.discard(int_id)
+            if not ids:
+                del self._product_to_ids[product_key]
+
+    def _set_id_code(self, int_id: int, code: int):
+        if int_id >= len(self._id_codes):
+            # Nới mảng gấp đôi để add liên tiếp không phải copy mỗi lần
+            grown = np.full(max(int_id + 1, 2 * len(self._id_codes)), -1, dtype=np.int32)
+            grown[:len(self._id_codes)] = self._id_codes
+            self._id_codes = grown
+        self._id_codes[int_id] = code
+
+    def _rebuild_lookups(self):
+        """Dựng lại chỉ mục ngược từ id_map (sau khi load từ file)."""
+        self._path_to_id = {}
+        self._product_to_ids = {}
+        self._product_codes = {}
+        self._id_codes = np.full(self.next_id, -1, dtype=np.int32)
+        # Bỏ entry không hợp lệ; duyệt theo ID tăng dần để ảnh trùng path trỏ tới entry mới nhất
+        entries = sorted(self.id_map.items())
+        self.id_map = {}
+        for int_id, info in entries:
+            if isinstance(info, dict):
+                self._remember(int_id, info)
 
 # Singleton
 try:
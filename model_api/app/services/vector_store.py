@@ -0,0 +1,114 @@
+# model_api/app/services/vector_store.py
+import os
+import threading
+
+import numpy as np
+
+from app.utils.io_utils import fsync_dir
+from app.utils.logger import logger
+
+
+class VectorStore:
+    """
+    Bản float32 đầy đủ của các vector, lưu trên đĩa (np.memmap), hàng thứ i = FAISS id i.
+    Index trong RAM có thể chỉ giữ mã nén (SQ8 / FP16 / PQ); khi search, top ứng viên
+    được re-rank lại bằng vector gốc đọc từ file này (OS page cache lo phần cache).
+    """
+    def __init__(self, path: str, dim: int, capacity: int = 1024):
+        self.path = path
+        self.dim = dim
+        self._lock = threading.Lock()
+        self.created = not os.path.exists(path) # File mới -> cần backfill từ index
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        row_bytes = dim * 4
+        if self.created:
+            with open(path, "wb") as f:
+                f.truncate(capacity * row_bytes)
+        size = os.path.getsize(path)
+        if size % row_bytes != 0:
+            logger.warning(f"[VectorStore] {path} has a partial trailing row, truncating")
+            with open(path, "r+b") as f:
+                f.truncate(size - size % row_bytes)
+        self._open()
+
+    def _open(self):
+        rows = os.path.getsize(self.path) // (self.dim * 4)
+        self._mm = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(max(rows, 1), self.dim))
+
+    @property
+    def capacity(self) -> int:
+        return self._mm.shape[0]
+
+    def _ensure_capacity(self, max_id: int):
+        if max_id < self.capacity:
+            return
+        new_rows = max(max_id + 1, self.capacity * 2)
+        self._mm.flush()
+        with open(self.path, "r+b") as f:
+            f.truncate(new_rows * self.dim * 4)
+        self._open()
+
+    def put(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dim)
+        with self._lock:
+            self._ensure_capacity(int(ids.max()))
+            self._mm[ids] = vectors
+
+    def get(self, ids) -> np.ndarray:
+        """Đọc vector theo FAISS id (id ngoài phạm vi -> vector 0)."""
+        ids = np.asarray(ids, dtype=np.int64)
+        mm = self._mm # Giữ tham chiếu: _ensure_capacity có thể thay self._mm ở thread khác
+        valid = (ids >= 0) & (ids < mm.shape[0])
+        out = np.zeros(ids.shape + (self.dim,), dtype=np.float32)
+        out[valid] = mm[ids[valid]]
+        return out
+
+    def flush(self):
+        """Đẩy dữ liệu xuống đĩa (gọi trước khi ghi snapshot)."""
+        with self._lock:
+            self._mm.flush()
+            with open(self.path, "r+b") as f:
+                os.fsync(f.fileno())
+        fsync_dir(os.path.dirname(self.path) or ".")
+
+    def disk_bytes(self) -> int:
+        return os.path.getsize(self.path)
+
+
+def rerank_exact(queries: np.ndarray, D: np.ndarray, I: np.ndarray, store: VectorStore, top_n: int):
+    """
+    Tính lại score (inner product) của các ứng viên bằng vector float32 đầy đủ,
+    sắp xếp lại và giữ top_n. Vị trí I = -1 luôn bị đẩy xuống cuối.
+    """
+    top_n = min(top_n, I.shape[1])
+    out_D = np.full((len(I), top_n), -np.inf, dtype=np.float32)
+    out_I = np.full((len(I), top_n), -1, dtype=np.int64)
+    for row in range(len(I)):
+        # Xử lý từng query để giới hạn bộ nhớ tạm (n_candidates x dim)
+        scores = store.get(I[row]) @ queries[row]
+        scores[I[row] < 0] = -np.inf
+        order = np.argsort(-scores, kind="stable")[:top_n]
+        out_D[row] = scores[order]
+        out_I[row] = I[row][order]
+    return out_D, out_I
+
+
+def exact_topk(queries: np.ndarray, ids: np.ndarray, store: VectorStore, k: int, chunk: int = 65536):
+    """Brute-force top-k trên toàn bộ vector gốc (ground truth cho báo cáo recall)."""
+    best_D = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_I = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(ids), chunk):
+        chunk_ids = ids[start:start + chunk]
+        scores = queries @ store.get(chunk_ids).T
+        D = np.concatenate([best_D, scores], axis=1)
+        I = np.concatenate([best_I, np.broadcast_to(chunk_ids, scores.shape)], axis=1)
+        keep = min(k, D.shape[1])
+        part = np.argpartition(-D, keep - 1, axis=1)[:, :keep]
+        best_D = np.take_along_axis(D, part, axis=1)
+        best_I = np.take_along_axis(I, part, axis=1)
+    order = np.argsort(-best_D, axis=1)
+    return np.take_along_axis(best_D, order, axis=1), np.take_along_axis(best_I, order, axis=1)
@@ -3,6 +3,7 @@
 from ultralytics import YOLO
 # Giả sử bạn đã định nghĩa đường dẫn này trong file config
 from app.config import YOLO_WEIGHT_PATH
+from app.services.model_workers import use_model_workers
 from app.utils.logger import logger
 from app.utils.timer import Timer
 
@@ -30,7 +31,8 @@ class YoloService:
 # --- ĐIỀU QUAN TRỌNG NHẤT ---
 # Tạo một instance duy nhất (singleton) ngay khi ứng dụng khởi chạy.
 # Tất cả các service khác sẽ `import` và sử dụng chính `yolo_service` này.
+# Chế độ model worker: YOLO chỉ load trong các process worker, không load ở process FastAPI
 try:
-    yolo_service = YoloService()
+    yolo_service = None if use_model_workers() else YoloService()
 except Exception as e:
     yolo_service = None # Xử lý lỗi nếu không khởi tạo được
\ No newline at end of file
@@ -0,0 +1,52 @@
+# model_api/app/utils/histogram.py
+import bisect
+import threading
+
+
+class Histogram:
+    """
+    Histogram bucket cố định (kiểu Prometheus): đếm số quan sát <= mỗi cận trên.
+    Thread-safe, chi phí observe O(log số bucket); snapshot() trả về dict để trả qua API.
+    """
+    def __init__(self, bounds):
+        self.bounds = sorted(bounds)
+        self._counts = [0] * (len(self.bounds) + 1) # bucket cuối: > cận lớn nhất
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.bounds, value)] += 1
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    def quantile(self, q: float) -> float:
+        """Xấp xỉ bằng cận trên của bucket chứa quantile (bucket cuối -> giá trị lớn nhất)."""
+        with self._lock:
+            if self._count == 0:
+                return 0.0
+            target = q * self._count
+            seen = 0
+            for bound, count in zip(self.bounds, self._counts):
+                seen += count
+                if seen >= target:
+                    return bound
+            return self._max
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            buckets = {f"le_{bound:g}": count for bound, count in zip(self.bounds, self._counts)}
+            buckets["gt_max"] = self._counts[-1]
+            count, total, maximum = self._count, self._sum, self._max
+        return {
+            "count": count,
+            "mean": round(total / count, 4) if count else 0.0,
+            "max": round(maximum, 4),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
@@ -1,5 +1,7 @@
 import os
 import json
+import hashlib
+import tempfile
 from typing import Any
 
 def ensure_dir(path: str):
@@ -31,3 +33,49 @@ def list_files(folder: str, exts=None):
             if exts is None or os.path.splitext(f)[1].lower() in exts:
                 files.append(os.path.join(folder, f))
     return files
+
+def sha256_file(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """Tính SHA-256 của file (đọc theo chunk để không tốn RAM)"""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def atomic_write_bytes(file_path: str, data, keep_previous: bool = True) -> str:
+    """
+    Ghi file an toàn khi crash: ghi ra file tạm cùng thư mục -> fsync -> os.replace.
+    Nếu keep_previous=True, bản cũ được giữ lại ở `<file_path>.prev`.
+    Trả về SHA-256 của nội dung đã ghi.
+    """
+    data = memoryview(data).cast("B")
+    dir_name = os.path.dirname(file_path) or "."
+    ensure_dir(dir_name)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + ".", suffix=".tmp", dir=dir_name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if keep_previous and os.path.exists(file_path):
+            os.replace(file_path, file_path + ".prev")
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fsync_dir(dir_name)
+    return hashlib.sha256(data).hexdigest()
+
+def fsync_dir(dir_name: str):
+    """fsync thư mục để thao tác rename được ghi bền vững (bỏ qua trên Windows)"""
+    try:
+        fd = os.open(dir_name, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,85 @@
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """
+    Khóa đọc-ghi (ưu tiên writer):
+    - Nhiều thread search có thể giữ read lock cùng lúc.
+    - Write lock độc quyền; khi có writer đang chờ, reader mới phải đợi để writer không bị đói.
+    - Write lock reentrant cho thread đang giữ nó (VD: _remove_ids -> rebuild_index),
+      và thread đang giữ write lock được phép lấy thêm read lock.
+    - Read lock reentrant trong cùng thread.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None # thread ident đang giữ write lock
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    def _read_depth(self) -> int:
+        return getattr(self._local, "depth", 0)
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        if self._writer == me or self._read_depth() > 0:
+            # Đã giữ write lock hoặc read lock -> cho qua (tránh tự deadlock)
+            self._local.depth = self._read_depth() + 1
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting > 0:
+                self._cond.wait()
+            self._readers += 1
+        self._local.depth = 1
+
+    def release_read(self):
+        depth = self._read_depth() - 1
+        self._local.depth = depth
+        if depth > 0 or self._writer == threading.get_ident():
+            return
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_depth += 1
+                return
+            if self._read_depth() > 0:
+                raise RuntimeError("Cannot upgrade a read lock to a write lock")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers > 0:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read_lock(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_lock(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
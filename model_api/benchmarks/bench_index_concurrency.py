@@ -0,0 +1,114 @@
+# model_api/benchmarks/bench_index_concurrency.py
+"""
+Stress test IndexService (img2img): nhiều thread search song song với thread add/remove.
+In ra QPS và latency p50/p95 của search và của thao tác ghi.
+
+Chạy từ thư mục model_api:
+    python -m benchmarks.bench_index_concurrency --vectors 50000 --readers 8 --writers 1 --duration 10
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from app.services.index_service import IndexService
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def _percentiles(latencies: list) -> str:
+    if not latencies:
+        return "n/a"
+    ms = np.array(latencies) * 1000
+    return f"p50={np.percentile(ms, 50):.2f}ms p95={np.percentile(ms, 95):.2f}ms max={ms.max():.2f}ms"
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        service = IndexService(
+            os.path.join(tmp, "bench.faiss"), os.path.join(tmp, "bench_map.json"),
+            dim=args.dim, index_type=args.index_type, result_cache=False
+        )
+        print(f"Loading {args.vectors} vectors (dim={args.dim}, index_type={args.index_type})...")
+        vectors = _normalize(rng.standard_normal((args.vectors, args.dim)).astype(np.float32))
+        for i, vector in enumerate(vectors):
+            service.add_item(vector, f"p{i // args.images_per_product}", f"img{i}")
+        service.commit()
+        if args.index_type != "flat":
+            service.rebuild_index(args.index_type)
+
+        stop = threading.Event()
+        read_latencies = [[] for _ in range(args.readers)]
+        write_latencies = [[] for _ in range(args.writers)]
+        errors = []
+
+        def reader(slot):
+            local_rng = np.random.default_rng(args.seed + 1 + slot)
+            while not stop.is_set():
+                query = _normalize(local_rng.standard_normal((1, args.dim)).astype(np.float32))[0]
+                start = time.perf_counter()
+                try:
+                    service.search(query, k=args.k)
+                except Exception as e:
+                    errors.append(e)
+                read_latencies[slot].append(time.perf_counter() - start)
+
+        def writer(slot):
+            local_rng = np.random.default_rng(10_000 + slot)
+            n = 0
+            while not stop.is_set():
+                product_id = f"w{slot}_{n}"
+                vector = _normalize(local_rng.standard_normal((1, args.dim)).astype(np.float32))[0]
+                start = time.perf_counter()
+                try:
+                    service.add_item(vector, product_id, "img0")
+                    if n % 2 == 1: # Xóa lại sản phẩm trước đó để kích thước index ổn định
+                        service.remove_product(f"w{slot}_{n - 1}")
+                except Exception as e:
+                    errors.append(e)
+                write_latencies[slot].append(time.perf_counter() - start)
+                n += 1
+                if args.write_interval:
+                    time.sleep(args.write_interval)
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+        threads += [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+        print(f"Running {args.readers} readers + {args.writers} writers for {args.duration}s...")
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        service.close()
+
+        reads = [x for lat in read_latencies for x in lat]
+        writes = [x for lat in write_latencies for x in lat]
+        print(f"search: {len(reads)} ops, {len(reads) / args.duration:.1f} QPS, {_percentiles(reads)}")
+        print(f"write : {len(writes)} ops, {len(writes) / args.duration:.1f} ops/s, {_percentiles(writes)}")
+        print(f"errors: {len(errors)}" + (f" (first: {errors[0]!r})" if errors else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent search/mutation benchmark for IndexService")
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--images-per-product", type=int, default=4)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=1)
+    parser.add_argument("--write-interval", type=float, default=0.0, help="Giây nghỉ giữa các lần ghi")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=0)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
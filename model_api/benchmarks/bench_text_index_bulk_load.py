@@ -0,0 +1,84 @@
+# model_api/benchmarks/bench_text_index_bulk_load.py
+"""
+Bulk load TextIndexService (txt2img): thêm N ảnh qua add_product, in throughput theo từng chặng
+để thấy chi phí mỗi lần thêm không tăng theo kích thước index; sau đó đo upsert ảnh đã có
+và remove_product.
+
+Chạy từ thư mục model_api:
+    python -m benchmarks.bench_text_index_bulk_load --images 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from app.services.txt_index_service import TextIndexService
+
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        service = TextIndexService(
+            os.path.join(tmp, "bench_txt.faiss"), os.path.join(tmp, "bench_txt_map.json"), dim=args.dim
+        )
+        if args.snapshot_threshold:
+            # Snapshot nền ghi lại toàn bộ index mỗi lần -> ngưỡng nhỏ làm chậm bulk load
+            service._snapshots.dirty_threshold = args.snapshot_threshold
+        vectors = rng.standard_normal((args.images, args.dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+        def product_of(i):
+            return f"p{i // args.images_per_product}"
+
+        print(f"Bulk loading {args.images} images (dim={args.dim}), report every {args.report_every}...")
+        total_start = chunk_start = time.perf_counter()
+        for i in range(args.images):
+            service.add_product(vectors[i], product_of(i), f"images/{i}.jpg")
+            if (i + 1) % args.report_every == 0:
+                elapsed = time.perf_counter() - chunk_start
+                print(f"  {i + 1:>8} images: {args.report_every / elapsed:,.0f} images/s in last chunk")
+                chunk_start = time.perf_counter()
+        total = time.perf_counter() - total_start
+        print(f"bulk load: {args.images} images in {total:.2f}s ({args.images / total:,.0f} images/s)")
+
+        # Upsert: thêm lại ảnh đã tồn tại -> thay entry cũ
+        n_upserts = min(args.upserts, args.images)
+        targets = rng.choice(args.images, size=n_upserts, replace=False)
+        start = time.perf_counter()
+        for i in targets:
+            service.add_product(vectors[i], product_of(i), f"images/{i}.jpg")
+        elapsed = time.perf_counter() - start
+        print(f"upsert   : {n_upserts} images in {elapsed:.2f}s ({elapsed / n_upserts * 1000:.3f} ms/op)")
+
+        # Xóa cả sản phẩm
+        n_products = args.images // args.images_per_product
+        n_removes = min(args.removes, n_products)
+        start = time.perf_counter()
+        removed = sum(service.remove_product(f"p{p}") for p in rng.choice(n_products, size=n_removes, replace=False))
+        elapsed = time.perf_counter() - start
+        print(f"remove   : {n_removes} products ({removed} images) in {elapsed:.2f}s "
+              f"({elapsed / max(n_removes, 1) * 1000:.3f} ms/op)")
+
+        expected = args.images - removed
+        print(f"ntotal={service.index.ntotal} id_map={len(service.id_map)} expected={expected}")
+        service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load benchmark for TextIndexService")
+    parser.add_argument("--images", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--images-per-product", type=int, default=4)
+    parser.add_argument("--report-every", type=int, default=10000)
+    parser.add_argument("--upserts", type=int, default=1000)
+    parser.add_argument("--removes", type=int, default=1000)
+    parser.add_argument("--snapshot-threshold", type=int, default=0,
+                        help="Ghi đè TEXT2IMG_SNAPSHOT_DIRTY_THRESHOLD (0 = giữ cấu hình)")
+    parser.add_argument("--seed", type=int, default=0)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
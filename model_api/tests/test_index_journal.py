@@ -0,0 +1,85 @@
+# model_api/tests/test_index_journal.py
+import os
+
+import numpy as np
+import pytest
+
+from app.services import index_journal
+from app.services.index_journal import IndexJournal, JournalDurabilityError, encode_vector, decode_vector
+
+
+def _crash(journal):
+    # Mô phỏng process chết: bỏ file đang mở, không sync / close theo thứ tự
+    journal._file.close()
+    journal._file = None
+
+
+def test_replay_after_crash_ignores_torn_last_line(tmp_path):
+    path = str(tmp_path / "txt.journal")
+    journal = IndexJournal(path)
+    for i in range(3):
+        journal.append({"op": "add", "id": i, "vector": encode_vector(np.full(4, i, dtype=np.float32))})
+    segment_path = journal._segment_path(journal.segment)
+    _crash(journal)
+    with open(segment_path, "ab") as f:
+        f.write(b'{"seq":4,"op":"add","id":3,"vec') # crash giữa lúc append
+
+    journal = IndexJournal(path)
+    try:
+        records = list(journal.replay())
+        assert [r["seq"] for r in records] == [1, 2, 3]
+        assert decode_vector(records[2]["vector"]).tolist() == [2.0] * 4
+        # Record mới nằm ở segment mới, không nối sau dòng bị ghi dở
+        assert journal.last_seq == 3
+        assert journal.append({"op": "remove", "ids": [0]}) == 4
+        assert journal._segment_path(journal.segment) != segment_path
+        assert [r["seq"] for r in journal.replay()] == [1, 2, 3, 4]
+    finally:
+        journal.close()
+
+
+def test_replay_across_rotated_segments(tmp_path):
+    path = str(tmp_path / "txt.journal")
+    journal = IndexJournal(path)
+    try:
+        journal.append({"op": "remove", "ids": [1]})
+        journal.append({"op": "remove", "ids": [2]})
+        snapshot_seq, closed_segment = journal.rotate()
+        journal.append({"op": "remove", "ids": [3]})
+        assert snapshot_seq == 2
+
+        # Snapshot chưa ghi xong: replay từ đầu vẫn thấy đủ cả 2 segment
+        assert [r["seq"] for r in journal.replay()] == [1, 2, 3]
+        # Snapshot đã chứa seq <= 2 -> chỉ replay phần sau, segment cũ được xóa
+        journal.drop_segments_through(closed_segment)
+        assert journal._list_segments() == [journal.segment]
+        assert [r["ids"] for r in journal.replay(after_seq=snapshot_seq)] == [[3]]
+    finally:
+        journal.close()
+
+    journal = IndexJournal(path)
+    try:
+        assert journal.last_seq == 3
+    finally:
+        journal.close()
+
+
+def test_wait_durable_raises_when_group_commit_fsync_fails(tmp_path, monkeypatch):
+    journal = IndexJournal(str(tmp_path / "txt.journal"), group_commit_window_s=0.001)
+    real_fsync = os.fsync
+    try:
+        def failing_fsync(fd):
+            raise OSError(28, "No space left on device")
+
+        monkeypatch.setattr(index_journal.os, "fsync", failing_fsync)
+        seq = journal.append({"op": "remove", "ids": [1]})
+        # Không được treo: lỗi fsync nền phải tới được thread đang chờ
+        with pytest.raises(JournalDurabilityError):
+            journal.wait_durable(seq, timeout=5)
+
+        # fsync hoạt động lại -> record kế tiếp vẫn được xác nhận bình thường
+        monkeypatch.setattr(index_journal.os, "fsync", real_fsync)
+        seq = journal.append({"op": "remove", "ids": [2]})
+        assert journal.wait_durable(seq, timeout=5)
+    finally:
+        journal.close()
@@ -0,0 +1,127 @@
+# model_api/tests/test_index_service.py
+import numpy as np
+import pytest
+
+from app.services.index_service import IndexService, INDEX_TYPES
+
+DIM = 64 # IMG2IMG_PQ_M (64) phải chia hết cho dim
+N_PRODUCTS = 600 # 2 ảnh / sản phẩm -> đủ vector để train IVF / PQ
+
+
+def _normalize(x):
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+@pytest.fixture
+def vectors():
+    rng = np.random.default_rng(0)
+    return _normalize(rng.standard_normal((2 * N_PRODUCTS, DIM)))
+
+
+def _build(tmp_path, index_type, vectors):
+    service = IndexService(str(tmp_path / "img.faiss"), str(tmp_path / "img_map.json"), dim=DIM,
+                           index_type=index_type, use_journal=False, mmap=False, result_cache=False)
+    product_ids = [f"p{i // 2}" for i in range(len(vectors))]
+    image_ids = [f"img{i}" for i in range(len(vectors))]
+    groups = ["top" if (i // 2) % 2 == 0 else "bottom" for i in range(len(vectors))]
+    shop_ids = [str((i // 2) % 3) for i in range(len(vectors))]
+    service.add_items(vectors, product_ids, image_ids, groups=groups, shop_ids=shop_ids)
+    service.rebuild_index(index_type)
+    assert service.index_type == index_type
+    return service
+
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+def test_search_after_delete(tmp_path, vectors, index_type):
+    service = _build(tmp_path, index_type, vectors)
+    try:
+        assert service.remove_product("p0") == 2
+        assert service.remove_list_images("p1", ["img2"]) == 1
+
+        results = service.search(vectors[0], k=10, nprobe=64, ef_search=128)
+        assert len(results) == 10
+        assert "p0" not in {r["product_id"] for r in results}
+
+        # Ảnh còn lại của p1 vẫn tìm thấy được, ảnh đã xóa thì không
+        results = service.search(vectors[3], k=10, nprobe=64, ef_search=128)
+        assert len(results) == 10
+        assert results[0]["product_id"] == "p1" and results[0]["image_id"] == "img3"
+        assert "img2" not in {r["image_id"] for r in results}
+    finally:
+        service.close()
+
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+def test_search_with_group_and_shop_filter(tmp_path, vectors, index_type):
+    service = _build(tmp_path, index_type, vectors)
+    try:
+        # p1: group "bottom", shop "1"
+        results = service.search(vectors[2], k=10, nprobe=64, ef_search=128, group="bottom")
+        assert len(results) == 10
+        assert results[0]["product_id"] == "p1"
+        assert all(int(r["product_id"][1:]) % 2 == 1 for r in results)
+
+        results = service.search(vectors[2], k=10, nprobe=64, ef_search=128, group="bottom", shop_id="1")
+        assert len(results) == 10
+        assert all(int(r["product_id"][1:]) % 6 == 1 for r in results)
+
+        # Query của p0 (group "top") không được trả về p0 khi lọc "bottom"
+        results = service.search(vectors[0], k=10, nprobe=64, ef_search=128, group="bottom")
+        assert "p0" not in {r["product_id"] for r in results}
+
+        assert service.search(vectors[0], k=10, group="unknown") == []
+    finally:
+        service.close()
+
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+def test_filtered_search_after_delete(tmp_path, vectors, index_type):
+    service = _build(tmp_path, index_type, vectors)
+    try:
+        service.remove_product("p1")
+        results = service.search(vectors[2], k=10, nprobe=64, ef_search=128, group="bottom")
+        assert len(results) == 10
+        assert "p1" not in {r["product_id"] for r in results}
+    finally:
+        service.close()
+
+
+def test_add_and_remove_invalidate_cached_search(tmp_path, vectors):
+    service = IndexService(str(tmp_path / "img.faiss"), str(tmp_path / "img_map.json"), dim=DIM,
+                           index_type="flat", use_journal=False, mmap=False, result_cache=True)
+    try:
+        service.add_items(vectors[:4], ["p0", "p0", "p1", "p1"], ["img0", "img1", "img2", "img3"])
+        assert service.search(vectors[4], k=10)[0]["product_id"] in ("p0", "p1")
+        assert service.search(vectors[4], k=10) # lần 2: trúng cache
+
+        service.add_items(vectors[4:5], ["p2"], ["img4"])
+        results = service.search(vectors[4], k=10)
+        assert results[0]["product_id"] == "p2"
+
+        service.remove_product("p2")
+        assert "p2" not in {r["product_id"] for r in service.search(vectors[4], k=10)}
+        assert service.result_cache.stats()["hits"] == 1
+    finally:
+        service.close()
+
+
+def test_journal_replay_after_crash(tmp_path, vectors):
+    def open_service():
+        return IndexService(str(tmp_path / "img.faiss"), str(tmp_path / "img_map.json"), dim=DIM,
+                            index_type="flat", use_journal=True, mmap=False, result_cache=False)
+
+    service = open_service()
+    service.add_items(vectors[:4], ["p0", "p0", "p1", "p1"], ["img0", "img1", "img2", "img3"])
+    assert service.save()
+    service.add_items(vectors[4:6], ["p2", "p2"], ["img4", "img5"])
+    service.remove_list_images("p0", ["img1"])
+    # Crash: snapshot chỉ chứa 4 ảnh đầu, phần còn lại chỉ nằm trong journal
+    service.close(save=False)
+
+    service = open_service()
+    try:
+        assert service.ntotal == 5
+        assert service.search(vectors[5], k=10)[0]["image_id"] == "img5"
+        assert "img1" not in {r["image_id"] for r in service.search(vectors[1], k=10)}
+    finally:
+        service.close()
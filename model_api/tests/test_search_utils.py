@@ -0,0 +1,38 @@
+# model_api/tests/test_search_utils.py
+import numpy as np
+import pytest
+
+from app.services.search_utils import collapse_search, first_unique_per_row
+
+
+def _search_fn(batch, fetch_k):
+    # Hit thứ j của mọi query là FAISS id j, score giảm dần
+    I = np.tile(np.arange(fetch_k, dtype=np.int64), (len(batch), 1))
+    D = np.tile(-np.arange(fetch_k, dtype=np.float32), (len(batch), 1))
+    return D, I
+
+
+def test_first_unique_per_row_keeps_best_hit_per_product():
+    codes = np.array([[3, 3, 1, -1, 2], [5, 5, 5, 5, 5]])
+    keep = first_unique_per_row(codes, k=2)
+    assert keep.tolist() == [[True, False, True, False, False], [True, False, False, False, False]]
+
+
+def test_collapse_search_grows_fetch_k_until_k_products():
+    # Mỗi sản phẩm có 4 ảnh liền nhau -> lượt đầu (fetch_k = k) chưa đủ 5 sản phẩm
+    codes_per_id = np.repeat(np.arange(25), 4)
+    hits, rounds = collapse_search(_search_fn, lambda I: codes_per_id[I], np.zeros((2, 4)),
+                                   k=5, ntotal=100, fetch_factor=1, growth=4)
+    for _, _, codes, keep in hits:
+        assert codes[keep].tolist() == [0, 1, 2, 3, 4]
+    assert rounds == [2, 2]
+
+
+@pytest.mark.parametrize("k", [0, -1])
+def test_collapse_search_non_positive_k_returns_empty_rows(k):
+    def search_fn(batch, fetch_k):
+        raise AssertionError("search_fn must not run when k <= 0")
+
+    hits, rounds = collapse_search(search_fn, lambda I: I, np.zeros((3, 4)), k=k, ntotal=100)
+    assert rounds == [0, 0, 0]
+    assert all(len(I) == 0 and not keep.any() for _, I, _, keep in hits)
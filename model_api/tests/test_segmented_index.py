@@ -0,0 +1,43 @@
+# model_api/tests/test_segmented_index.py
+import faiss
+import numpy as np
+
+from app.services.segmented_index import SegmentedIndex, supports_search_params
+
+DIM = 64
+
+
+def _data(n=1000):
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((n, DIM)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_pq_base_search_skips_deleted_ids():
+    x = _data()
+    base = faiss.IndexIDMap2(faiss.IndexPQ(DIM, 8, 8, faiss.METRIC_INNER_PRODUCT))
+    base.train(x)
+    base.add_with_ids(x, np.arange(len(x), dtype=np.int64))
+    assert not supports_search_params(base)
+
+    seg = SegmentedIndex(base)
+    seg.remove_ids(np.arange(0, 500, dtype=np.int64))
+    seg.add_with_ids(x[:1], np.array([5000], dtype=np.int64))
+
+    D, I = seg.search(x[:4], 10)
+    assert I.shape == (4, 10)
+    assert (I >= 500).all()
+    assert I[0, 0] == 5000
+    assert (np.diff(D, axis=1) <= 1e-6).all()
+
+
+def test_flat_base_supports_search_params():
+    x = _data(100)
+    base = faiss.IndexIDMap2(faiss.IndexFlatIP(DIM))
+    base.add_with_ids(x, np.arange(len(x), dtype=np.int64))
+    assert supports_search_params(base)
+
+    seg = SegmentedIndex(base)
+    seg.remove_ids(np.array([0], dtype=np.int64))
+    _, I = seg.search(x[:1], 5)
+    assert 0 not in I[0]
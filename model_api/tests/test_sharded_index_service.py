@@ -0,0 +1,72 @@
+# model_api/tests/test_sharded_index_service.py
+import os
+
+import numpy as np
+import pytest
+
+from app.services.index_service import IndexService
+from app.services.sharded_index_service import ShardedIndexService, shard_path, IMPORT_MARKER_SUFFIX
+
+DIM = 16
+N_SHARDS = 3
+
+
+@pytest.fixture
+def legacy(tmp_path):
+    """Index một-file cũ: 40 sản phẩm x 3 ảnh, một phần chỉ nằm trong journal (chưa snapshot)."""
+    index_path, map_path = str(tmp_path / "img.faiss"), str(tmp_path / "img_map.json")
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((120, DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    service = IndexService(index_path, map_path, dim=DIM, index_type="flat", result_cache=False)
+    products = [f"p{i // 3}" for i in range(120)]
+    service.add_items(vectors[:90], products[:90], [f"img{i}" for i in range(90)])
+    service.save()
+    service.add_items(vectors[90:], products[90:], [f"img{i}" for i in range(90, 120)])
+    service.close(save=False)
+    return index_path, map_path, vectors
+
+
+def _open_sharded(index_path, map_path):
+    return ShardedIndexService(index_path, map_path, dim=DIM, num_shards=N_SHARDS,
+                               index_type="flat", result_cache=False)
+
+
+def test_import_unsharded_index(legacy):
+    index_path, map_path, vectors = legacy
+    sharded = _open_sharded(index_path, map_path)
+    try:
+        assert sharded.ntotal == 120
+        assert sum(1 for shard in sharded.shards if shard.ntotal) > 1
+        assert sharded.search(vectors[100], k=1)[0]["image_id"] == "img100"
+    finally:
+        sharded.close()
+    assert not os.path.exists(index_path)
+    assert os.path.exists(index_path + ".migrated")
+    assert not os.path.exists(index_path + IMPORT_MARKER_SUFFIX)
+
+    # Khởi động lại: không import lần nữa
+    reopened = _open_sharded(index_path, map_path)
+    try:
+        assert reopened.ntotal == 120
+    finally:
+        reopened.close()
+
+
+def test_interrupted_import_is_redone(legacy):
+    index_path, map_path, vectors = legacy
+    # Mô phỏng crash giữa chừng: marker còn đó, một shard đã có một phần dữ liệu
+    partial = IndexService(shard_path(index_path, 0), shard_path(map_path, 0), dim=DIM,
+                           index_type="flat", result_cache=False)
+    partial.add_items(vectors[:5], ["p0"] * 5, [f"img{i}" for i in range(5)])
+    partial.close()
+    open(index_path + IMPORT_MARKER_SUFFIX, "w").close()
+
+    sharded = _open_sharded(index_path, map_path)
+    try:
+        assert sharded.ntotal == 120
+        results = sharded.search(vectors[0], k=3)
+        assert [r["image_id"] for r in results].count("img0") == 1
+    finally:
+        sharded.close()
+    assert not os.path.exists(index_path + IMPORT_MARKER_SUFFIX)
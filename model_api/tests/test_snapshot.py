@@ -0,0 +1,62 @@
+# model_api/tests/test_snapshot.py
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from app.services.snapshot import write_snapshot, load_snapshot
+
+DIM = 8
+
+
+def _write(tmp_path, ntotal):
+    index = faiss.IndexFlatIP(DIM)
+    index.add(np.ones((ntotal, DIM), dtype=np.float32))
+    write_snapshot(str(tmp_path / "idx.faiss"), faiss.serialize_index(index),
+                   str(tmp_path / "idx_map.json"), {"ntotal": ntotal})
+
+
+def _load(tmp_path, mmap=False):
+    return load_snapshot(str(tmp_path / "idx.faiss"), str(tmp_path / "idx_map.json"), mmap=mmap)
+
+
+def _truncate(path):
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) // 2)
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_load_latest_snapshot(tmp_path, mmap):
+    _write(tmp_path, 2)
+    _write(tmp_path, 3)
+    index, mapping = _load(tmp_path, mmap)
+    assert index.ntotal == 3 and mapping["ntotal"] == 3
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_torn_index_falls_back_to_prev(tmp_path, mmap):
+    _write(tmp_path, 2)
+    _write(tmp_path, 3)
+    _truncate(tmp_path / "idx.faiss")
+    index, mapping = _load(tmp_path, mmap)
+    assert index.ntotal == 2 and mapping["ntotal"] == 2
+
+
+def test_crash_before_mapping_rename_uses_prev_index(tmp_path):
+    _write(tmp_path, 2)
+    _write(tmp_path, 3)
+    # Crash giữa 2 bước của write_snapshot: index mới đã rename, mapping vẫn là bản cũ
+    os.replace(tmp_path / "idx_map.json.prev", tmp_path / "idx_map.json")
+    index, mapping = _load(tmp_path)
+    assert index.ntotal == 2 and mapping["ntotal"] == 2
+
+
+def test_all_snapshots_corrupt_starts_empty_and_keeps_files(tmp_path):
+    _write(tmp_path, 2)
+    _write(tmp_path, 3)
+    _truncate(tmp_path / "idx.faiss")
+    _truncate(tmp_path / "idx.faiss.prev")
+    assert _load(tmp_path) == (None, None)
+    assert not (tmp_path / "idx.faiss").exists()
+    assert any(name.startswith("idx.faiss.corrupt-") for name in os.listdir(tmp_path))
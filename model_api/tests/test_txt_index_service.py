@@ -0,0 +1,110 @@
+# model_api/tests/test_txt_index_service.py
+import numpy as np
+import pytest
+
+from app.services.txt_index_service import TextIndexService
+
+DIM = 8
+
+
+def _vec(i):
+    # Mọi cặp vector có tích vô hướng > 0 (vượt TEXT2IMG_SEARCH_SCORE_FLOOR mặc định)
+    v = np.full(DIM, 0.1, dtype=np.float32)
+    v[i] += 1.0
+    return v / np.linalg.norm(v)
+
+
+def _open(tmp_path):
+    return TextIndexService(str(tmp_path / "txt.faiss"), str(tmp_path / "txt_map.json"), dim=DIM)
+
+
+def _crash(service):
+    # Process chết trước khi snapshot được ghi: chỉ còn journal trên đĩa
+    service._snapshots.stop(flush=False)
+    service.journal.close()
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = _open(tmp_path)
+    yield service
+    service.close()
+
+
+def _ids(results):
+    return [r["id"] for r in results]
+
+
+def test_add_product_upserts_by_image_path(service):
+    assert service.add_product(_vec(0), "p0", "a.jpg")
+    assert service.add_product(_vec(1), "p1", "a.jpg")
+    assert service.index.ntotal == 1
+    assert list(service.id_map.values()) == [{"product_id": "p1", "image_path": "a.jpg"}]
+    assert _ids(service.search(_vec(0), k=5)) == ["p1"]
+
+
+def test_search_returns_each_product_once(service):
+    service.add_product(_vec(0), "p0", "a.jpg")
+    service.add_product(_vec(0) * 0.99 + _vec(1) * 0.01, "p0", "b.jpg")
+    service.add_product(_vec(2), "p1", "c.jpg")
+    results = service.search(_vec(0), k=2)
+    assert _ids(results) == ["p0", "p1"]
+    assert results[0]["image"] == "a.jpg"
+
+
+def test_add_invalidates_cached_search(service):
+    service.add_product(_vec(0), "p0", "a.jpg")
+    assert _ids(service.search(_vec(1), k=5)) == ["p0"]
+    generation = service.generation
+
+    service.add_product(_vec(1), "p1", "b.jpg")
+    assert service.generation > generation
+    assert _ids(service.search(_vec(1), k=5)) == ["p1", "p0"]
+
+    service.remove_product("p1")
+    assert _ids(service.search(_vec(1), k=5)) == ["p0"]
+
+
+def test_add_products_keeps_last_duplicate_in_batch(service):
+    vectors = np.stack([_vec(0), _vec(1), _vec(2)])
+    assert service.add_products(vectors, ["p0", "p1", "p2"], ["a.jpg", "b.jpg", "a.jpg"]) == 3
+    assert service.index.ntotal == 2
+    assert sorted(info["product_id"] for info in service.id_map.values()) == ["p1", "p2"]
+    assert _ids(service.search(_vec(0), k=5))[0] != "p0"
+
+
+def test_journal_replay_after_crash(tmp_path):
+    service = _open(tmp_path)
+    service.add_product(_vec(0), "p0", "a.jpg")
+    service.add_products(np.stack([_vec(1), _vec(2)]), ["p1", "p2"], ["b.jpg", "a.jpg"])
+    service.remove_product("p1")
+    expected_map, expected_next_id = dict(service.id_map), service.next_id
+    _crash(service)
+
+    service = _open(tmp_path)
+    try:
+        assert service.id_map == expected_map
+        assert service.next_id == expected_next_id
+        assert service.index.ntotal == 1
+        assert _ids(service.search(_vec(2), k=5)) == ["p2"]
+        # ID mới không đè lên ID đã cấp trước crash
+        service.add_product(_vec(3), "p3", "d.jpg")
+        assert service._find_id_by_image_path("d.jpg") == expected_next_id
+    finally:
+        service.close()
+
+
+def test_snapshot_then_journal_tail_survive_restart(tmp_path):
+    service = _open(tmp_path)
+    service.add_product(_vec(0), "p0", "a.jpg")
+    assert service.save()
+    service.add_product(_vec(1), "p0", "a.jpg") # upsert sau snapshot -> chỉ nằm trong journal
+    _crash(service)
+
+    service = _open(tmp_path)
+    try:
+        assert service.index.ntotal == 1
+        assert _ids(service.search(_vec(1), k=5)) == ["p0"]
+        assert service.search(_vec(1), k=5)[0]["score"] == pytest.approx(1.0, abs=1e-5)
+    finally:
+        service.close()